@@ -1,15 +1,21 @@
 #!/usr/bin/python
 '''Entrypoint for APS CLI'''
 import argparse
+import glob
 import json
 import logging
 import os
 import sys
+import threading
 import traceback
-
-import coloredlogs
-
-from apsapi import ApsApi
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Modules only needed by some commands (apsapi, aps_preflight, coloredlogs) are imported
+# where they are used, to keep the startup of the tool fast.
+from aps_daemon import (
+    ApsDaemon, ApsDaemonClient, DAEMON_METHODS, get_identity, get_socket_path)
+from aps_exceptions import ApsErrorResponseException
 from aps_utils import (
     setup_logging, LOGGER)
 
@@ -24,32 +30,108 @@ os.environ['COLOREDLOGS_FIELD_STYLES'] = ''
 os.environ['COLOREDLOGS_LEVEL_STYLES'] = 'debug=blue;info=green;warning=yellow;' +\
                                       'error=red;critical=red,bold'
 
+# Arguments of the command run by the current thread in batch mode
+BATCH_COMMAND = threading.local()
+
+# Commands which cannot be run by the batch command
+NON_BATCH_COMMANDS = ['batch', 'serve']
+
+def install_logging(level):
+    '''Install colored log output at the given level'''
+    import coloredlogs # pylint: disable=import-outside-toplevel
+    coloredlogs.install(level=level)
+
+def project(record, fields):
+    '''Restrict a record to the given fields'''
+    if not fields:
+        return record
+    return {field: record[field] for field in fields if field in record}
+
+def add_output_arguments(parser):
+    '''Add the output format arguments of listing commands'''
+    parser.add_argument('--output', type=str, required=False, default='json',
+                        choices=['json', 'ndjson'],
+                        help='''Output format. With ndjson each record is written on its own
+                        line as soon as it is received, without loading the whole listing.''')
+    parser.add_argument('--fields', type=str, required=False,
+                        help='''Comma separated list of the fields of each record to output.
+                        The fields are selected locally, after the full records have been
+                        fetched, so this does not reduce the data transferred.''')
+
+def output_listing(records, args):
+    '''Output the records of a listing according to the output format arguments.
+    Returns the listing to print for the json format, or None for ndjson.'''
+    fields = args.fields.split(',') if args.fields else None
+    # In batch mode the result of each command is written as a single line
+    if args.output == 'ndjson' and getattr(BATCH_COMMAND, 'args', None) is None:
+        # An error object is returned instead of records, so it is detected before any
+        # record is written and printed like the json format does
+        try:
+            for record in records:
+                sys.stdout.write(json.dumps(project(record, fields), sort_keys=True) + '\n')
+                sys.stdout.flush()
+        except ApsErrorResponseException as e:
+            return e.response
+        return None
+    if not isinstance(records, (list, dict)):
+        records = list(records)
+    if isinstance(records, list):
+        return [project(record, fields) for record in records]
+    if 'errorMessage' in records:
+        return records
+    return project(records, fields)
+
+def batch_arguments(args):
+    '''Convert a dict of command arguments to a list of command line arguments'''
+    arguments = []
+    for name, value in args.items():
+        option = f'--{name}'
+        if value is True:
+            arguments.append(option)
+        elif isinstance(value, list):
+            arguments += [option] + value
+        elif value is not None and value is not False:
+            arguments += [option, value]
+    return arguments
+
 def supported_commands():
     '''Returns the list of supported commands'''
     return ['protect',
+            'protect-batch',
+            'jobs',
             'list-applications',
             'add-application',
             'update-application',
             'delete-application',
+            'apply',
             'set-signing-certificate',
             'set-mapping-file',
             'list-builds',
             'add-build',
             'delete-build',
+            'prune-builds',
             'protect-start',
             'protect-get-status',
             'protect-cancel',
             'protect-download',
             'get-account-info',
+            'get-statistics',
+            'report',
             'display-application-package-id',
+            'validate',
             'get-sail-config',
-            'get-version' ]
+            'get-version',
+            'batch',
+            'serve' ]
 
 class Aps:
     '''Class encapsulating all supported command line options'''
     def __init__(self):
 
-        self.commands = None
+        self.default_commands = None
+        # Set in batch mode, where commands share one ApsApi per authentication scope
+        self.shared_commands = None
+        self.shared_lock = threading.Lock()
 
         parser = argparse.ArgumentParser(
             description='APS command line tool',
@@ -57,17 +139,21 @@ class Aps:
     The following commands are available
 
       * protect
+      * protect-batch
+      * jobs
 
       * list-applications
       * add-application
       * update-application
       * delete-application
+      * apply
       * set-signing-certificate
       * set-mapping-file
 
       * list-builds
       * add-build
       * delete-build
+      * prune-builds
 
       * protect-start
       * protect-get-status
@@ -75,10 +161,16 @@ class Aps:
       * protect-download
 
       * get-account-info
+      * get-statistics
+      * report
       * display-application-package-id
+      * validate
       * get-sail-config
       * get-version
 
+      * batch
+      * serve
+
     Use aps <command> -h for information on a specific command.
     Use aps -h for information on the global options.
      ''')
@@ -100,11 +192,46 @@ class Aps:
 
         parser.add_argument('-b', '--boto-logs',
                             action='store_true',
-                            help='Include verbose logging output from boto3')
+                            help='Include verbose logging output from third party modules')
 
         parser.add_argument('--api-gateway-url', type=str, required=False, help = 'Optional Api gateway URL')
         parser.add_argument('--access-token-url', type=str, required=False, help='Optional Access token URL')
 
+        parser.add_argument('--daemon-socket', type=str, required=False,
+                            help='Socket of the APS daemon (see the serve command)')
+        parser.add_argument('--no-daemon',
+                            action='store_true',
+                            help='Do not forward commands to a running APS daemon')
+        parser.add_argument('--progress', type=str, required=False, choices=['json'],
+                            help='''Write progress events of uploads, downloads and protections to
+                            stderr, one JSON object per line''')
+        parser.add_argument('--profile', type=str, required=False, choices=['cpu', 'mem'],
+                            help='''Run the command under the CPU (cProfile) or memory
+                            (tracemalloc) profiler, and write a summary to stderr''')
+        parser.add_argument('--profile-output', type=str, required=False,
+                            help='Profile file to write, by default aps-cpu.prof or aps-mem.prof')
+        parser.add_argument('--profile-top', type=int, required=False, default=20,
+                            help='Number of entries in the profile summary')
+        parser.add_argument('--no-cache',
+                            action='store_true',
+                            help='''Do not cache responses of read-mostly endpoints (e.g.
+                            get-account-info, get-version) locally''')
+        parser.add_argument('--skip-applied-certificates',
+                            action='store_true',
+                            help='''Do not upload a signing certificate (e.g. with protect) when
+                            this host set the same certificate on the application before.
+                            APS does not return the certificate of an application, so
+                            without this option it is uploaded every time.''')
+        parser.add_argument('--compress-mapping-files',
+                            action='store_true',
+                            help='''Experimental: upload R8/Proguard mapping files gzip
+                            compressed, as <name>.gz (e.g. with protect or protect-batch).
+                            APS is not known to accept compressed mapping files yet, so a
+                            warning is logged whenever this is used.''')
+        parser.add_argument('--sample-rss', type=float, required=False, metavar='SECONDS',
+                            help='''Sample the resident memory at this interval during protect,
+                            and report the peak of each phase in the timing report''')
+
         # find the index of the command argument
         self.command_pos = len(sys.argv)
         i = 0
@@ -123,6 +250,7 @@ class Aps:
 
         # python doesn't allow for hyphens in method names
         mapped_command = args.command.replace('-', '_')
+        self.mapped_command = mapped_command
 
         if not hasattr(self, mapped_command):
             print('Unrecognized command')
@@ -131,7 +259,12 @@ class Aps:
 
         # invoke command
         try:
-            response = getattr(self, mapped_command)(args)
+            if args.profile:
+                from aps_profile import profile # pylint: disable=import-outside-toplevel
+                response = profile(args.profile, lambda: getattr(self, mapped_command)(args),
+                                   args.profile_output, args.profile_top)
+            else:
+                response = getattr(self, mapped_command)(args)
             if response is not None:
                 if isinstance(response, str):
                     print(response)
@@ -141,25 +274,78 @@ class Aps:
             traceback.print_exc()
             sys.exit(1)
 
+    def command_args(self):
+        '''Returns the arguments of the command to run: those following it on the command
+        line, or those of the command run by the current thread in batch mode'''
+        args = getattr(BATCH_COMMAND, 'args', None)
+        if args is not None:
+            return args
+        return sys.argv[self.command_pos:]
+
+    @property
+    def commands(self):
+        '''The ApsApi (or daemon client) running the current command. In batch mode this
+        is the one of the scope of the command run by the current thread.'''
+        commands = getattr(BATCH_COMMAND, 'commands', None)
+        return self.default_commands if commands is None else commands
+
+    @commands.setter
+    def commands(self, commands):
+        self.default_commands = commands
+
     def initialize_from_global_args(self, args, **kwargs):
         '''Parse global command line arguments'''
-        if args.logging:
-            coloredlogs.install(level=args.logging)
-
-        self.commands = ApsApi(args,
-                               vmx_platform=args.platform,
-                               verbose_logs=args.boto_logs,
-                               rest_api_id = args.rest_api_id)
+        scope = kwargs.pop('scope', 'aps')
+        if self.shared_commands is not None:
+            # The session of each scope is authenticated once, by its first command
+            with self.shared_lock:
+                if scope not in self.shared_commands:
+                    self.shared_commands[scope] = self.create_api(args, scope)
+                BATCH_COMMAND.commands = self.shared_commands[scope]
+            return
 
-        if args.client_id and args.client_secret:
-            scope = kwargs.pop('scope', 'aps')
-            self.commands.authenticate_api_key(args.client_id, args.client_secret, scope=scope)
-        else:
+        if args.logging:
+            install_logging(args.logging)
+
+        # Forward the command to a daemon running with the same credentials, if any.
+        # Progress events are not forwarded, and the daemon is not profiled, so commands
+        # reporting or profiling them run locally. So do commands with protection options
+        # which the daemon, running with its own options, would not apply.
+        run_locally = args.no_daemon or args.progress or args.profile or args.sample_rss or \
+            args.compress_mapping_files or args.skip_applied_certificates
+        if self.mapped_command in DAEMON_METHODS and not run_locally:
+            client = ApsDaemonClient(get_socket_path(args), get_identity(args))
+            if client.is_available():
+                self.commands = client
+                return
+
+        self.commands = self.create_api(args, scope)
+
+    def create_api(self, args, scope):
+        '''Returns an ApsApi for the global arguments, authenticated for the given scope'''
+        from apsapi import ApsApi # pylint: disable=import-outside-toplevel
+        progress = None
+        if args.progress == 'json':
+            from aps_progress import json_progress_writer # pylint: disable=import-outside-toplevel
+            progress = json_progress_writer()
+        commands = ApsApi(args,
+                          vmx_platform=args.platform,
+                          verbose_logs=args.boto_logs,
+                          rest_api_id = args.rest_api_id,
+                          progress=progress,
+                          rss_interval=args.sample_rss,
+                          compress_mapping_files=args.compress_mapping_files,
+                          use_http_cache=not args.no_cache,
+                          skip_applied_certificates=args.skip_applied_certificates)
+
+        if not (args.client_id and args.client_secret):
             msg = ('Error: missing authentication credentials.\n'
                    'Either a --username, --password pair or a --client-id, --client-secret\n'
                    'pair of arguments must be provided')
             print(msg)
             sys.exit(1)
+        commands.authenticate_api_key(args.client_id, args.client_secret, scope=scope)
+        return commands
 
     def protect(self, global_args):
         '''Perform APS protection from an input file.
@@ -173,7 +359,7 @@ class Aps:
             description='Perform APS protection on the input file.')
 
         parser.add_argument('--file', type=str, required=True,
-                            help='Build file (aab, apk or zipped xcarchive folder)')
+                            help='Build file (aab, apk, xcarchive folder or zipped xcarchive folder)')
         parser.add_argument('--subscription-type', type=str, required=False,
                             help='Subscription Type',
                             choices=SUBSCRIPTION_TYPES)
@@ -181,17 +367,125 @@ class Aps:
                             help='PEM encoded certificate file.')
         parser.add_argument('--mapping-file', type=str, required=False,
                             help='R8/Proguard mapping file for android')
+        parser.add_argument('--timeout', type=float, required=False,
+                            help='''Overall time limit in seconds for the upload, protection and
+                            download. When it runs out the upload is aborted or the protection
+                            cancelled.''')
+        parser.add_argument('--no-preflight',
+                            action='store_true',
+                            help='Do not check the build file locally before uploading it')
+        parser.add_argument('--timing-report', type=str, required=False,
+                            help='''Write the time spent in each phase of the protection, and the
+                            bytes moved, to this JSON file''')
+        parser.add_argument('--metrics-file', type=str, required=False,
+                            help='''Write the timing report to this file in the OpenMetrics text
+                            format, e.g. for the node_exporter textfile collector''')
 
 
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args)
 
         return self.commands.protect(args.file,
                                      signing_certificate=args.signing_certificate,
                                      subscription_type=args.subscription_type,
-                                     mapping_file=args.mapping_file)
+                                     mapping_file=args.mapping_file,
+                                     timeout=args.timeout,
+                                     preflight=not args.no_preflight,
+                                     timing_report=args.timing_report,
+                                     metrics_file=args.metrics_file)
+
+    def protect_batch(self, global_args):
+        '''Perform APS protection of many input files.
+
+        Input files are given as glob patterns, a list file or a JSON manifest. The
+        files are processed concurrently as a pipeline (inspect, build, upload, protect,
+        download) and each protected binary is downloaded into its own folder. Returns a
+        summary with the result for each file.'''
+
+        parser = argparse.ArgumentParser(
+            usage='aps protect-batch [<args>]',
+            description='Perform APS protection on many input files.')
+
+        parser.add_argument('--files', type=str, nargs='+', required=False,
+                            help='Build files or glob patterns (aab, apk, xcarchive folder or zipped '
+                            'xcarchive folder)')
+        parser.add_argument('--list-file', type=str, required=False,
+                            help='File listing one build file per line')
+        parser.add_argument('--manifest', type=str, required=False,
+                            help='''JSON file containing a list of jobs. Each job is an object
+                            with a "file" property and optional "subscription_type",
+                            "signing_certificate", "mapping_file" and "output_dir" properties''')
+        parser.add_argument('--output-dir', type=str, required=False,
+                            help='''Folder under which each protected file is downloaded
+                            into its own sub folder. Defaults to the current folder.''')
+        parser.add_argument('--subscription-type', type=str, required=False,
+                            help='Subscription Type',
+                            choices=SUBSCRIPTION_TYPES)
+        parser.add_argument('--signing-certificate', type=str, required=False,
+                            help='PEM encoded certificate file.')
+        parser.add_argument('--mapping-file', type=str, required=False,
+                            help='R8/Proguard mapping file for android')
+        parser.add_argument('--workers', type=int, required=False,
+                            help='Number of concurrent workers for each pipeline stage')
+        parser.add_argument('--no-preflight',
+                            action='store_true',
+                            help='Do not check the build file locally before uploading it')
+
+        # inside subcommands ignore the first command_pos argv's
+        args = parser.parse_args(self.command_args())
+
+        jobs = []
+        for pattern in args.files or []:
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                parser.error(f'No files match {pattern}')
+            jobs.extend(matches)
+        if args.list_file:
+            with open(args.list_file, 'r') as file_handle:
+                jobs.extend(line.strip() for line in file_handle if line.strip())
+        if args.manifest:
+            with open(args.manifest, 'r') as file_handle:
+                jobs.extend(json.load(file_handle))
+        if not jobs:
+            parser.error('One of --files, --list-file or --manifest must be provided')
+
+        self.initialize_from_global_args(global_args)
+
+        return self.commands.protect_many(jobs,
+                                          signing_certificate=args.signing_certificate,
+                                          subscription_type=args.subscription_type,
+                                          mapping_file=args.mapping_file,
+                                          output_dir=args.output_dir,
+                                          workers=args.workers,
+                                          preflight=not args.no_preflight)
+
+    def jobs(self, global_args):
+        '''List or resume protection jobs'''
+        parser = argparse.ArgumentParser(
+            usage='aps jobs {list,resume} [<args>]',
+            description='''Protections performed by the protect command are recorded in a
+            local job store. The "list" action lists the recorded jobs. The "resume" action
+            resumes every unfinished job (e.g. after the protect command was interrupted)
+            from its last completed stage, without creating a new build or re-uploading
+            parts that were already uploaded. Jobs still run by another aps process are
+            not resumed. Finished jobs are deleted from the store after 30 days.''')
+
+        parser.add_argument('action', type=str, choices=['list', 'resume'], help='Action')
+        parser.add_argument('--unfinished',
+                            action='store_true',
+                            help='Only list the unfinished jobs which can be resumed')
+        parser.add_argument('--timeout', type=float, required=False,
+                            help='Time limit in seconds for each resumed job')
+
+        # inside subcommands ignore the first command_pos argv's
+        args = parser.parse_args(self.command_args())
+
+        self.initialize_from_global_args(global_args)
+        if args.action == 'resume':
+            return self.commands.resume_jobs(args.timeout)
+        return self.commands.list_jobs(args.unfinished)
 
     def get_account_info(self, global_args):
         '''Get info about the user and organization'''
@@ -199,11 +493,71 @@ class Aps:
             usage='aps get-account-info [<args>]',
             description='Returns information about the user and organization (customer)')
 
-        parser.parse_args(sys.argv[self.command_pos:])
+        parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args)
         return self.commands.get_account_info()
 
+    def get_statistics(self, global_args):
+        '''Get APS statistics'''
+        parser = argparse.ArgumentParser(
+            usage='aps get-statistics [<args>]',
+            description='''Returns APS statistics for a time range. With --cache, statistics
+            of past days are kept in a local store, so only the days not fetched before and
+            the current day are requested from APS.''')
+
+        parser.add_argument('--start', type=str, required=True,
+                            help='Start of the time range, e.g. 2024-01-31 or 2024-01-31T12:00')
+        parser.add_argument('--end', type=str, required=False,
+                            help='End of the time range. Defaults to now.')
+        parser.add_argument('--cache',
+                            action='store_true',
+                            help='''Request the statistics per day, keeping the days which
+                            ended in a local store. Counts are added up over the days;
+                            statistics which cannot be added up are requested for the
+                            whole time range.''')
+        # inside subcommands ignore the first command_pos argv's
+        args = parser.parse_args(self.command_args())
+
+        self.initialize_from_global_args(global_args)
+        return self.commands.get_statistics(args.start, args.end, cache=args.cache)
+
+    def report(self, global_args):
+        '''Analytics reports'''
+        parser = argparse.ArgumentParser(
+            usage='aps report builds [<args>]',
+            description='''Report on the build history. Per application and per OS the
+            number of protected and failed builds, the failure ratio and percentiles of
+            the time builds spent queued for protection and being protected (in seconds)
+            are reported, as well as the number of builds protected per day. The times
+            are read from the protectRequestTime, protectStartTime and protectEndTime
+            fields of the build records. Protected builds lacking some of them are
+            counted as missingTimings and left out of the time percentiles.''')
+
+        parser.add_argument('report', type=str, choices=['builds'], help='Report')
+        parser.add_argument('--application-id', type=str, required=False,
+                            help='Only report on the builds of this application')
+        parser.add_argument('--subscription-type', type=str, required=False,
+                            help='Subscription Type',
+                            choices=SUBSCRIPTION_TYPES)
+        parser.add_argument('--percentiles', type=str, required=False, default='50,90,99',
+                            help='Comma separated list of the percentiles to report')
+        parser.add_argument('--format', type=str, required=False, default='json',
+                            choices=['json', 'csv'], help='Output format')
+        # inside subcommands ignore the first command_pos argv's
+        args = parser.parse_args(self.command_args())
+        percentiles = [float(value) if '.' in value else int(value)
+                       for value in args.percentiles.split(',')]
+
+        self.initialize_from_global_args(global_args)
+        report = self.commands.report_builds(args.application_id, args.subscription_type,
+                                             percentiles)
+        if args.format == 'csv' and getattr(BATCH_COMMAND, 'args', None) is None:
+            from aps_report import write_report_csv # pylint: disable=import-outside-toplevel
+            write_report_csv(report)
+            return None
+        return report
+
     def add_application(self, global_args):
         '''Add a new application'''
         parser = argparse.ArgumentParser(
@@ -234,7 +588,7 @@ class Aps:
                             action='store_true', default=False)
 
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
         permissions = {}
         permissions['private'] = args.private
         permissions['no_upload'] = args.no_upload
@@ -273,7 +627,7 @@ class Aps:
                             action='store_true', default=False)
 
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
         permissions = {}
         permissions['private'] = args.private
         permissions['no_upload'] = args.no_upload
@@ -304,14 +658,21 @@ class Aps:
         parser.add_argument('--subscription-type', type=str, required=False,
                             help='Subscription Type',
                             choices=SUBSCRIPTION_TYPES)
+        add_output_arguments(parser)
 
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args)
-        return self.commands.list_applications(args.application_id,
-                                               args.group,
-                                               args.subscription_type)
+        if args.output == 'ndjson':
+            return output_listing(self.commands.iter_applications(args.application_id,
+                                                                  args.group,
+                                                                  args.subscription_type),
+                                  args)
+        return output_listing(self.commands.list_applications(args.application_id,
+                                                              args.group,
+                                                              args.subscription_type),
+                              args)
     def delete_application(self, global_args):
         '''Delete an application'''
         parser = argparse.ArgumentParser(
@@ -321,11 +682,46 @@ class Aps:
         parser.add_argument('--application-id', type=str, required=True, help='Application ID')
 
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args)
         return self.commands.delete_application(args.application_id)
 
+    def apply(self, global_args):
+        '''Bring applications to a desired state'''
+        parser = argparse.ArgumentParser(
+            usage='aps apply [<args>]',
+            description='''Add and update applications to match the desired state given in a
+            JSON or YAML file: name, package id, OS, group, permissions, signing certificate
+            and protection configuration of each application. Only the differences with the
+            current state are applied. Prints a summary of the changes.
+
+            Signing certificates and protection configurations are compared with the files
+            last applied from this host, which are recorded in the local cache folder. On
+            a host without that record (e.g. a fresh CI runner) they are set again.''')
+        parser.add_argument('--file', type=str, required=True,
+                            help='Desired state file (.json, or .yaml with PyYAML installed)')
+        parser.add_argument('--subscription-type', type=str, required=False,
+                            help='Subscription Type',
+                            choices=SUBSCRIPTION_TYPES)
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            help='Report the changes that would be made without making them')
+        parser.add_argument('--workers', type=int, required=False, default=4,
+                            help='Number of applications changed concurrently')
+        parser.add_argument('--rate', type=float, required=False, default=5,
+                            help='Maximum number of requests per second')
+
+        # inside subcommands ignore the first command_pos argv's
+        args = parser.parse_args(self.command_args())
+
+        self.initialize_from_global_args(global_args)
+        return self.commands.apply_applications(args.file,
+                                                workers=args.workers,
+                                                rate=args.rate,
+                                                dry_run=args.dry_run,
+                                                subscription_type=args.subscription_type)
+
     def list_builds(self, global_args):
         '''List builds'''
         parser = argparse.ArgumentParser(
@@ -347,12 +743,21 @@ class Aps:
         parser.add_argument('--subscription-type', type=str, required=False,
                             help='Subscription Type',
                             choices=SUBSCRIPTION_TYPES)
+        add_output_arguments(parser)
 
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args)
-        return self.commands.list_builds(args.application_id, args.build_id, args.subscription_type)
+        if args.output == 'ndjson':
+            return output_listing(self.commands.iter_builds(args.application_id,
+                                                            args.build_id,
+                                                            args.subscription_type),
+                                  args)
+        return output_listing(self.commands.list_builds(args.application_id,
+                                                        args.build_id,
+                                                        args.subscription_type),
+                              args)
 
     def add_build(self, global_args):
         '''Add a new build'''
@@ -366,11 +771,16 @@ class Aps:
         parser.add_argument('--subscription-type', type=str, required=False,
                             help='Subscription Type',
                             choices=SUBSCRIPTION_TYPES)
+        parser.add_argument('--no-preflight',
+                            action='store_true',
+                            help='Do not check the build file locally before uploading it')
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args)
-        return self.commands.add_build(args.file, application_id=args.application_id, subscription_type=args.subscription_type)
+        return self.commands.add_build(args.file, application_id=args.application_id,
+                                       subscription_type=args.subscription_type,
+                                       preflight=not args.no_preflight)
 
     def delete_build(self, global_args):
         '''Delete a build'''
@@ -380,11 +790,54 @@ class Aps:
         parser.add_argument('--build-id', type=str, required=True, help='Build ID')
 
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args)
         return self.commands.delete_build(args.build_id)
 
+    def prune_builds(self, global_args):
+        '''Delete many builds'''
+        parser = argparse.ArgumentParser(
+            usage='aps prune-builds [<args>]',
+            description='''Delete builds selected by age, state, application or a keep-last-N
+            policy, e.g. to free storage. At least one of --older-than, --state or --keep-last
+            must be given. Builds that are being protected are never deleted. Prints a summary
+            of the deleted builds and the storage reclaimed.''')
+
+        parser.add_argument('--application-id', type=str, required=False,
+                            help='Only consider builds of this application')
+        parser.add_argument('--older-than', type=float, required=False,
+                            help='Select builds older than this number of days')
+        parser.add_argument('--state', type=str, required=False, action='append',
+                            help='Select builds in this state. Can be given several times.')
+        parser.add_argument('--keep-last', type=int, required=False,
+                            help='Keep this number of most recent builds of each application')
+        parser.add_argument('--subscription-type', type=str, required=False,
+                            help='Subscription Type',
+                            choices=SUBSCRIPTION_TYPES)
+        parser.add_argument('--dry-run',
+                            action='store_true',
+                            help='Report the builds that would be deleted without deleting them')
+        parser.add_argument('--workers', type=int, required=False, default=4,
+                            help='Number of concurrent deletions')
+        parser.add_argument('--rate', type=float, required=False, default=5,
+                            help='Maximum number of deletions per second')
+
+        # inside subcommands ignore the first command_pos argv's
+        args = parser.parse_args(self.command_args())
+        if args.older_than is None and not args.state and args.keep_last is None:
+            parser.error('One of --older-than, --state or --keep-last must be provided')
+
+        self.initialize_from_global_args(global_args)
+        return self.commands.prune_builds(application_id=args.application_id,
+                                          older_than=args.older_than,
+                                          states=args.state,
+                                          keep_last=args.keep_last,
+                                          dry_run=args.dry_run,
+                                          workers=args.workers,
+                                          rate=args.rate,
+                                          subscription_type=args.subscription_type)
+
     def protect_start(self, global_args):
         '''Start build protection'''
         parser = argparse.ArgumentParser(
@@ -393,7 +846,7 @@ class Aps:
 
         parser.add_argument('--build-id', type=str, required=True, help='Build ID')
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args)
         return self.commands.protect_start(args.build_id)
@@ -406,7 +859,7 @@ class Aps:
 
         parser.add_argument('--build-id', type=str, required=True, help='Build ID')
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args)
         return self.commands.protect_cancel(args.build_id)
@@ -420,7 +873,7 @@ class Aps:
 
         parser.add_argument('--build-id', type=str, required=True, help='Build ID')
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args)
         return self.commands.protect_get_status(args.build_id)
@@ -433,7 +886,7 @@ class Aps:
 
         parser.add_argument('--build-id', type=str, required=True, help='Build ID')
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args)
         return self.commands.protect_download(args.build_id)
@@ -449,7 +902,7 @@ class Aps:
         parser.add_argument('--file', type=str, required=True,
                             help='Input file (apk or xcarchive folder)')
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args)
         return self.commands.display_application_package_id(args.file)
@@ -464,7 +917,7 @@ class Aps:
             help='PEM encoded certificate file. If omitted, this unsets the current certificate')
 
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args)
         return self.commands.set_signing_certificate(args.application_id, args.file)
@@ -477,12 +930,18 @@ class Aps:
         parser.add_argument('--build-id', type=str, required=True, help='Build ID')
         parser.add_argument('--file', type=str, required=True,
             help='R8/Proguard mapping file for android')
+        parser.add_argument('--compress',
+                            action='store_true',
+                            help='''Upload the mapping file gzip compressed, as <name>.gz. It is
+                            compressed on the fly, no compressed copy is written. Only use this
+                            with an APS backend accepting gzip compressed mapping files.''')
 
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args)
-        return self.commands.set_mapping_file(args.build_id, args.file)
+        return self.commands.set_mapping_file(args.build_id, args.file,
+                                              compress=args.compress or None)
 
     def get_sail_config(self, global_args):
         '''Get SAIL configuration'''
@@ -494,11 +953,31 @@ class Aps:
                             choices=['ios', 'android'])
         parser.add_argument('--version', type=str, required=False, help='Version')
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args, scope='sail-config')
         return self.commands.get_sail_config(args.os, args.version)
 
+    def validate(self, global_args):
+        '''Check a build file locally, without sending anything to APS'''
+        parser = argparse.ArgumentParser(
+            usage='aps validate [<args>]',
+            description='''Check a build file for problems APS would reject it for, e.g. a
+            debuggable application, a missing INTERNET permission or minimum SDK version,
+            an invalid file name or a corrupt archive. The same checks are done by the
+            protect and add-build commands before anything is uploaded. No credentials are
+            needed.''')
+
+        parser.add_argument('--file', type=str, required=True,
+                            help='Build file (aab, apk, xcarchive folder or zipped xcarchive folder)')
+        # inside subcommands ignore the first command_pos argv's
+        args = parser.parse_args(self.command_args())
+
+        if global_args.logging:
+            install_logging(global_args.logging)
+        from aps_preflight import validate_build # pylint: disable=import-outside-toplevel
+        return validate_build(args.file)
+
     def get_version(self, global_args):
         '''Get Version'''
         parser = argparse.ArgumentParser(
@@ -506,11 +985,114 @@ class Aps:
             description='Get version.')
 
         # inside subcommands ignore the first command_pos argv's
-        args = parser.parse_args(sys.argv[self.command_pos:])
+        args = parser.parse_args(self.command_args())
 
         self.initialize_from_global_args(global_args)
         return self.commands.get_version()
 
+    def batch(self, global_args):
+        '''Run many commands in one process'''
+        parser = argparse.ArgumentParser(
+            usage='aps batch [<args>]',
+            description='''Run many commands in one process, sharing one authenticated
+            session per authentication scope. Commands are read as JSON lines, each an object with a "command"
+            property (e.g. "list-builds"), an "args" property holding either the list of
+            command arguments or an object mapping argument names to values (true for
+            flags), and an optional "id" property. One JSON line is written per command
+            with its id (by default its line number) and either its "result" or an
+            "error".''')
+
+        parser.add_argument('--file', type=str, required=False,
+                            help='File to read the commands from. Defaults to stdin.')
+        parser.add_argument('--jobs', type=int, required=False, default=1,
+                            help='Number of commands to run at the same time')
+        parser.add_argument('--unordered',
+                            action='store_true',
+                            help='''Write the result of each command as soon as it completes,
+                            instead of in input order''')
+
+        # inside subcommands ignore the first command_pos argv's
+        args = parser.parse_args(self.command_args())
+        jobs = max(1, args.jobs)
+
+        self.initialize_from_global_args(global_args)
+        self.shared_commands = {'aps': self.commands}
+
+        def write(result):
+            sys.stdout.write(json.dumps(result, sort_keys=True) + '\n')
+            sys.stdout.flush()
+
+        input_file = open(args.file, 'r') if args.file else sys.stdin
+        try:
+            # At most jobs commands are in flight, so the input can be streamed
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                pending = set() if args.unordered else deque()
+                for line_number, line in enumerate(input_file, 1):
+                    if not line.strip():
+                        continue
+                    future = executor.submit(self.run_batch_command, global_args,
+                                             line, line_number)
+                    if args.unordered:
+                        pending.add(future)
+                        if len(pending) >= jobs:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            for done_future in done:
+                                write(done_future.result())
+                    else:
+                        pending.append(future)
+                        if len(pending) >= jobs:
+                            write(pending.popleft().result())
+                for future in pending:
+                    write(future.result())
+        finally:
+            if args.file:
+                input_file.close()
+
+    def run_batch_command(self, global_args, line, line_number):
+        '''Run a command of a batch. Returns its result line.'''
+        result = {'id': line_number}
+        try:
+            request = json.loads(line)
+            result['id'] = request.get('id', line_number)
+            command = request['command']
+            result['command'] = command
+            if command not in supported_commands() or command in NON_BATCH_COMMANDS:
+                raise ValueError(f'Unsupported command {command}')
+
+            command_args = request.get('args', [])
+            if isinstance(command_args, dict):
+                command_args = batch_arguments(command_args)
+            BATCH_COMMAND.args = [str(arg) for arg in command_args]
+            result['result'] = getattr(self, command.replace('-', '_'))(global_args)
+        except SystemExit:
+            # argparse exits on invalid arguments, after printing the usage to stderr
+            result['error'] = 'Invalid arguments'
+        except Exception as e: # pylint: disable=broad-except
+            LOGGER.debug(traceback.format_exc())
+            result['error'] = str(e)
+        finally:
+            BATCH_COMMAND.args = BATCH_COMMAND.commands = None
+        return result
+
+    def serve(self, global_args):
+        '''Run the APS daemon'''
+        parser = argparse.ArgumentParser(
+            usage='aps serve [<args>]',
+            description='''Run a long lived daemon keeping an authenticated session, connection
+            pool and caches warm. While it runs, the protect, protect-get-status,
+            protect-download, list-applications and list-builds commands invoked with the same
+            credentials are forwarded to the daemon over a local Unix socket (see the
+            --daemon-socket and --no-daemon global options). The messages logged by a
+            forwarded command are sent back and logged by the client.''')
+
+        # inside subcommands ignore the first command_pos argv's
+        parser.parse_args(self.command_args())
+
+        self.initialize_from_global_args(global_args)
+        ApsDaemon(get_socket_path(global_args),
+                  get_identity(global_args),
+                  self.commands).serve()
+
 
 if __name__ == '__main__':
     Aps()
@@ -0,0 +1,120 @@
+'''Declarative management of applications.
+
+A desired state file (JSON, or YAML when PyYAML is installed) lists applications:
+
+    applications:
+      - packageId: com.example.app
+        os: android
+        name: Example            # default: the package id
+        group: team-a            # only used when the application is added
+        private: false
+        noUpload: false
+        noDelete: false
+        signingCertificate: certs/example.pem       # relative to the file
+        protectionConfiguration: config/example.json
+
+The desired state is compared with the current applications and with the settings
+applied before, giving the minimal list of actions for each application.
+
+APS does not return the protection configuration nor the signing certificate of an
+application. The digests of the settings files applied are therefore recorded locally (in the applied-*.json file of
+the cache folder). On a host without that record, e.g. a fresh CI runner, these
+settings are set again once, after which they are recorded there too.'''
+import hashlib
+import json
+import os
+
+from aps_exceptions import ApsException
+from aps_utils import certificate_fingerprint, get_permission_fields, LOGGER
+
+APPLICATION_OS = ['android', 'ios']
+
+# Settings given as files. The digest of the file last applied is remembered locally,
+# since APS does not return the settings themselves.
+FILE_SETTINGS = ['signingCertificate', 'protectionConfiguration']
+
+
+def load_desired_state(path):
+    '''Load the list of desired applications from a JSON or YAML file'''
+    with open(path, 'r') as file_handle:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml # pylint: disable=import-outside-toplevel
+            except ImportError as e:
+                raise ApsException('Reading YAML files requires the PyYAML package, '
+                                   'use a JSON file instead') from e
+            data = yaml.safe_load(file_handle)
+        else:
+            data = json.load(file_handle)
+
+    applications = data.get('applications') if isinstance(data, dict) else data
+    if not isinstance(applications, list):
+        raise ApsException(f'{path} does not contain a list of applications')
+    base_dir = os.path.dirname(os.path.abspath(path))
+    return [normalize_application(application, base_dir) for application in applications]
+
+def normalize_application(application, base_dir):
+    '''Validate a desired application and fill in its defaults. Paths are made relative
+    to base_dir.'''
+    if not isinstance(application, dict) or not application.get('packageId') or \
+       application.get('os') not in APPLICATION_OS:
+        raise ApsException(f'Invalid application {application}: a packageId and an os '
+                           f'({", ".join(APPLICATION_OS)}) are required')
+    desired = {
+        'packageId': application['packageId'],
+        'os': application['os'],
+        'name': application.get('name') or application['packageId'],
+        'group': application.get('group'),
+        'permissions': {
+            'private': bool(application.get('private')),
+            'no_upload': bool(application.get('noUpload')),
+            'no_delete': bool(application.get('noDelete')),
+        },
+    }
+    for setting in FILE_SETTINGS:
+        path = application.get(setting)
+        desired[setting] = os.path.join(base_dir, path) if path else None
+    return desired
+
+def index_applications(applications):
+    '''Returns the application records keyed by (package id, os). When several
+    applications share a package id the first one is used, like protect does.'''
+    index = {}
+    for application in applications:
+        key = (application['applicationPackageId'], application['os'])
+        if key in index:
+            LOGGER.warning(f'Several {key[1]} applications have package id {key[0]}, '
+                           f'using {index[key]["id"]} and ignoring {application["id"]}')
+            continue
+        index[key] = application
+    return index
+
+def setting_digest(setting, path):
+    '''Returns the digest of a settings file: the certificate fingerprint for a signing
+    certificate, otherwise the SHA-256 digest of the file'''
+    if setting == 'signingCertificate':
+        return certificate_fingerprint(path)
+    with open(path, 'rb') as file_handle:
+        return hashlib.sha256(file_handle.read()).hexdigest()
+
+def diff_application(desired, current, applied):
+    '''Returns the actions needed to bring an application to its desired state: 'add',
+    'update' and the FILE_SETTINGS to set. current is the application record (None if
+    there is none), applied the digests of the settings files last applied to it.'''
+    actions = []
+    if current is None:
+        actions.append('add')
+    else:
+        expected = {'applicationName': desired['name'],
+                    **get_permission_fields(desired['permissions'])}
+        if any(current.get(field) != value for field, value in expected.items()):
+            actions.append('update')
+        if desired['group'] and current.get('group') != desired['group']:
+            LOGGER.warning(f'The group of application {current["id"]} cannot be changed '
+                           f'to {desired["group"]}')
+    for setting in FILE_SETTINGS:
+        if not desired[setting]:
+            continue
+        if applied.get(setting) != setting_digest(setting, desired[setting]):
+            actions.append(setting)
+    return actions
@@ -0,0 +1,160 @@
+'''Reader for the binary XML (AXML) AndroidManifest.xml found in APK files.
+
+Only the manifest properties needed by APS are read, in a single pass over the
+binary XML chunks.'''
+import struct
+
+from aps_exceptions import ApsException
+
+RES_STRING_POOL_TYPE = 0x0001
+RES_XML_TYPE = 0x0003
+RES_XML_START_ELEMENT_TYPE = 0x0102
+RES_XML_END_ELEMENT_TYPE = 0x0103
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+
+UTF8_FLAG = 0x100
+NO_INDEX = 0xFFFFFFFF
+
+TYPE_REFERENCE = 0x01
+TYPE_STRING = 0x03
+TYPE_INT_DEC = 0x10
+TYPE_INT_HEX = 0x11
+TYPE_INT_BOOLEAN = 0x12
+
+# Resource ids of the android: attributes we read. Attribute names may be stripped or
+# obfuscated in the string pool, but the resource ids are stable.
+ANDROID_ATTRIBUTES = {
+    0x01010003: 'name',
+    0x0101000f: 'debuggable',
+    0x0101020c: 'minSdkVersion',
+    0x0101021b: 'versionCode',
+    0x0101021c: 'versionName',
+    0x01010270: 'targetSdkVersion',
+}
+
+
+def read_length(data, offset, utf8):
+    '''Read a string length from the string pool, returns (length, new offset)'''
+    if utf8:
+        length = data[offset]
+        offset += 1
+        if length & 0x80:
+            length = ((length & 0x7f) << 8) | data[offset]
+            offset += 1
+        return length, offset
+    length = struct.unpack_from('<H', data, offset)[0]
+    offset += 2
+    if length & 0x8000:
+        length = ((length & 0x7fff) << 16) | struct.unpack_from('<H', data, offset)[0]
+        offset += 2
+    return length, offset
+
+def read_string_pool(data, start, header_size):
+    '''Read all strings of a string pool chunk'''
+    count, _, flags, strings_start = struct.unpack_from('<IIII', data, start + 8)
+    utf8 = bool(flags & UTF8_FLAG)
+    offsets = struct.unpack_from(f'<{count}I', data, start + header_size)
+    strings = []
+    for offset in offsets:
+        offset += start + strings_start
+        if utf8:
+            # The UTF-16 length comes first, followed by the UTF-8 length in bytes
+            _, offset = read_length(data, offset, True)
+            length, offset = read_length(data, offset, True)
+            strings.append(data[offset:offset + length].decode('utf-8', errors='replace'))
+        else:
+            length, offset = read_length(data, offset, False)
+            strings.append(data[offset:offset + 2 * length].decode('utf-16-le',
+                                                                   errors='replace'))
+    return strings
+
+def parse_manifest(data):
+    '''Parse a binary AndroidManifest.xml. Returns a dict with the package,
+    versionCode, versionName, minSdkVersion, targetSdkVersion, debuggable and
+    permissions properties of the manifest. Properties absent from the manifest are
+    None (debuggable is False and permissions is empty).'''
+    manifest = {
+        'package': None,
+        'versionCode': None,
+        'versionName': None,
+        'minSdkVersion': None,
+        'targetSdkVersion': None,
+        'debuggable': False,
+        'permissions': [],
+    }
+    try:
+        chunk_type, header_size, size = struct.unpack_from('<HHI', data, 0)
+        if chunk_type != RES_XML_TYPE:
+            raise ApsException('AndroidManifest.xml is not in binary XML format')
+        if size > len(data):
+            raise ApsException('AndroidManifest.xml is truncated')
+
+        strings = []
+        resource_ids = []
+        elements = []
+        offset = header_size
+        while offset + 8 <= size:
+            chunk_type, header_size, chunk_size = struct.unpack_from('<HHI', data, offset)
+            if chunk_size < 8 or offset + chunk_size > size:
+                raise ApsException('Invalid chunk size in AndroidManifest.xml')
+
+            if chunk_type == RES_STRING_POOL_TYPE:
+                strings = read_string_pool(data, offset, header_size)
+            elif chunk_type == RES_XML_RESOURCE_MAP_TYPE:
+                count = (chunk_size - header_size) // 4
+                resource_ids = struct.unpack_from(f'<{count}I', data, offset + header_size)
+            elif chunk_type == RES_XML_START_ELEMENT_TYPE:
+                element, attributes = read_element(data, offset + header_size,
+                                                   strings, resource_ids)
+                elements.append(element)
+                apply_element(manifest, elements, attributes)
+            elif chunk_type == RES_XML_END_ELEMENT_TYPE and elements:
+                elements.pop()
+            offset += chunk_size
+    except (struct.error, IndexError) as e:
+        raise ApsException(f'Failed to parse AndroidManifest.xml: {e}') from e
+    return manifest
+
+def read_element(data, offset, strings, resource_ids):
+    '''Read a start element. Returns its name and a dict of its attributes.'''
+    _, name, attribute_start, attribute_size, attribute_count = \
+        struct.unpack_from('<IIHHH', data, offset)
+    attributes = {}
+    offset += attribute_start
+    for _ in range(attribute_count):
+        _, attribute_name, raw_value, _, _, data_type, value = \
+            struct.unpack_from('<IIIHBBI', data, offset)
+        offset += attribute_size
+
+        if attribute_name < len(resource_ids) and resource_ids[attribute_name] in ANDROID_ATTRIBUTES:
+            attribute_name = ANDROID_ATTRIBUTES[resource_ids[attribute_name]]
+        else:
+            attribute_name = strings[attribute_name]
+
+        if data_type == TYPE_STRING or (raw_value != NO_INDEX and data_type != TYPE_INT_BOOLEAN):
+            index = raw_value if raw_value != NO_INDEX else value
+            attributes[attribute_name] = strings[index]
+        elif data_type in [TYPE_INT_DEC, TYPE_INT_HEX]:
+            attributes[attribute_name] = struct.unpack('<i', struct.pack('<I', value))[0]
+        elif data_type == TYPE_INT_BOOLEAN:
+            attributes[attribute_name] = value != 0
+        elif data_type == TYPE_REFERENCE:
+            attributes[attribute_name] = f'@{value:08x}'
+        else:
+            attributes[attribute_name] = value
+    return strings[name], attributes
+
+def apply_element(manifest, elements, attributes):
+    '''Take the properties we are interested in from an element'''
+    if elements == ['manifest']:
+        manifest['package'] = attributes.get('package')
+        manifest['versionCode'] = attributes.get('versionCode')
+        manifest['versionName'] = attributes.get('versionName')
+    elif elements == ['manifest', 'uses-sdk']:
+        manifest['minSdkVersion'] = attributes.get('minSdkVersion')
+        manifest['targetSdkVersion'] = attributes.get('targetSdkVersion')
+    elif elements == ['manifest', 'application']:
+        manifest['debuggable'] = attributes.get('debuggable') is True
+    elif elements in [['manifest', 'uses-permission'], ['manifest', 'uses-permission-sdk-23']]:
+        if attributes.get('name'):
+            manifest['permissions'].append(attributes['name'])
@@ -0,0 +1,312 @@
+'''Local caches of APS data'''
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from aps_exceptions import ApsException
+from aps_utils import (
+    get_cache_dir, get_os, extract_version_info, get_package_id, LOGGER)
+
+# Applications rarely move, so index entries are trusted for a day. A hit is always
+# verified with a cheap request for the single application anyway.
+APPLICATION_INDEX_TTL = 24 * 3600
+
+# Bytes read from the start and the end of a file for its fingerprint
+FINGERPRINT_SAMPLE_SIZE = 1024 * 1024
+
+# Maximum total size in bytes of the cached HTTP responses
+HTTP_CACHE_SIZE = 16 * 1024 * 1024
+
+# Maximum number of build files whose metadata is cached
+METADATA_CACHE_ENTRIES = 256
+
+
+def cache_key(*parts):
+    '''Returns a short stable hash of the parts, suitable as a cache file name'''
+    return hashlib.sha256(json.dumps(parts).encode('utf-8')).hexdigest()[:32]
+
+def read_json_file(path, default=None):
+    '''Read a JSON cache file, returning default if it is missing or corrupt'''
+    try:
+        with open(path, 'r') as file_handle:
+            return json.load(file_handle)
+    except (OSError, ValueError):
+        return default
+
+def write_json_file(path, data):
+    '''Atomically write a JSON cache file, so concurrent readers never see a partial file.
+    Failing to write it is not an error, the cache is then only kept in memory.'''
+    tmp_path = None
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as file_handle:
+            json.dump(data, file_handle)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        LOGGER.debug(f'Failed to write cache file {path}: {e}')
+        if tmp_path:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+def touch_file(path):
+    '''Record the use of a cache entry file: the modification time of an entry file is
+    the time it was last used'''
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def evict_files(path, max_size=None, max_entries=None):
+    '''Remove the least recently used entry files of a cache folder until their total
+    size is at most max_size bytes and their number at most max_entries'''
+    files = []
+    for name in os.listdir(path):
+        if name.endswith('.json'):
+            try:
+                stat = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in files)
+    count = len(files)
+    for _, size, name in sorted(files):
+        if (max_size is None or total <= max_size) and \
+           (max_entries is None or count <= max_entries):
+            break
+        try:
+            os.remove(os.path.join(path, name))
+        except OSError:
+            pass
+        total -= size
+        count -= 1
+
+def file_fingerprint(path):
+    '''Returns a fingerprint of a file: its path, size, modification time and a fast
+    hash of its first and last megabyte. Reading the whole file is not needed.
+    For a folder the size and time are the total size and latest modification of its
+    content, and the hash covers the names, sizes and times of the files in it.'''
+    if os.path.isdir(path):
+        return folder_fingerprint(path)
+
+    stat = os.stat(path)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as file_handle:
+        digest.update(file_handle.read(FINGERPRINT_SAMPLE_SIZE))
+        if stat.st_size > FINGERPRINT_SAMPLE_SIZE:
+            file_handle.seek(max(FINGERPRINT_SAMPLE_SIZE,
+                                 stat.st_size - FINGERPRINT_SAMPLE_SIZE))
+            digest.update(file_handle.read(FINGERPRINT_SAMPLE_SIZE))
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+
+def folder_fingerprint(path):
+    '''Returns the fingerprint of a folder, see file_fingerprint'''
+    digest = hashlib.blake2b(digest_size=16)
+    size = mtime = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for name in sorted(filenames):
+            full_path = os.path.join(dirpath, name)
+            stat = os.lstat(full_path)
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime_ns)
+            digest.update(json.dumps([os.path.relpath(full_path, path), stat.st_size,
+                                      stat.st_mtime_ns]).encode('utf-8'))
+    return [os.path.abspath(path), size, mtime, digest.hexdigest()]
+
+
+class ApplicationIndex:
+    '''Persistent index mapping (applicationPackageId, os, subscriptionType) to the id of
+    the matching application. The subscriptionType is the one used for the lookup, None
+    meaning no subscription type filter.'''
+
+    def __init__(self, scope, ttl=APPLICATION_INDEX_TTL):
+        '''scope identifies the account (e.g. API gateway URL and API key id), so that
+        different accounts use different indexes'''
+        self.ttl = ttl
+        self.path = os.path.join(get_cache_dir(), f'applications-{cache_key(scope)}.json')
+        self.lock = threading.Lock()
+        self.entries = read_json_file(self.path, {})
+
+    @staticmethod
+    def key(package_id, os_type, subscription_type):
+        '''Index key for a lookup'''
+        return json.dumps([package_id, os_type, subscription_type])
+
+    def get(self, package_id, os_type, subscription_type=None):
+        '''Returns the indexed application id, or None if unknown or expired'''
+        with self.lock:
+            entry = self.entries.get(self.key(package_id, os_type, subscription_type))
+        if entry and time.time() - entry['time'] < self.ttl:
+            return entry['id']
+        return None
+
+    def put(self, application, subscription_type=None):
+        '''Add an application record to the index'''
+        self.update([application], subscription_type)
+
+    def update(self, applications, subscription_type=None):
+        '''Add application records (e.g. from a full listing) to the index'''
+        now = time.time()
+        seen = set()
+        with self.lock:
+            for application in applications:
+                key = self.key(application['applicationPackageId'], application['os'],
+                               subscription_type)
+                # Keep the first match, which is the one a linear search would find
+                if key not in seen:
+                    seen.add(key)
+                    self.entries[key] = {'id': application['id'], 'time': now}
+            write_json_file(self.path, self.entries)
+
+    def invalidate(self, application_id=None, package_id=None, os_type=None):
+        '''Remove the entries for an application id or for a package id and OS'''
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                entry_package_id, entry_os, _ = json.loads(key)
+                if entry['id'] == application_id or \
+                   (entry_package_id, entry_os) == (package_id, os_type):
+                    del self.entries[key]
+            write_json_file(self.path, self.entries)
+
+
+class AppliedSettings:
+    '''Persistent record of the settings files (signing certificate, protection
+    configuration) applied to each application, as digests of their content. APS does not
+    return these settings, so this is used to skip setting them again unchanged.'''
+
+    def __init__(self, scope):
+        '''scope identifies the account, see ApplicationIndex'''
+        self.path = os.path.join(get_cache_dir(), f'applied-{cache_key(scope)}.json')
+        self.lock = threading.Lock()
+        self.entries = read_json_file(self.path, {})
+
+    def get(self, application_id):
+        '''Returns the digests of the settings applied to an application, by setting'''
+        with self.lock:
+            return dict(self.entries.get(application_id, {}))
+
+    def put(self, application_id, setting, digest):
+        '''Record the digest of a settings file applied to an application'''
+        with self.lock:
+            self.entries.setdefault(application_id, {})[setting] = digest
+            write_json_file(self.path, self.entries)
+
+
+class BuildMetadataCache:
+    '''Persistent cache of the metadata extracted from build files: the version info
+    sent as build metadata, the application package id and the OS. Entries are keyed by
+    file path and only used while the file's fingerprint is unchanged, so a modified
+    file is inspected again. At most max_entries files are cached, the least recently
+    used entries are evicted.'''
+
+    def __init__(self, path=None, max_entries=METADATA_CACHE_ENTRIES):
+        self.path = path or os.path.join(get_cache_dir(), 'metadata')
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        try:
+            os.makedirs(self.path, exist_ok=True)
+        except OSError as e:
+            LOGGER.debug(f'Build metadata cache disabled: {e}')
+
+    def get(self, file):
+        '''Returns a dict with the versionInfo, packageId and os of a build file,
+        inspecting the file only if it is not cached yet. The packageId is None when it
+        cannot be parsed, such metadata is not cached.'''
+        fingerprint = file_fingerprint(file)
+        entry_path = os.path.join(self.path, f'{cache_key(fingerprint[0])}.json')
+        entry = read_json_file(entry_path)
+        if entry and entry.get('fingerprint') == fingerprint:
+            LOGGER.debug(f'Using cached metadata of {file}')
+            touch_file(entry_path)
+            return entry['metadata']
+
+        version_info = extract_version_info(file)
+        metadata = {
+            'versionInfo': version_info,
+            'packageId': None,
+            'os': get_os(file),
+        }
+        try:
+            metadata['packageId'] = get_package_id(version_info)
+        except ApsException as e:
+            LOGGER.warning(f'Failed to parse the package id of {file}: {e}')
+            return metadata
+        write_json_file(entry_path, {'fingerprint': fingerprint, 'metadata': metadata})
+        with self.lock:
+            try:
+                evict_files(self.path, max_entries=self.max_entries)
+            except OSError as e:
+                LOGGER.debug(f'Failed to evict build metadata cache entries: {e}')
+        return metadata
+
+
+class StatisticsStore:
+    '''Persistent store of the statistics of closed time buckets. Statistics of a bucket
+    which ended are not expected to change any more, so they are kept forever.'''
+
+    def __init__(self, scope, bucket_size):
+        '''scope identifies the account, bucket_size is the bucket length in seconds'''
+        self.path = os.path.join(get_cache_dir(),
+                                 f'statistics-{cache_key(scope, bucket_size)}.json')
+        self.lock = threading.Lock()
+        self.buckets = read_json_file(self.path, {})
+
+    @staticmethod
+    def key(start):
+        '''Store key of the bucket starting at a datetime'''
+        return start.isoformat()
+
+    def get(self, start):
+        '''Returns the statistics of the bucket starting at a datetime, or None'''
+        with self.lock:
+            return self.buckets.get(self.key(start))
+
+    def put(self, statistics):
+        '''Store the statistics of closed buckets, given as a dict keyed by bucket start'''
+        with self.lock:
+            for bucket_start, bucket_statistics in statistics.items():
+                self.buckets[self.key(bucket_start)] = bucket_statistics
+            write_json_file(self.path, self.buckets)
+
+
+class HttpCache:
+    '''Persistent cache of HTTP responses, see ApsRequest.cached_get. Entries are stored
+    one per file, and the least recently used entries are evicted when their total size
+    exceeds max_size. Raises an OSError when the cache folder cannot be created.'''
+
+    def __init__(self, path=None, max_size=HTTP_CACHE_SIZE):
+        self.path = path or os.path.join(get_cache_dir(), 'http')
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def entry_path(self, key):
+        '''Path of the file of an entry'''
+        return os.path.join(self.path, f'{cache_key(key)}.json')
+
+    def get(self, key):
+        '''Returns the entry stored for a key, or None'''
+        path = self.entry_path(key)
+        entry = read_json_file(path)
+        if not entry or entry.get('key') != key:
+            return None
+        touch_file(path)
+        return entry
+
+    def put(self, key, entry):
+        '''Store an entry, evicting the least recently used entries if needed'''
+        write_json_file(self.entry_path(key), {**entry, 'key': key})
+        self.evict()
+
+    def evict(self):
+        '''Remove the least recently used entries until the cache fits in max_size'''
+        with self.lock:
+            try:
+                evict_files(self.path, max_size=self.max_size)
+            except OSError as e:
+                LOGGER.debug(f'Failed to evict HTTP cache entries: {e}')
@@ -0,0 +1,250 @@
+'''Long lived APS daemon serving commands over a local Unix socket.
+
+The daemon keeps an authenticated ApsApi (and with it the connection pool and local
+caches) warm between commands. The aps command line tool forwards commands to the
+daemon when one is running for the same credentials.'''
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+
+from aps_exceptions import ApsErrorResponseException, ApsException
+from aps_utils import get_cache_dir, LOGGER
+
+# ApsApi methods which can be run by the daemon
+DAEMON_METHODS = ['protect',
+                  'protect_get_status',
+                  'protect_download',
+                  'list_applications',
+                  'list_builds']
+
+# Generator methods of ApsApi, which the daemon serves through the corresponding
+# listing method
+ITERATOR_METHODS = {'iter_applications': 'list_applications',
+                    'iter_builds': 'list_builds'}
+
+# Arguments naming local files, as (position, keyword) pairs, which are made absolute
+# before forwarding since the daemon does not share the working directory of the client
+PATH_ARGUMENTS = {
+    'protect': [(0, 'file'), (2, 'signing_certificate'), (3, 'mapping_file'),
+                (4, 'output_dir'), (7, 'timing_report'), (8, 'metrics_file')],
+    'protect_download': [(1, 'output_dir')],
+}
+
+# Response stream of the request run by the current thread. Tasks run by the request
+# on worker threads run in a copy of its context, so their log records are streamed too.
+RESPONSE_STREAM = contextvars.ContextVar('aps_daemon_response_stream', default=None)
+
+
+def get_socket_path(args):
+    '''Returns the path of the daemon socket'''
+    return args.daemon_socket or os.path.join(get_cache_dir(), 'aps.sock')
+
+def get_identity(args):
+    '''Returns a digest of the credentials and endpoints in the global arguments. The
+    daemon only serves clients presenting the same identity.'''
+    identity = [args.client_id, args.client_secret, args.platform, args.rest_api_id,
+                args.api_gateway_url, args.access_token_url]
+    return hashlib.sha256(json.dumps(identity).encode('utf-8')).hexdigest()
+
+def send_request(socket_path, request):
+    '''Send a single request to the daemon and return its response.
+
+    The daemon answers with newline delimited JSON messages: a log message for each
+    record logged while running the request, which is logged again here so the output
+    is the same as when running locally, followed by the response message.'''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile('rwb') as stream:
+            stream.write(json.dumps(request).encode('utf-8') + b'\n')
+            stream.flush()
+            for line in stream:
+                message = json.loads(line)
+                if 'log' not in message:
+                    return message
+                LOGGER.log(message['log']['level'], message['log']['message'])
+    raise ApsException('APS daemon closed the connection')
+
+
+class ApsDaemonClient:
+    '''Stands in for ApsApi, forwarding the supported methods to a running daemon'''
+
+    def __init__(self, socket_path, identity):
+        self.socket_path = socket_path
+        self.identity = identity
+
+    def is_available(self):
+        '''Is a daemon running for our identity'''
+        if not hasattr(socket, 'AF_UNIX') or not os.path.exists(self.socket_path):
+            return False
+        try:
+            return send_request(self.socket_path, self.request('ping')).get('result') is True
+        except (OSError, ValueError):
+            return False
+
+    def request(self, method, args=(), kwargs=None):
+        '''Construct a request'''
+        return {'identity': self.identity, 'method': method,
+                'args': list(args), 'kwargs': kwargs or {}}
+
+    def __getattr__(self, method):
+        if method in ITERATOR_METHODS:
+            listing = getattr(self, ITERATOR_METHODS[method])
+
+            def iterate(*args, **kwargs):
+                records = listing(*args, **kwargs)
+                if not isinstance(records, list):
+                    if 'errorMessage' in records:
+                        raise ApsErrorResponseException(records)
+                    records = [records]
+                return iter(records)
+            return iterate
+
+        if method not in DAEMON_METHODS:
+            raise AttributeError(method)
+
+        def forward(*args, **kwargs):
+            args = list(args)
+            for position, name in PATH_ARGUMENTS.get(method, []):
+                value = args[position] if position < len(args) else kwargs.get(name)
+                # Output is written to the client's directory by default
+                if name == 'output_dir':
+                    value = value or os.getcwd()
+                if not value:
+                    continue
+                if position < len(args):
+                    args[position] = os.path.abspath(value)
+                else:
+                    kwargs[name] = os.path.abspath(value)
+
+            LOGGER.debug(f'Forwarding {method} to APS daemon at {self.socket_path}')
+            response = send_request(self.socket_path, self.request(method, args, kwargs))
+            if 'error' in response:
+                raise ApsException(f'APS daemon failed to run {method}: {response["error"]}')
+            return response['result']
+        return forward
+
+
+class ResponseStream:
+    '''Writes the messages of the response to a request. Messages may be written by
+    several threads, e.g. log records of tasks run concurrently.'''
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def write(self, message):
+        '''Write a message, unless the client has gone away'''
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            except OSError:
+                # The request keeps running, e.g. a protection is completed and
+                # recorded in the job store, without reporting back
+                self.closed = True
+
+
+class StreamLogHandler(logging.Handler):
+    '''Writes the records logged while running a request to its response stream'''
+
+    def emit(self, record):
+        stream = RESPONSE_STREAM.get()
+        if stream is None:
+            return
+        try:
+            message = self.format(record)
+        except Exception: # pylint: disable=broad-except
+            self.handleError(record)
+            return
+        stream.write({'log': {'level': record.levelno, 'message': message}})
+
+
+class ApsDaemonHandler(socketserver.StreamRequestHandler):
+    '''Handles a single request to the daemon'''
+
+    def handle(self):
+        line = self.rfile.readline()
+        # A connection without a request just probes whether the daemon is running
+        if not line:
+            return
+        stream = ResponseStream(self.wfile)
+        try:
+            request = json.loads(line)
+            response = self.server.run(request, stream)
+        except Exception as e:
+            LOGGER.error(f'APS daemon request failed: {e}')
+            response = {'error': str(e)}
+        stream.write(response)
+
+
+class ApsDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''Serves ApsApi commands over a Unix socket. Each request is handled in its own
+    thread, so several protections can run at the same time.'''
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, identity, commands):
+        self.identity = identity
+        self.commands = commands
+
+        # Refuse to start if another daemon is listening, otherwise remove a stale socket
+        if os.path.exists(socket_path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(socket_path)
+                    raise ApsException(f'An APS daemon is already running at {socket_path}')
+                except OSError:
+                    pass
+            os.remove(socket_path)
+
+        self.log_handler = StreamLogHandler()
+        LOGGER.addHandler(self.log_handler)
+
+        # The daemon acts with our credentials, so only let the current user connect
+        umask = os.umask(0o177)
+        try:
+            super().__init__(socket_path, ApsDaemonHandler)
+        finally:
+            os.umask(umask)
+
+    def run(self, request, stream):
+        '''Run a request, returning the response. The records logged while running it
+        are written to the response stream.'''
+        if request.get('identity') != self.identity:
+            return {'error': 'credentials do not match those of the APS daemon'}
+        method = request.get('method')
+        if method == 'ping':
+            return {'result': True}
+        if method not in DAEMON_METHODS:
+            return {'error': f'unsupported command {method}'}
+
+        LOGGER.info(f'Running {method}')
+        result = contextvars.copy_context().run(self.stream_run, stream, method,
+                                                request['args'], request['kwargs'])
+        return {'result': result}
+
+    def stream_run(self, stream, method, args, kwargs):
+        '''Run a method in the current context, streaming the records it logs'''
+        RESPONSE_STREAM.set(stream)
+        return getattr(self.commands, method)(*args, **kwargs)
+
+    def serve(self):
+        '''Serve requests until interrupted'''
+        LOGGER.info(f'APS daemon listening on {self.server_address}')
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            LOGGER.removeHandler(self.log_handler)
+            self.server_close()
+            os.remove(self.server_address)
+        LOGGER.info('APS daemon stopped')
@@ -6,3 +6,29 @@ class ApsException(Exception):
 
 class ApsHttpException(ApsException):
     """A HTTP error occurred."""
+
+class ApsErrorResponseException(ApsException):
+    """The APS API returned an error object instead of the expected records.
+
+    The error object is available as the response attribute."""
+
+    def __init__(self, response):
+        super().__init__(response['errorMessage'])
+        self.response = response
+
+class ApsDeadlineException(ApsException):
+    """The time budget of an operation ran out."""
+
+class ApsCancelledException(ApsException):
+    """A task was cancelled because a concurrent task of the same operation failed."""
+
+class ApsTaskException(ApsException):
+    """A task of a concurrently executed operation failed.
+
+    The name of the failed task and the results of the tasks which completed are
+    available as the task and results attributes."""
+
+    def __init__(self, task, results, cause):
+        super().__init__(f'Task {task} failed: {cause}')
+        self.task = task
+        self.results = results
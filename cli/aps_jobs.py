@@ -0,0 +1,301 @@
+'''Durable local store of protection jobs, so interrupted protections can be resumed'''
+import contextlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from aps_utils import get_cache_dir, LOGGER
+
+# Stages of a protection job, in order. A job records the last stage it completed.
+JOB_STAGES = ['new',             # nothing done on the backend yet
+              'build_added',     # build created and its metadata set
+              'application_set', # build associated to its application
+              'uploaded',        # binary (and mapping file, certificate) uploaded
+              'protecting',      # protection started
+              'protected',       # protection completed successfully
+              'done']            # protected binary downloaded
+
+# Final stage of a job which failed and cannot be resumed
+JOB_FAILED = 'failed'
+
+# Interval in seconds at which a running job records that it is alive. A job whose
+# owner did not do so for JOB_STALE_TIMEOUT seconds is considered abandoned.
+JOB_HEARTBEAT_INTERVAL = 30
+JOB_STALE_TIMEOUT = 3 * JOB_HEARTBEAT_INTERVAL
+
+# Columns added after the first release of the store, with their definition
+JOB_MIGRATIONS = {'owner': 'TEXT', 'heartbeat': 'REAL'}
+
+# Finished jobs are deleted from the store this many seconds after they finished
+JOB_RETENTION = 30 * 86400
+
+# Final stages of a job
+JOB_FINISHED_STAGES = [JOB_STAGES[-1], JOB_FAILED]
+
+
+def job_owner():
+    '''Returns the owner of the jobs run by this process'''
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def process_alive(pid):
+    '''Is a process of this host running'''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        # Exists but belongs to another user, or cannot be checked on this platform
+        return True
+    return True
+
+def job_stale(job, now=None):
+    '''Has the owner of an unfinished job stopped running it: its process on this host
+    has exited, or it has not recorded a heartbeat for JOB_STALE_TIMEOUT seconds'''
+    now = now or time.time()
+    heartbeat = job.get('heartbeat') or job['updated']
+    if now - heartbeat > JOB_STALE_TIMEOUT:
+        return True
+    host, _, pid = (job.get('owner') or '').rpartition(':')
+    if host == socket.gethostname() and pid.isdigit():
+        return int(pid) != os.getpid() and not process_alive(int(pid))
+    return False
+
+def stage_reached(job, stage):
+    '''Has the job completed the given stage'''
+    return job['stage'] != JOB_FAILED and \
+        JOB_STAGES.index(job['stage']) >= JOB_STAGES.index(stage)
+
+
+class JobStore:
+    '''Protection jobs recorded in a SQLite database. Each operation uses its own
+    connection, so the store can be shared between threads and processes.
+
+    When the cache folder cannot be written, jobs are kept in memory instead: they can
+    not be resumed by another process then, but protections still work. Jobs which
+    finished more than JOB_RETENTION seconds ago are deleted when the store is opened.'''
+
+    def __init__(self, scope, path=None, retention=JOB_RETENTION):
+        '''scope identifies the account, only jobs of the same scope are returned'''
+        self.scope = scope
+        # Connection keeping an in-memory database alive, see use_memory
+        self.memory_connection = None
+        try:
+            self.path = path or os.path.join(get_cache_dir(), 'jobs.sqlite3')
+            self.create_tables()
+            self.prune(retention)
+        except (OSError, sqlite3.Error) as e:
+            LOGGER.warning(f'Cannot open the job store ({e}), jobs will not be resumable')
+            self.use_memory()
+            self.create_tables()
+
+    def use_memory(self):
+        '''Keep the jobs in an in-memory database, shared by the connections of this
+        store while one of them stays open'''
+        self.path = f'file:aps-jobs-{id(self)}?mode=memory&cache=shared'
+        self.memory_connection = sqlite3.connect(self.path, uri=True,
+                                                 check_same_thread=False)
+
+    def create_tables(self):
+        '''Create the jobs and upload parts tables, or add the columns missing in an older
+        jobs table'''
+        with self.connect() as connection:
+            connection.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                scope TEXT NOT NULL,
+                file TEXT NOT NULL,
+                subscription_type TEXT,
+                signing_certificate TEXT,
+                mapping_file TEXT,
+                output_dir TEXT,
+                stage TEXT NOT NULL,
+                build_id TEXT,
+                package_id TEXT,
+                application_id TEXT,
+                upload TEXT,
+                protect_state TEXT,
+                output TEXT,
+                error TEXT,
+                created REAL NOT NULL,
+                updated REAL NOT NULL,
+                owner TEXT,
+                heartbeat REAL)''')
+            columns = {row['name'] for row in connection.execute('PRAGMA table_info(jobs)')}
+            for column, definition in JOB_MIGRATIONS.items():
+                if column not in columns:
+                    connection.execute(f'ALTER TABLE jobs ADD COLUMN {column} {definition}')
+            # The parts uploaded by the multipart upload of a job, see UploadJournal
+            connection.execute('''CREATE TABLE IF NOT EXISTS upload_parts (
+                job_id INTEGER NOT NULL,
+                number INTEGER NOT NULL,
+                part TEXT NOT NULL,
+                PRIMARY KEY (job_id, number))''')
+
+    def prune(self, retention):
+        '''Delete the jobs which finished more than retention seconds ago'''
+        with self.connect() as connection:
+            cursor = connection.execute(
+                'DELETE FROM jobs WHERE stage IN (?, ?) AND updated < ?',
+                JOB_FINISHED_STAGES + [time.time() - retention])
+            connection.execute(
+                'DELETE FROM upload_parts WHERE job_id NOT IN (SELECT id FROM jobs)')
+        if cursor.rowcount:
+            LOGGER.debug(f'Deleted {cursor.rowcount} finished jobs from the job store')
+
+    @contextlib.contextmanager
+    def connect(self):
+        '''Open a connection to the database, committing and closing it when done'''
+        connection = sqlite3.connect(self.path, timeout=30, uri=bool(self.memory_connection))
+        connection.row_factory = sqlite3.Row
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def add(self, file, **options):
+        '''Record a new job, returns its id'''
+        now = time.time()
+        fields = {'scope': self.scope, 'file': file, 'stage': JOB_STAGES[0],
+                  'created': now, 'updated': now, 'owner': job_owner(), 'heartbeat': now}
+        fields.update(options)
+        with self.connect() as connection:
+            cursor = connection.execute(
+                f'INSERT INTO jobs ({", ".join(fields)}) VALUES ({", ".join("?" * len(fields))})',
+                list(fields.values()))
+            return cursor.lastrowid
+
+    def update(self, job_id, **fields):
+        '''Update fields of a job. The uploaded parts of a job are forgotten with its
+        upload, or when it finishes.'''
+        if 'upload' in fields and fields['upload'] is not None:
+            fields['upload'] = json.dumps(fields['upload'])
+        fields['updated'] = fields['heartbeat'] = time.time()
+        with self.connect() as connection:
+            connection.execute(
+                f'UPDATE jobs SET {", ".join(f"{name} = ?" for name in fields)} WHERE id = ?',
+                list(fields.values()) + [job_id])
+            if 'upload' in fields or fields.get('stage') in JOB_FINISHED_STAGES:
+                connection.execute('DELETE FROM upload_parts WHERE job_id = ?', [job_id])
+
+    def add_upload_part(self, job_id, number, part):
+        '''Record a part uploaded by the multipart upload of a job'''
+        with self.connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO upload_parts (job_id, number, part) VALUES (?, ?, ?)',
+                [job_id, number, json.dumps(part)])
+            connection.execute('UPDATE jobs SET heartbeat = ? WHERE id = ?',
+                               [time.time(), job_id])
+
+    def get(self, job_id):
+        '''Returns a job as a dict'''
+        with self.connect() as connection:
+            row = connection.execute('SELECT * FROM jobs WHERE id = ?', [job_id]).fetchone()
+            return self.to_dict(connection, row) if row else None
+
+    def list_jobs(self, unfinished=False):
+        '''Returns the jobs of our scope, optionally only the unfinished ones which are
+        no longer run by their owner and so can be resumed'''
+        query = 'SELECT * FROM jobs WHERE scope = ?'
+        params = [self.scope]
+        if unfinished:
+            query += ' AND stage NOT IN (?, ?)'
+            params += JOB_FINISHED_STAGES
+        with self.connect() as connection:
+            rows = connection.execute(query + ' ORDER BY id', params).fetchall()
+            jobs = [self.to_dict(connection, row) for row in rows]
+        if unfinished:
+            now = time.time()
+            jobs = [job for job in jobs if job_stale(job, now)]
+        return jobs
+
+    def claim(self, job):
+        '''Take over a stale job. Returns False if another process claimed or updated it
+        since it was listed.'''
+        now = time.time()
+        with self.connect() as connection:
+            cursor = connection.execute(
+                'UPDATE jobs SET owner = ?, heartbeat = ? '
+                'WHERE id = ? AND updated = ? AND heartbeat IS ?',
+                [job_owner(), now, job['id'], job['updated'], job['heartbeat']])
+            return cursor.rowcount == 1
+
+    def beat(self, job_id):
+        '''Record that the owner of a job is still running it'''
+        with self.connect() as connection:
+            connection.execute('UPDATE jobs SET heartbeat = ? WHERE id = ?',
+                               [time.time(), job_id])
+
+    @contextlib.contextmanager
+    def heartbeat(self, job_id):
+        '''Record a heartbeat of the job every JOB_HEARTBEAT_INTERVAL seconds while the
+        block runs'''
+        stop = threading.Event()
+
+        def run():
+            while not stop.wait(JOB_HEARTBEAT_INTERVAL):
+                try:
+                    self.beat(job_id)
+                except sqlite3.Error as e:
+                    LOGGER.debug(f'Failed to record heartbeat of job {job_id}: {e}')
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    @staticmethod
+    def to_dict(connection, row):
+        '''Convert a database row to a job dict, with the parts of its upload'''
+        job = dict(row)
+        job['upload'] = json.loads(job['upload']) if job['upload'] else None
+        if job['upload']:
+            # Stores written by older versions keep the parts in the upload itself
+            parts = job['upload'].setdefault('parts', [])
+            parts += [json.loads(part) for part, in connection.execute(
+                'SELECT part FROM upload_parts WHERE job_id = ? ORDER BY number',
+                [job['id']])]
+        return job
+
+
+class UploadJournal:
+    '''Progress of a multipart upload, saved in the job store after every part so an
+    interrupted upload can be continued. Each part is stored as a row of its own.'''
+
+    def __init__(self, store, job_id, state=None):
+        self.store = store
+        self.job_id = job_id
+        state = state or {}
+        self.upload_id = state.get('uploadId')
+        self.upload_name = state.get('uploadName')
+        self.parts = state.get('parts', [])
+
+    def save(self):
+        '''Save the upload of the journal in the job store, forgetting its parts'''
+        state = None
+        if self.upload_id:
+            state = {'uploadId': self.upload_id,
+                     'uploadName': self.upload_name}
+        self.store.update(self.job_id, upload=state)
+
+    def start(self, upload_id, upload_name):
+        '''Record a newly started upload'''
+        self.upload_id = upload_id
+        self.upload_name = upload_name
+        self.parts = []
+        self.save()
+
+    def add_part(self, part):
+        '''Record an uploaded part'''
+        self.parts.append(part)
+        self.store.add_upload_part(self.job_id, len(self.parts), part)
+
+    def clear(self):
+        '''Forget the upload, e.g. once it was aborted'''
+        self.upload_id = self.upload_name = None
+        self.parts = []
+        self.save()
@@ -0,0 +1,225 @@
+'''Timing of the phases of APS operations.
+
+An operation activates a PhaseTimer, and code running on its behalf (also in the
+worker threads of a TaskGraph, which copy the context) records the time spent and the
+bytes moved in named phases. Recording is a no-op when no timer is active. Phases of
+concurrent tasks overlap, so their durations may add up to more than the total.
+
+Optionally the resident memory (RSS) of the process is sampled while phases run, and
+the peak seen during each phase is reported.'''
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+CURRENT_TIMER = contextvars.ContextVar('aps_phase_timer', default=None)
+CURRENT_PHASE = contextvars.ContextVar('aps_phase', default=None)
+
+
+def current_rss():
+    '''Returns the resident set size of the process in bytes, or None if unknown. Where
+    /proc is not available this is the peak resident set size so far.'''
+    try:
+        with open('/proc/self/statm', 'r') as file_handle:
+            return int(file_handle.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class PhaseTimer:
+    '''Durations and bytes moved per phase of an operation. When rss_interval is given,
+    the RSS is sampled at that interval (in seconds) and when phases start and end.'''
+
+    def __init__(self, operation, rss_interval=None):
+        self.operation = operation
+        self.rss_interval = rss_interval
+        self.start_time = time.time()
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.phases = {}
+        # Number of runs of each phase in progress
+        self.active = {}
+        self.peak_rss = None
+
+    @contextlib.contextmanager
+    def activate(self):
+        '''Record the phases of the code run in this context'''
+        token = CURRENT_TIMER.set(self)
+        stop = threading.Event()
+        sampler = None
+        if self.rss_interval:
+            sampler = threading.Thread(target=self.sample_rss, args=(stop,), daemon=True)
+            sampler.start()
+        try:
+            yield self
+        finally:
+            CURRENT_TIMER.reset(token)
+            if sampler:
+                stop.set()
+                sampler.join()
+
+    def sample_rss(self, stop):
+        '''Sample the RSS until stop is set'''
+        while not stop.wait(self.rss_interval):
+            self.record_rss()
+
+    def record_rss(self):
+        '''Record the current RSS as seen by the phases in progress'''
+        rss = current_rss()
+        if rss is None:
+            return
+        with self.lock:
+            self.peak_rss = max(self.peak_rss or 0, rss)
+            for phase, runs in self.active.items():
+                if runs:
+                    entry = self.phases[phase]
+                    entry['peakRss'] = max(entry['peakRss'] or 0, rss)
+
+    def add(self, phase, duration=0.0, byte_count=0, runs=0):
+        '''Add time, bytes or runs to a phase'''
+        with self.lock:
+            entry = self.phases.setdefault(
+                phase, {'duration': 0.0, 'bytes': 0, 'runs': 0, 'peakRss': None})
+            entry['duration'] += duration
+            entry['bytes'] += byte_count
+            entry['runs'] += runs
+
+    def enter(self, phase):
+        '''Record the start of a run of a phase'''
+        self.add(phase)
+        with self.lock:
+            self.active[phase] = self.active.get(phase, 0) + 1
+        if self.rss_interval:
+            self.record_rss()
+
+    def leave(self, phase, duration):
+        '''Record the end of a run of a phase'''
+        if self.rss_interval:
+            self.record_rss()
+        self.add(phase, duration=duration, runs=1)
+        with self.lock:
+            self.active[phase] -= 1
+
+    def report(self, **fields):
+        '''Returns the timing report: the total duration and, per phase in the order the
+        phases started, the duration, runs, bytes moved, throughput in bytes/second and
+        the peak RSS in bytes (None unless sampled)'''
+        report = {'operation': self.operation,
+                  'startTime': self.start_time,
+                  'duration': time.monotonic() - self.start}
+        report.update(fields)
+        with self.lock:
+            report['peakRss'] = self.peak_rss
+            report['phases'] = [
+                {'phase': phase,
+                 'duration': entry['duration'],
+                 'runs': entry['runs'],
+                 'bytes': entry['bytes'],
+                 'throughput': entry['bytes'] / entry['duration']
+                               if entry['bytes'] and entry['duration'] else None,
+                 'peakRss': entry['peakRss']}
+                for phase, entry in self.phases.items()]
+        return report
+
+
+@contextlib.contextmanager
+def timed_phase(phase):
+    '''Record the time spent in the block as a run of the phase'''
+    timer = CURRENT_TIMER.get()
+    if not timer:
+        yield
+        return
+    timer.enter(phase)
+    token = CURRENT_PHASE.set(phase)
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timer.leave(phase, time.monotonic() - start)
+        CURRENT_PHASE.reset(token)
+
+def add_phase_time(phase, duration):
+    '''Record time spent in a phase which is not a single block, e.g. waiting in a state'''
+    timer = CURRENT_TIMER.get()
+    if timer:
+        timer.add(phase, duration=duration)
+
+def add_phase_bytes(byte_count):
+    '''Record bytes moved by the current phase'''
+    timer = CURRENT_TIMER.get()
+    phase = CURRENT_PHASE.get()
+    if timer and phase:
+        timer.add(phase, byte_count=byte_count)
+
+def write_atomically(path, text):
+    '''Write a file so that readers (e.g. node_exporter) never see a partial file'''
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as file_handle:
+            file_handle.write(text)
+        os.replace(tmp_path, path)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+
+def write_timing_report(report, path):
+    '''Write a timing report as JSON'''
+    write_atomically(path, json.dumps(report, indent=2, sort_keys=True) + '\n')
+
+def openmetrics_labels(**labels):
+    '''Format OpenMetrics labels'''
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels.items()) + '}'
+
+def write_openmetrics(report, path):
+    '''Write a timing report in the OpenMetrics text format, e.g. as a textfile for the
+    node_exporter textfile collector'''
+    operation = report['operation']
+    lines = [
+        '# TYPE aps_operation_duration_seconds gauge',
+        '# HELP aps_operation_duration_seconds Duration of the last run of the operation.',
+        f'aps_operation_duration_seconds{openmetrics_labels(operation=operation)} '
+        f'{report["duration"]}',
+        '# TYPE aps_operation_success gauge',
+        '# HELP aps_operation_success Whether the last run of the operation succeeded.',
+        f'aps_operation_success{openmetrics_labels(operation=operation)} '
+        f'{int(bool(report.get("success")))}',
+        '# TYPE aps_operation_start_timestamp_seconds gauge',
+        '# HELP aps_operation_start_timestamp_seconds Start time of the last run of the operation.',
+        f'aps_operation_start_timestamp_seconds{openmetrics_labels(operation=operation)} '
+        f'{report["startTime"]}',
+    ]
+    if report.get('peakRss') is not None:
+        lines += [
+            '# TYPE aps_operation_peak_rss_bytes gauge',
+            '# HELP aps_operation_peak_rss_bytes Peak sampled resident memory of the operation.',
+            f'aps_operation_peak_rss_bytes{openmetrics_labels(operation=operation)} '
+            f'{report["peakRss"]}',
+        ]
+    for name, field, description in [
+            ('aps_phase_duration_seconds', 'duration', 'Time spent in the phase.'),
+            ('aps_phase_bytes', 'bytes', 'Bytes moved by the phase.'),
+            ('aps_phase_throughput_bytes_per_second', 'throughput',
+             'Bytes moved per second of the phase.'),
+            ('aps_phase_peak_rss_bytes', 'peakRss',
+             'Peak sampled resident memory during the phase.')]:
+        lines += [f'# TYPE {name} gauge', f'# HELP {name} {description}']
+        for phase in report['phases']:
+            if phase[field] is not None:
+                labels = openmetrics_labels(operation=operation, phase=phase['phase'])
+                lines.append(f'{name}{labels} {phase[field]}')
+    lines.append('# EOF')
+    write_atomically(path, '\n'.join(lines) + '\n')
@@ -0,0 +1,108 @@
+'''Local checks of build files, run before anything is sent to APS.
+
+The checks reproduce rejections of the APS backend which can be detected from the file
+itself, so that they are reported with the same error codes and messages, but before
+a build is created and the file is uploaded. A check which cannot parse the file does
+not block it: the file is then left for the backend to check.'''
+import base64
+import os
+import re
+from zipfile import BadZipFile, ZipFile, is_zipfile
+
+from aps_axml import parse_manifest
+from aps_cache import BuildMetadataCache
+from aps_exceptions import ApsException
+from aps_utils import get_os, get_upload_name, is_xcarchive_dir, LOGGER
+from common import getSimpleErrorMessage
+
+# Characters the backend accepts in upload file names
+FILENAME_PATTERN = re.compile(r'^[A-Za-z0-9 ._-]+$')
+
+INTERNET_PERMISSION = 'android.permission.INTERNET'
+
+# Start of the local header preceding each entry in a zip archive, and its fixed size
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+LOCAL_HEADER_SIZE = 30
+
+
+def get_error(code):
+    '''Returns an error response for an APS error code, with the message APS uses'''
+    return {'errorMessage': code, 'message': getSimpleErrorMessage(code)}
+
+def check_archive(file):
+    '''Returns the error code for a build file which is not a valid zip archive, or None.
+    Only the central directory is checked: every entry it lists must start with a local
+    header within the file. The entries are not decompressed.'''
+    if is_xcarchive_dir(file):
+        return None
+    if not is_zipfile(file):
+        return 'INVALID_FILES'
+    try:
+        size = os.path.getsize(file)
+        with ZipFile(file) as zipfile, open(file, 'rb') as file_handle:
+            for entry in zipfile.infolist():
+                if entry.header_offset < 0 or \
+                   entry.header_offset + LOCAL_HEADER_SIZE + entry.compress_size > size:
+                    LOGGER.debug(f'Entry {entry.filename} lies outside {file}')
+                    return 'INVALID_FILES'
+                file_handle.seek(entry.header_offset)
+                if file_handle.read(len(LOCAL_HEADER_SIGNATURE)) != LOCAL_HEADER_SIGNATURE:
+                    LOGGER.debug(f'Entry {entry.filename} of {file} has no local header')
+                    return 'INVALID_FILES'
+    except (BadZipFile, OSError, EOFError) as e:
+        LOGGER.debug(f'Failed to read {file}: {e}')
+        return 'INVALID_FILES'
+    return None
+
+def check_manifest(version_info):
+    '''Returns the error codes for the android manifest of a build'''
+    if 'androidManifest' not in version_info:
+        # aab manifests are in protobuf format, which is not parsed locally
+        return []
+    try:
+        manifest = parse_manifest(base64.b64decode(version_info['androidManifest']))
+    except Exception as e: # pylint: disable=broad-except
+        LOGGER.warning(f'Cannot check the android manifest, left to APS: {e}')
+        return []
+
+    errors = []
+    if manifest['debuggable']:
+        errors.append('ANDROID_APPLICATION_DEBUGGABLE')
+    if INTERNET_PERMISSION not in manifest['permissions']:
+        errors.append('ANDROID_PERMISSION_INTERNET_MISSING')
+    if manifest['minSdkVersion'] is None:
+        errors.append('ANDROID_MINIMUM_SDK_VERSION_MISSING')
+    return errors
+
+def check_build(file, metadata_cache=None):
+    '''Check a build file. Returns the list of APS error codes it would be rejected
+    with, empty if no problem was found.'''
+    if not os.path.exists(file):
+        return ['ERROR_NO_FILES']
+    try:
+        os_type = get_os(file)
+    except ApsException:
+        return ['INVALID_FILES']
+
+    errors = []
+    if not FILENAME_PATTERN.match(get_upload_name(file)):
+        errors.append('ERROR_INVALID_FILENAME')
+
+    error = check_archive(file)
+    if error:
+        return errors + [error]
+
+    if os_type == 'android':
+        try:
+            version_info = (metadata_cache or BuildMetadataCache()).get(file)['versionInfo']
+        except ApsException as e:
+            LOGGER.warning(f'Cannot check the contents of {file}, left to APS: {e}')
+            return errors
+        errors += check_manifest(version_info)
+    return errors
+
+def validate_build(file, metadata_cache=None):
+    '''Check a build file. Returns a dict with the file, whether it is valid and the
+    list of errors found, each with its APS error code and message.'''
+    errors = [get_error(code) for code in check_build(file, metadata_cache)]
+    return {'file': file, 'valid': not errors, 'errors': errors}
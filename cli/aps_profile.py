@@ -0,0 +1,86 @@
+'''Profiling of CLI commands.
+
+A command is run under cProfile (cpu) or tracemalloc (mem). The profile is written to
+a file, which can be loaded with pstats or tracemalloc.Snapshot.load, and a summary of
+the top entries in the modules of the APS client is written to stderr.'''
+import cProfile
+import pstats
+import sys
+import threading
+import tracemalloc
+
+# Modules the profile summary is restricted to
+PROFILE_MODULES = ['apsapi', 'aps_utils', 'aps_requests']
+
+# Number of frames stored per memory allocation
+TRACEMALLOC_FRAMES = 25
+
+
+def profile_cpu(func, output, top, stream=None):
+    '''Run func under cProfile, write the profile to output and a summary of the top
+    functions by cumulative time to stream. Returns the result of func.
+
+    Threads started while func runs (e.g. the workers adding the build and uploading
+    it in protect) are profiled with a profiler of their own, and their profiles are
+    merged with the one of the calling thread.'''
+    lock = threading.Lock()
+    thread_profilers = []
+
+    def profile_thread(frame, event, arg): # pylint: disable=unused-argument
+        # Called on the first event of a new thread, the profiler then replaces it
+        thread_profiler = cProfile.Profile()
+        try:
+            thread_profiler.enable()
+        except ValueError:
+            # Since Python 3.12 a single profiler sees all threads and no other one
+            # can be enabled
+            sys.setprofile(None)
+            return
+        with lock:
+            thread_profilers.append(thread_profiler)
+
+    profiler = cProfile.Profile()
+    threading.setprofile(profile_thread)
+    try:
+        return profiler.runcall(func)
+    finally:
+        threading.setprofile(None)
+        stream = stream or sys.stderr
+        stats = pstats.Stats(profiler, stream=stream)
+        with lock:
+            for thread_profiler in thread_profilers:
+                stats.add(thread_profiler)
+        stats.dump_stats(output)
+        stats.sort_stats('cumulative')
+        stream.write(f'CPU profile written to {output}\n')
+        stats.print_stats('|'.join(f'{module}\\.py' for module in PROFILE_MODULES), top)
+
+def profile_memory(func, output, top, stream=None):
+    '''Run func under tracemalloc, write a snapshot of the memory still allocated at the
+    end to output and a summary of the peak memory and the top allocating lines to
+    stream. Returns the result of func.'''
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    try:
+        return func()
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        snapshot.dump(output)
+
+        stream = stream or sys.stderr
+        stream.write(f'Memory profile written to {output}\n')
+        stream.write(f'Peak traced memory: {peak / 1048576:.1f} MiB\n')
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(True, f'*{module}.py', all_frames=True)
+            for module in PROFILE_MODULES])
+        for statistic in snapshot.statistics('lineno')[:top]:
+            stream.write(f'{statistic}\n')
+
+def profile(kind, func, output=None, top=20):
+    '''Run func under the cpu or mem profiler. The profile is written to output, by
+    default aps-<kind>.prof. Returns the result of func.'''
+    output = output or f'aps-{kind}.prof'
+    if kind == 'cpu':
+        return profile_cpu(func, output, top)
+    return profile_memory(func, output, top)
@@ -0,0 +1,97 @@
+'''Live progress events of transfers and protections.
+
+Progress is reported to a callback as events, which are dicts with an 'event' type:
+'upload' and 'download' events are sent while a file is transferred, 'protect_state'
+events when the protection state of a build changes. The callback may be called from
+several threads at once.'''
+import json
+import sys
+import threading
+import time
+
+# Minimum interval in seconds between two progress events of a transfer
+PROGRESS_INTERVAL = 0.5
+
+
+class TransferProgress:
+    '''Progress of an upload or download. Reports the bytes transferred, the total size
+    if known, the instantaneous throughput (since the previous event) and the average
+    throughput in bytes/second, the parts in flight and the estimated time left in
+    seconds. Does nothing without a callback.
+
+    initial is the number of bytes transferred before, e.g. by an interrupted upload
+    which is continued. They count as transferred but not for the throughput.'''
+
+    def __init__(self, callback, event, total=None, initial=0, **fields):
+        self.callback = callback
+        self.event = event
+        self.total = total
+        self.fields = fields
+        self.lock = threading.Lock()
+        self.initial = self.bytes = self.last_bytes = initial
+        self.parts_in_flight = 0
+        self.start = self.last_time = time.monotonic()
+        self.emit(force=True)
+
+    def start_part(self):
+        '''Record the start of the transfer of a part'''
+        with self.lock:
+            self.parts_in_flight += 1
+        self.emit()
+
+    def add(self, byte_count, part_done=False):
+        '''Record transferred bytes, and the end of the transfer of a part'''
+        with self.lock:
+            self.bytes += byte_count
+            if part_done:
+                self.parts_in_flight -= 1
+        self.emit(force=part_done)
+
+    def finish(self, success=True):
+        '''Report the end of the transfer'''
+        self.emit(force=True, done=True, success=success)
+
+    def emit(self, force=False, **extra):
+        '''Send a progress event, unless one was sent less than PROGRESS_INTERVAL ago'''
+        if not self.callback:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if not force and now - self.last_time < PROGRESS_INTERVAL:
+                return
+            elapsed = now - self.start
+            interval = now - self.last_time
+            average = (self.bytes - self.initial) / elapsed if elapsed > 0 else None
+            event = {
+                'event': self.event,
+                'time': time.time(),
+                'bytes': self.bytes,
+                'totalBytes': self.total,
+                'throughput': (self.bytes - self.last_bytes) / interval if interval > 0 else None,
+                'averageThroughput': average,
+                'partsInFlight': self.parts_in_flight,
+                'eta': (self.total - self.bytes) / average
+                       if self.total is not None and average else None,
+            }
+            event.update(self.fields)
+            event.update(extra)
+            self.last_time, self.last_bytes = now, self.bytes
+        self.callback(event)
+
+
+def protect_state_event(build_id, state, previous_state, progress=None):
+    '''Returns the event for a change of the protection state of a build'''
+    return {'event': 'protect_state', 'time': time.time(), 'buildId': build_id,
+            'state': state, 'previousState': previous_state, 'progress': progress}
+
+def json_progress_writer(stream=None):
+    '''Returns a progress callback writing each event as a line of JSON, by default to
+    stderr'''
+    lock = threading.Lock()
+
+    def write(event):
+        with lock:
+            output = stream or sys.stderr
+            output.write(json.dumps(event, sort_keys=True) + '\n')
+            output.flush()
+    return write
@@ -0,0 +1,156 @@
+'''Analytics over the build history of an account.
+
+Build records are loaded into columns in a single pass, then aggregated per
+application and per OS.'''
+import csv
+import math
+import sys
+from datetime import datetime, timezone
+
+from aps_utils import get_build_time, LOGGER
+
+# Build record fields holding the time protection was requested, started and ended.
+# Protected builds without all of them are counted as missing timings.
+PROTECT_REQUEST_FIELD = 'protectRequestTime'
+PROTECT_START_FIELD = 'protectStartTime'
+PROTECT_END_FIELD = 'protectEndTime'
+
+PROTECT_DONE_STATE = 'protect_done'
+
+# States of builds whose protection is not finished
+PROTECT_PENDING_STATES = ['protect_queue', 'protect_in_progress']
+
+DEFAULT_PERCENTILES = [50, 90, 99]
+
+SECONDS_PER_DAY = 86400
+
+
+def load_build_columns(builds):
+    '''Load build records into columns, in a single pass over the records. Times are
+    epoch seconds, NaN when unknown. The missing column tells whether a protected build
+    lacks some of its protection times.'''
+    columns = {'application': [], 'os': [], 'queue': [], 'protect': [], 'end': [],
+               'done': [], 'failed': [], 'missing': []}
+    for build in builds:
+        requested = get_build_time(build, PROTECT_REQUEST_FIELD)
+        started = get_build_time(build, PROTECT_START_FIELD)
+        ended = get_build_time(build, PROTECT_END_FIELD)
+        state = build.get('state') or ''
+        missing = state == PROTECT_DONE_STATE and None in (requested, started, ended)
+        if missing:
+            LOGGER.debug(f'Build {build.get("id")} was protected but lacks some of '
+                         f'{PROTECT_REQUEST_FIELD}, {PROTECT_START_FIELD} and '
+                         f'{PROTECT_END_FIELD}')
+
+        columns['application'].append(build.get('applicationId') or '')
+        columns['os'].append(build.get('os') or '')
+        columns['queue'].append(started - requested
+                                if started is not None and requested is not None
+                                else math.nan)
+        columns['protect'].append(ended - started
+                                  if ended is not None and started is not None
+                                  else math.nan)
+        columns['end'].append(ended if ended is not None else math.nan)
+        columns['done'].append(state == PROTECT_DONE_STATE)
+        columns['failed'].append(state.startswith('protect_') and
+                                 state != PROTECT_DONE_STATE and
+                                 state not in PROTECT_PENDING_STATES)
+        columns['missing'].append(missing)
+    return columns
+
+def percentile(values, q):
+    '''Percentile of sorted values, interpolated linearly like numpy.percentile'''
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def group_stats(keys, columns, percentiles):
+    '''Aggregate the columns per group key. Returns a dict of stats keyed by group key.'''
+    groups = {}
+    for index, key in enumerate(keys):
+        group = groups.setdefault(key, {'builds': 0, 'done': 0, 'failed': 0, 'missing': 0,
+                                        'queue': [], 'protect': []})
+        group['builds'] += 1
+        group['done'] += columns['done'][index]
+        group['failed'] += columns['failed'][index]
+        group['missing'] += columns['missing'][index]
+        for name in ['queue', 'protect']:
+            if not math.isnan(columns[name][index]):
+                group[name].append(columns[name][index])
+
+    stats = {}
+    for key in sorted(groups):
+        group = groups[key]
+        stats[key] = make_stats(
+            group['builds'], group['done'], group['failed'], group['missing'],
+            {name: {f'p{q}': percentile(sorted(group[name]), q) for q in percentiles}
+             for name in ['queue', 'protect']})
+    return stats
+
+def make_stats(builds, done, failed, missing, durations):
+    '''Stats of a group of builds'''
+    finished = done + failed
+    return {'builds': builds,
+            'protected': done,
+            'failed': failed,
+            'missingTimings': missing,
+            'failureRatio': failed / finished if finished else None,
+            'queueTime': durations['queue'],
+            'protectTime': durations['protect']}
+
+def throughput_per_day(columns):
+    '''Number of builds protected per (UTC) day'''
+    days = {}
+    for done, end in zip(columns['done'], columns['end']):
+        if done and not math.isnan(end):
+            day = int(end // SECONDS_PER_DAY)
+            days[day] = days.get(day, 0) + 1
+    return [{'date': datetime.fromtimestamp(day * SECONDS_PER_DAY,
+                                            timezone.utc).strftime('%Y-%m-%d'),
+             'protected': days[day]}
+            for day in sorted(days)]
+
+def build_report(builds, percentiles=None):
+    '''Report on build records: per application and per OS the number of builds, the
+    protected and failed builds, the failure ratio and percentiles (in seconds) of the
+    time spent in the protection queue and protecting, plus the throughput per day.
+    Protected builds lacking some of their protection times are counted as
+    missingTimings and left out of the durations they are needed for.'''
+    percentiles = percentiles or DEFAULT_PERCENTILES
+    columns = load_build_columns(builds)
+    missing = sum(columns['missing'])
+    if missing:
+        LOGGER.warning(f'{missing} protected builds lack some of the {PROTECT_REQUEST_FIELD}, '
+                       f'{PROTECT_START_FIELD} and {PROTECT_END_FIELD} fields, their '
+                       'protection times are not reported')
+    return {
+        'builds': len(columns['done']),
+        'missingTimings': missing,
+        'byApplication': group_stats(columns['application'], columns, percentiles),
+        'byOs': group_stats(columns['os'], columns, percentiles),
+        'throughput': throughput_per_day(columns),
+    }
+
+def write_report_csv(report, output=None):
+    '''Write a build report as CSV (by default to stdout), one row per application, OS
+    and day'''
+    groups = list(report['byApplication'].values()) + list(report['byOs'].values())
+    duration_columns = [(name, q) for name in ['queueTime', 'protectTime']
+                        for q in (groups[0][name] if groups else {})]
+
+    writer = csv.writer(output or sys.stdout)
+    writer.writerow(['group', 'key', 'builds', 'protected', 'failed', 'missingTimings',
+                     'failureRatio'] +
+                    [f'{name}_{q}' for name, q in duration_columns] + ['date'])
+    for group, key in [('application', 'byApplication'), ('os', 'byOs')]:
+        for name, stats in report[key].items():
+            writer.writerow([group, name, stats['builds'], stats['protected'],
+                             stats['failed'], stats['missingTimings'],
+                             stats['failureRatio']] +
+                            [stats[column][q] for column, q in duration_columns] + [''])
+    for day in report['throughput']:
+        writer.writerow(['day', '', '', day['protected'], '', '', ''] +
+                        [''] * len(duration_columns) + [day['date']])
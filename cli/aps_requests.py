@@ -1,10 +1,86 @@
+import base64
+import contextlib
+import contextvars
+import json
+import re
+import time
+
 import requests
 import backoff
 
+from aps_exceptions import ApsDeadlineException
+
+# Share one session between all requests so that connections are pooled and reused
+SESSION = requests.Session()
+
+# Budget in seconds given to cleanup requests (e.g. cancelling a protection) made once
+# the deadline of an operation has expired
+CLEANUP_TIMEOUT = 30
+
+# Time in seconds a cached response is used without revalidation, when the server gave
+# neither a validator (ETag or Last-Modified) nor a max-age
+CACHE_TTL = 300
+
+# Headers of a 304 Not Modified response which update those of the cached response
+REVALIDATION_HEADERS = ['Cache-Control', 'Date', 'ETag', 'Expires', 'Last-Modified']
+
+# Deadline of the operation in progress, if any. Every request made while a deadline is
+# set gets the remaining time as its timeout.
+DEADLINE = contextvars.ContextVar('aps_deadline', default=None)
+
+
+class Deadline:
+    '''Point in time by which an operation must have completed'''
+
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        '''Seconds left before the deadline'''
+        return self.expires - time.monotonic()
+
+    def check(self):
+        '''Raise ApsDeadlineException if the deadline has expired'''
+        if self.remaining() <= 0:
+            raise ApsDeadlineException('Deadline exceeded')
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    '''Run the enclosed block with a deadline in the given number of seconds, or
+    without a deadline when seconds is None'''
+    token = DEADLINE.set(Deadline(seconds) if seconds is not None else None)
+    try:
+        yield DEADLINE.get()
+    finally:
+        DEADLINE.reset(token)
+
+@contextlib.contextmanager
+def cleanup_deadline():
+    '''Run cleanup requests with a short budget of their own when a deadline is set,
+    as the deadline itself may have already expired'''
+    if DEADLINE.get() is None:
+        yield
+    else:
+        with deadline(CLEANUP_TIMEOUT):
+            yield
+
+def check_deadline():
+    '''Raise ApsDeadlineException if the deadline of the current operation has expired'''
+    if DEADLINE.get() is not None:
+        DEADLINE.get().check()
+
+def remaining_time():
+    '''Seconds left before the deadline of the current operation, or None'''
+    return DEADLINE.get().remaining() if DEADLINE.get() is not None else None
+
 
 def check_requests_response(response):
     '''Check response from requests call. If there is an error message coming from
     APS backend then return it, otherwise raise an exception'''
+    # Successful responses are not inspected, so streamed bodies are not read here
+    if response.ok:
+        return
     if 'Content-Type' in response.headers and \
         response.headers['Content-Type'] == 'application/json':
         if 'errorMessage' in response.json():
@@ -18,15 +94,92 @@ def check_requests_response(response):
                       max_time=30)
 def request_with_retry(method, url, **kwargs):
     '''Requests with retry'''
-    response = requests.request(method, url, **kwargs)
+    if DEADLINE.get() is not None:
+        DEADLINE.get().check()
+        kwargs.setdefault('timeout', DEADLINE.get().remaining())
+    response = SESSION.request(method, url, **kwargs)
     check_requests_response(response)
     return response
 
+def cache_lifetime(headers, ttl):
+    '''Returns the number of seconds a response with the given headers may be used
+    without revalidation, or None if it must not be cached'''
+    cache_control = headers.get('Cache-Control', '').lower()
+    if 'no-store' in cache_control:
+        return None
+    match = re.search(r'max-age=(\d+)', cache_control)
+    if match:
+        return int(match.group(1))
+    if 'no-cache' in cache_control or 'ETag' in headers or 'Last-Modified' in headers:
+        return 0
+    return ttl
+
+def cached_response(url, entry):
+    '''Rebuild a response from a cache entry'''
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+    response._content = base64.b64decode(entry['body']) # pylint: disable=protected-access
+    return response
+
+
 class ApsRequest:
     @staticmethod
     def get(url, **kwargs):
          return request_with_retry('get', url, **kwargs)
 
+    @staticmethod
+    def cached_get(url, cache, scope, ttl=CACHE_TTL, **kwargs):
+        '''GET a read-mostly resource through a cache of responses (an HttpCache, or
+        None for no caching). Entries are keyed by the URL, the query parameters and
+        scope, which identifies the account since the Authorization header changes.
+
+        A cached response is returned without a request while it is fresh: for the
+        max-age given by the server, or for ttl seconds if the server gave no max-age and
+        no validator. Otherwise it is revalidated with If-None-Match/If-Modified-Since,
+        and returned again if the server answers 304 Not Modified.'''
+        if cache is None:
+            return ApsRequest.get(url, **kwargs)
+
+        key = json.dumps([url, kwargs.get('params'), scope], sort_keys=True)
+        entry = cache.get(key)
+        if entry and time.time() < entry['expires']:
+            return cached_response(url, entry)
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('lastModified'):
+            headers['If-Modified-Since'] = entry['lastModified']
+        response = request_with_retry('get', url, headers=headers, **kwargs)
+
+        if entry and response.status_code == 304:
+            cached_headers = requests.structures.CaseInsensitiveDict(entry['headers'])
+            for name in REVALIDATION_HEADERS:
+                if name in response.headers:
+                    cached_headers[name] = response.headers[name]
+            lifetime = cache_lifetime(cached_headers, ttl)
+            if lifetime is not None:
+                cache.put(key, {**entry,
+                                'headers': dict(cached_headers),
+                                'etag': cached_headers.get('ETag'),
+                                'lastModified': cached_headers.get('Last-Modified'),
+                                'expires': time.time() + lifetime})
+            return cached_response(url, entry)
+
+        lifetime = cache_lifetime(response.headers, ttl)
+        if response.status_code == 200 and lifetime is not None:
+            cache.put(key, {
+                'headers': {name: value for name, value in response.headers.items()
+                            if name.lower() != 'set-cookie'},
+                'body': base64.b64encode(response.content).decode('ascii'),
+                'etag': response.headers.get('ETag'),
+                'lastModified': response.headers.get('Last-Modified'),
+                'expires': time.time() + lifetime,
+            })
+        return response
+
     @staticmethod
     def put(url, **kwargs):
          return request_with_retry('put', url, **kwargs)
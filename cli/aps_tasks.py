@@ -0,0 +1,150 @@
+'''Helpers for running APS operations concurrently'''
+import contextvars
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from aps_exceptions import ApsCancelledException, ApsException, ApsTaskException
+
+# Event set when a task run concurrently with the current one has failed, if any. Long
+# running tasks (e.g. uploads) check it with check_cancelled to stop early.
+CANCELLED = contextvars.ContextVar('aps_task_cancelled', default=None)
+
+
+def check_cancelled():
+    '''Raise ApsCancelledException if a task run concurrently with the current one has
+    failed'''
+    if CANCELLED.get() is not None and CANCELLED.get().is_set():
+        raise ApsCancelledException('Cancelled since a concurrent task failed')
+
+
+class TaskGraph:
+    '''Runs a small graph of dependent tasks on a pool of worker threads. Each task is
+    started as soon as all tasks it depends on have completed, so independent tasks
+    run at the same time.'''
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.tasks = {}
+
+    def add(self, name, function, *depends_on):
+        '''Add a task. The function is called with the results of the tasks it depends
+        on, in the given order. Dependencies must be added before the tasks using them.'''
+        for dependency in depends_on:
+            if dependency not in self.tasks:
+                raise ApsException(f'Task {name} depends on unknown task {dependency}')
+        self.tasks[name] = (function, depends_on)
+
+    def run(self):
+        '''Run all tasks and return a dict of their results keyed by task name.
+
+        When a task fails no further tasks are started, the tasks already running are
+        cancelled (see check_cancelled) and waited for, and an ApsTaskException is raised
+        from the task's exception.'''
+        results = {}
+        pending = dict(self.tasks)
+        running = {}
+        failure = None
+        cancelled = threading.Event()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if not failure:
+                    for name, (function, depends_on) in list(pending.items()):
+                        if all(dependency in results for dependency in depends_on):
+                            del pending[name]
+                            args = [results[dependency] for dependency in depends_on]
+                            # Run in a copy of our context, so e.g. a deadline applies
+                            context = contextvars.copy_context()
+                            context.run(CANCELLED.set, cancelled)
+                            running[executor.submit(context.run, function, *args)] = name
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    if future.exception():
+                        failure = failure or (name, future.exception())
+                        cancelled.set()
+                    else:
+                        results[name] = future.result()
+
+        if failure:
+            name, exc = failure
+            raise ApsTaskException(name, results, exc) from exc
+        return results
+
+
+class StagedPipeline:
+    '''Runs items through a sequence of stages, each stage having its own bounded pool
+    of worker threads. An item moves on to the next stage as soon as the previous stage
+    is done with it, so different items can be in different stages at the same time.'''
+
+    def __init__(self, stages):
+        '''stages is a list of (name, function, workers) tuples. Each function is
+        called with the item being processed and returns the item for the next stage.'''
+        self.stages = stages
+
+    def run(self, items):
+        '''Process all items. Returns a list of (item, failed_stage, exception) tuples in
+        input order, where failed_stage and exception are None when all stages passed.'''
+        items = list(items)
+        results = [None] * len(items)
+        if not items:
+            return results
+
+        lock = threading.Lock()
+        finished = threading.Event()
+        remaining = [len(items)]
+        executors = [ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix=name)
+                     for name, _, workers in self.stages]
+
+        def finish(index, item, stage, exc):
+            results[index] = (item, stage, exc)
+            with lock:
+                remaining[0] -= 1
+                if not remaining[0]:
+                    finished.set()
+
+        def submit(index, stage_index, item):
+            if stage_index == len(self.stages):
+                finish(index, item, None, None)
+                return
+            function = self.stages[stage_index][1]
+            future = executors[stage_index].submit(function, item)
+            future.add_done_callback(
+                lambda future: advance(index, stage_index, item, future))
+
+        def advance(index, stage_index, item, future):
+            exc = future.exception()
+            if exc:
+                finish(index, item, self.stages[stage_index][0], exc)
+            else:
+                submit(index, stage_index + 1, future.result())
+
+        try:
+            for index, item in enumerate(items):
+                submit(index, 0, item)
+            finished.wait()
+        finally:
+            for executor in executors:
+                executor.shutdown(wait=True)
+        return results
+
+
+class RateLimiter:
+    '''Limits the rate at which threads proceed to a given number per second'''
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self):
+        '''Wait until the calling thread may proceed'''
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
@@ -1,15 +1,22 @@
 '''Helper utilities'''
 import base64
+import codecs
+import gzip
+import hashlib
+import itertools
+import json
 import plistlib
 import logging
 import os
-import shutil
+import re
+import stat
 import sys
+import time
+from datetime import datetime, timedelta, timezone
 
-from zipfile import is_zipfile, ZipFile
-
-from pyaxmlparser import APK
+from zipfile import is_zipfile, ZipFile, ZipInfo, ZIP_DEFLATED
 
+from aps_axml import parse_manifest
 from aps_exceptions import ApsException
 
 LOGGER = logging.getLogger(__name__)
@@ -41,27 +48,277 @@ def get_config(args):
     LOGGER.debug('Constructed config object %s', repr(config))
     return config
 
+def get_cache_dir():
+    '''Returns the folder holding locally cached APS data, creating it if needed.
+    The folder can be set with the APS_CACHE_DIR environment variable. When it cannot be
+    created the path is still returned: the local caches then do not persist anything.'''
+    path = os.environ.get('APS_CACHE_DIR') or \
+        os.path.join(os.path.expanduser('~'), '.cache', 'aps')
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError as e:
+        LOGGER.debug(f'Failed to create cache folder {path}: {e}')
+    return path
+
 def get_api_gw_url(config, rest_api_id):
     ''''Returns the API Gateway URL to use for a specific path'''
     return config['api_gateway_url'].format(rest_api_id=rest_api_id)
 
 
+def iter_json_stream(chunks):
+    '''Incrementally parse a JSON document received as a sequence of byte chunks.
+    The elements of a top level array are yielded as soon as each has been received.
+    Any other top level value is yielded once the whole document has been received.'''
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    # None before the document starts, then 'value' or 'separator' while inside the
+    # top level array, 'done' after it, or 'document' when it is not an array.
+    state = None
+    for chunk in itertools.chain(chunks, [None]):
+        final = chunk is None
+        buffer += text_decoder.decode(chunk or b'', final)
+        pos = 0
+        while state not in ['done', 'document']:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos == len(buffer):
+                break
+            char = buffer[pos]
+            if state is None:
+                if char == '[':
+                    state = 'value'
+                    pos += 1
+                else:
+                    state = 'document'
+            elif char == ']':
+                state = 'done'
+                pos += 1
+            elif state == 'separator':
+                if char != ',':
+                    raise ValueError(f'Unexpected character {char!r} in JSON array')
+                state = 'value'
+                pos += 1
+            else:
+                try:
+                    value, end = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    break
+                # A value ending with the buffer may be a truncated number
+                if end == len(buffer) and not final:
+                    break
+                yield value
+                pos = end
+                state = 'separator'
+        buffer = buffer[pos:]
+
+    if state == 'document':
+        yield json.loads(buffer)
+    elif state != 'done':
+        raise ValueError('Truncated JSON document')
+
+# Fields of statistics responses holding counts of events, which add up over
+# consecutive time ranges. Statistics with other fields which differ between ranges
+# cannot be merged.
+STATISTICS_ADDITIVE_FIELDS = ['builds', 'protections', 'protectedBuilds', 'failedBuilds',
+                              'uploads', 'downloads']
+
+# Build record fields holding the build's creation time and its storage size
+BUILD_TIME_FIELD = 'createdAt'
+BUILD_SIZE_FIELD = 'fileSize'
+
+PEM_CERTIFICATE_PATTERN = re.compile(
+    rb'-----BEGIN CERTIFICATE-----(.+?)-----END CERTIFICATE-----', re.DOTALL)
+
+def parse_timestamp(value):
+    '''Returns the epoch seconds of a timestamp given either as epoch seconds,
+    epoch milliseconds or an ISO 8601 string, or None if it cannot be parsed'''
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        # Values this large cannot be seconds, so they are milliseconds
+        return value / 1000 if value > 1e11 else float(value)
+    if isinstance(value, str):
+        try:
+            timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+        if not timestamp.tzinfo:
+            timestamp = timestamp.replace(tzinfo=timezone.utc)
+        return timestamp.timestamp()
+    return None
+
+def get_build_time(build, field=BUILD_TIME_FIELD):
+    '''Returns a time of a build record in epoch seconds, by default its creation time,
+    or None if the record has no readable time'''
+    return parse_timestamp(build.get(field))
+
+def get_build_size(build):
+    '''Returns the storage size of a build record in bytes, or None'''
+    size = build.get(BUILD_SIZE_FIELD)
+    return size if isinstance(size, (int, float)) and not isinstance(size, bool) else None
+
+def select_builds(builds, older_than=None, states=None, keep_last=None,
+                  excluded_states=(), now=None):
+    '''Select the builds to prune: older than older_than days and/or in one of the given
+    states, except the keep_last most recent builds of each application and builds in
+    one of the excluded states. Builds whose creation time cannot be read are never
+    selected when the selection depends on it, and an ApsException is raised when no
+    build has one. Returns the list of selected builds.'''
+    now = now or time.time()
+    kept = set()
+    if older_than is not None or keep_last is not None:
+        untimed = [build['id'] for build in builds if get_build_time(build) is None]
+        if builds and len(untimed) == len(builds):
+            raise ApsException(f'None of the {len(builds)} builds has a readable '
+                               f'{BUILD_TIME_FIELD} time, builds cannot be selected by age')
+        for build_id in untimed:
+            LOGGER.warning(f'Build {build_id} has no {BUILD_TIME_FIELD} time, '
+                           'it is not pruned')
+        kept.update(untimed)
+    if keep_last is not None:
+        by_application = {}
+        for build in builds:
+            if build['id'] not in kept:
+                by_application.setdefault(build.get('applicationId'), []).append(build)
+        for application_builds in by_application.values():
+            application_builds.sort(key=get_build_time, reverse=True)
+            kept.update(build['id'] for build in application_builds[:keep_last])
+
+    selected = []
+    for build in builds:
+        if build['id'] in kept or build.get('state') in excluded_states:
+            continue
+        if states and build.get('state') not in states:
+            continue
+        if older_than is not None and now - get_build_time(build) < older_than * 86400:
+            continue
+        selected.append(build)
+    return selected
+
+def get_permission_fields(permissions):
+    '''Returns the permission fields of an application record for a dict of private,
+    no_upload and no_delete flags. A private application allows no uploads or deletes.'''
+    return {
+        'permissionPrivate': permissions['private'],
+        'permissionUpload': False if permissions['private'] else not permissions['no_upload'],
+        'permissionDelete': False if permissions['private'] else not permissions['no_delete'],
+    }
+
+def certificate_fingerprint(path):
+    '''Returns the SHA-256 fingerprint (lowercase hex) of the first certificate of a PEM
+    file, or the SHA-256 digest of the file if it holds no PEM certificate'''
+    with open(path, 'rb') as file_handle:
+        data = file_handle.read()
+    match = PEM_CERTIFICATE_PATTERN.search(data)
+    if match:
+        try:
+            data = base64.b64decode(b''.join(match.group(1).split()), validate=True)
+        except ValueError:
+            pass
+    return hashlib.sha256(data).hexdigest()
+
+def is_xcarchive_dir(file):
+    '''Is the input an (unzipped) xcarchive folder'''
+    return file.rstrip(os.sep).endswith('.xcarchive') and os.path.isdir(file)
+
+EPOCH = datetime(1970, 1, 1)
+
+def split_time_range(start, end, bucket_size, closed_before):
+    '''Split the time range [start, end) of naive datetimes into buckets of bucket_size
+    seconds, aligned on multiples of bucket_size since the epoch. Returns a list of
+    (start, end, closed) tuples. closed is True for complete buckets ending before the
+    closed_before datetime; the partial buckets at either end of the range and buckets
+    still receiving data are not closed.'''
+    start_seconds = (start - EPOCH).total_seconds()
+    end_seconds = (end - EPOCH).total_seconds()
+    closed_seconds = (closed_before - EPOCH).total_seconds()
+    if end_seconds <= start_seconds:
+        return [(start, end, False)]
+
+    def to_datetime(seconds):
+        return EPOCH + timedelta(seconds=seconds)
+
+    segments = []
+    bucket_start = -(-start_seconds // bucket_size) * bucket_size
+    if start_seconds < bucket_start:
+        segments.append((start, to_datetime(min(bucket_start, end_seconds)), False))
+    while bucket_start < end_seconds:
+        bucket_end = bucket_start + bucket_size
+        if bucket_end <= end_seconds:
+            segments.append((to_datetime(bucket_start), to_datetime(bucket_end),
+                             bucket_end <= closed_seconds))
+        else:
+            segments.append((to_datetime(bucket_start), end, False))
+        bucket_start = bucket_end
+    return segments
+
+def merge_statistics(responses, additive_fields=STATISTICS_ADDITIVE_FIELDS):
+    '''Merge statistics responses of consecutive time ranges into the response for the
+    whole range. Objects are merged recursively, and the numbers in additive_fields
+    (including the numbers in objects held by these fields) are added up. Any other
+    value must be the same in all responses. Returns None when the responses cannot be
+    merged this way.'''
+    def merge(values, additive):
+        if all(isinstance(value, dict) for value in values):
+            merged = {}
+            for key in dict.fromkeys(key for value in values for key in value):
+                present = [value[key] for value in values if key in value]
+                key_additive = additive or key in additive_fields
+                if len(present) < len(values) and not key_additive:
+                    raise ValueError(key)
+                merged[key] = merge(present, key_additive)
+            return merged
+        if additive and all(isinstance(value, (int, float)) and not isinstance(value, bool)
+                            for value in values):
+            return sum(values)
+        if any(value != values[0] for value in values):
+            raise ValueError(values)
+        return values[0]
+
+    if not responses:
+        return None
+    try:
+        return merge(list(responses), False)
+    except ValueError as e:
+        LOGGER.debug(f'Statistics cannot be merged, {e} is not additive')
+        return None
+
 def get_os(file):
     '''Deduce the OS based on the file extension'''
     if file.endswith('.apk') or file.endswith('.aab'):
         return 'android'
-    if file.endswith('.xcarchive.zip'):
+    if file.endswith('.xcarchive.zip') or is_xcarchive_dir(file):
         return 'ios'
-    raise ApsException('Unsupported file suffix (not apk or .xcarchive.zip)')
+    raise ApsException('Unsupported file suffix (not apk, .xcarchive or .xcarchive.zip)')
+
+def get_upload_name(file, compress=False):
+    '''Name under which a build file is uploaded. xcarchive folders are uploaded zipped,
+    and gzip compressed files get a .gz suffix.'''
+    if is_xcarchive_dir(file):
+        return f'{os.path.basename(file.rstrip(os.sep))}.zip'
+    if compress:
+        return f'{os.path.basename(file)}.gz'
+    return os.path.basename(file)
+
+# Size of the chunks in which zip entries are read and base64 encoded. A multiple
+# of 3 so that the encoded chunks can simply be concatenated.
+ZIP_READ_CHUNK_SIZE = 3 * 65536
+
+# Size of the chunks in which files are read for on the fly compression
+COMPRESS_CHUNK_SIZE = 1048576
 
 def extract_file_data_from_zip(zipfile, file):
-    '''Unzip a particular file from a zip archive'''
-    filepath = zipfile.extract(file)
-    data = ''
-    with open(filepath, 'rb') as file_handle:
-        data = base64.b64encode(file_handle.read()).decode('utf-8')
-    os.remove(filepath)
-    return data
+    '''Read a particular file from a zip archive and return it base64 encoded. The
+    entry is decompressed in memory, nothing is written to disk.'''
+    encoded = []
+    with zipfile.open(file) as file_handle:
+        while True:
+            chunk = file_handle.read(ZIP_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            encoded.append(base64.b64encode(chunk).decode('utf-8'))
+    return ''.join(encoded)
 
 ALLOWED_SUFFIXES = ['.apk', '.aab', '.xcarchive.zip']
 
@@ -69,59 +326,209 @@ def extract_version_info(file):
     '''Extract application information from the input file to be protected'''
     version_info = {}
 
+    if is_xcarchive_dir(file):
+        version_info.update(extract_plists_from_dir(file))
+        return version_info
+
     suffix_ok = False
     for _, suffix in enumerate(ALLOWED_SUFFIXES):
         if file.endswith(suffix):
             suffix_ok = True
     if not suffix_ok:
-        LOGGER.critical('Error, input file must be an aab, apk or zipped xcarchive')
-        raise ApsException('Error, input file must be an aab, apk or zipped xcarchive')
+        LOGGER.critical('Error, input file must be an aab, apk or (zipped) xcarchive')
+        raise ApsException('Error, input file must be an aab, apk or (zipped) xcarchive')
 
     if not is_zipfile(file):
         LOGGER.critical('Error, input file is not in zipped format')
         raise ApsException('Error, input file is not in zipped format')
 
-    # Extract the AndroidManifest.xml or Info.plist from the input zip file
-    # and base64 encode it. Delete the file after unzipping.
-    zipfile = ZipFile(file)
-    if file.endswith('.apk'):
-        version_info['androidManifest'] = extract_file_data_from_zip(zipfile,
-                                                                     'AndroidManifest.xml')
-    elif file.endswith('.aab'):
-        version_info['androidManifestProtobuf'] = \
-            extract_file_data_from_zip(zipfile, 'base/manifest/AndroidManifest.xml')
-    else:
-        # Get the folder name of the unzipped archive
-        dirname = None
-        namelist = zipfile.namelist()
-        for name in namelist:
-            if not name.startswith('.'):
-                dirname = os.path.dirname(name)
-                break
+    # Read the AndroidManifest.xml or Info.plist from the input zip file
+    # and base64 encode it.
+    with ZipFile(file) as zipfile:
+        if file.endswith('.apk'):
+            version_info['androidManifest'] = extract_file_data_from_zip(zipfile,
+                                                                         'AndroidManifest.xml')
+        elif file.endswith('.aab'):
+            version_info['androidManifestProtobuf'] = \
+                extract_file_data_from_zip(zipfile, 'base/manifest/AndroidManifest.xml')
+        else:
+            version_info.update(extract_plists_from_zip(zipfile))
 
-        for name in namelist:
-            if '.app/Info.plist' in name and name.count('.app/') == 1:
-                version_info['iosBinaryPlist'] = extract_file_data_from_zip(zipfile, name)
+    return version_info
 
-            if f'{dirname}/Info.plist' == name:
-                version_info['iosXmlPlist'] = extract_file_data_from_zip(zipfile, name)
-        if dirname:
-            shutil.rmtree(dirname)
+def extract_plists_from_zip(zipfile):
+    '''Find the Info.plist files of a zipped xcarchive in a single pass over its
+    central directory and return them base64 encoded'''
+    # The folder name of the archive is that of its first entry
+    dirname = None
+    binary_plist = xml_plist = None
+    for name in zipfile.namelist():
+        if dirname is None and not name.startswith('.'):
+            dirname = os.path.dirname(name)
 
-    return version_info
+        if '.app/Info.plist' in name and name.count('.app/') == 1:
+            binary_plist = name
+
+        if dirname is not None and f'{dirname}/Info.plist' == name:
+            xml_plist = name
+
+    plists = {}
+    if binary_plist:
+        plists['iosBinaryPlist'] = extract_file_data_from_zip(zipfile, binary_plist)
+    if xml_plist:
+        plists['iosXmlPlist'] = extract_file_data_from_zip(zipfile, xml_plist)
+    return plists
+
+def extract_plists_from_dir(path):
+    '''Find the Info.plist files of an xcarchive folder and return them base64 encoded'''
+    plists = {}
+    xml_plist = os.path.join(path, 'Info.plist')
+    if os.path.isfile(xml_plist):
+        with open(xml_plist, 'rb') as file_handle:
+            plists['iosXmlPlist'] = base64.b64encode(file_handle.read()).decode('utf-8')
+
+    for dirpath, dirnames, _ in os.walk(path):
+        dirnames.sort()
+        for name in [name for name in dirnames if name.endswith('.app')]:
+            # Apps nested inside the app (e.g. watch apps) are not the main app
+            dirnames.remove(name)
+            binary_plist = os.path.join(dirpath, name, 'Info.plist')
+            if 'iosBinaryPlist' not in plists and os.path.isfile(binary_plist):
+                with open(binary_plist, 'rb') as file_handle:
+                    plists['iosBinaryPlist'] = \
+                        base64.b64encode(file_handle.read()).decode('utf-8')
+    return plists
+
+
+class ZipStreamWriter:
+    '''Non-seekable file object collecting the output of a ZipFile or GzipFile, so that
+    an archive can be produced piece by piece without writing it anywhere'''
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self, size):
+        '''Yield the collected data in pieces of the given size, keeping the remainder'''
+        while self.size >= size:
+            data = b''.join(self.chunks)
+            self.chunks = [data[size:]]
+            self.size -= size
+            yield data[:size]
+
+    def take_all(self):
+        '''Returns all collected data'''
+        data = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+def iter_zip_stream(path, part_size):
+    '''Zip a folder on the fly and yield the archive in parts of part_size bytes (the last
+    one may be shorter). Entry names are relative to the folder's parent, symbolic links
+    are stored as links, and the output is the same every time for unchanged input.'''
+    path = os.path.abspath(path.rstrip(os.sep))
+    parent = os.path.dirname(path)
+    writer = ZipStreamWriter()
+    with ZipFile(writer, 'w', ZIP_DEFLATED) as zipfile:
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            arcdir = os.path.relpath(dirpath, parent)
+            zipfile.writestr(ZipInfo.from_file(dirpath, arcdir, strict_timestamps=False), b'')
+
+            # Links to folders are listed with the folders, but not walked into
+            links = [name for name in dirnames if os.path.islink(os.path.join(dirpath, name))]
+            dirnames[:] = [name for name in dirnames if name not in links]
+            for name in sorted(filenames + links):
+                full_path = os.path.join(dirpath, name)
+                arcname = os.path.join(arcdir, name)
+                if os.path.islink(full_path):
+                    # Zip timestamps cannot be older than 1980
+                    info = ZipInfo(arcname, time.localtime(
+                        max(os.lstat(full_path).st_mtime, 315619200))[:6])
+                    info.create_system = 3
+                    info.external_attr = (stat.S_IFLNK | 0o755) << 16
+                    zipfile.writestr(info, os.readlink(full_path))
+                else:
+                    info = ZipInfo.from_file(full_path, arcname, strict_timestamps=False)
+                    info.compress_type = ZIP_DEFLATED
+                    with open(full_path, 'rb') as source, zipfile.open(info, 'w') as dest:
+                        while True:
+                            chunk = source.read(ZIP_READ_CHUNK_SIZE)
+                            if not chunk:
+                                break
+                            dest.write(chunk)
+                            yield from writer.take(part_size)
+                yield from writer.take(part_size)
+
+    # Closing the archive wrote its central directory
+    yield from writer.take(part_size)
+    if writer.size:
+        yield writer.take_all()
+
+def iter_gzip_stream(path, part_size):
+    '''Compress a file with gzip on the fly and yield the compressed data in parts of
+    part_size bytes (the last one may be shorter). The output is the same every time for
+    unchanged input.'''
+    writer = ZipStreamWriter()
+    with open(path, 'rb') as file_handle, \
+         gzip.GzipFile(filename='', mode='wb', fileobj=writer, mtime=0) as gzip_file:
+        while True:
+            data = file_handle.read(COMPRESS_CHUNK_SIZE)
+            if not data:
+                break
+            gzip_file.write(data)
+            yield from writer.take(part_size)
+    yield from writer.take(part_size)
+    if writer.size:
+        yield writer.take_all()
+
+def iter_file_parts(file, part_size, skip=0, compress=False):
+    '''Yield the content of a build file in parts of part_size bytes, skipping the first
+    skip parts. xcarchive folders are zipped on the fly, and files are gzip compressed on
+    the fly when compress is True.'''
+    if is_xcarchive_dir(file) or compress:
+        stream = iter_zip_stream if is_xcarchive_dir(file) else iter_gzip_stream
+        for index, data in enumerate(stream(file, part_size)):
+            if index >= skip:
+                yield data
+        return
+
+    with open(file, 'rb') as file_handle:
+        file_handle.seek(skip * part_size)
+        while True:
+            data = file_handle.read(part_size)
+            if not data:
+                break
+            yield data
 
 
 def extract_package_id(file):
     '''Extract application package ID from binary file'''
+    if file.endswith('.aab'):
+        LOGGER.error('Cannot display application package ID for aab files')
+        return None
+
+    return get_package_id(extract_version_info(file))
+
+def get_package_id(version_info):
+    '''Get the application package ID from the version info of a binary file. Returns
+    None for aab files, whose protobuf manifest is not parsed.'''
     try:
-        if file.endswith('.aab'):
-            LOGGER.error('Cannot display application package ID for aab files')
+        if 'androidManifestProtobuf' in version_info:
             return None
-
-        version_info = extract_version_info(file)
         if 'androidManifest' in version_info:
-            apk = APK(file)
-            return apk.package
+            manifest = parse_manifest(base64.b64decode(version_info['androidManifest']))
+            LOGGER.info(f'Extracted manifest: {manifest}')
+            return manifest['package']
         elif 'iosXmlPlist' in version_info:
             data = version_info['iosXmlPlist']
             plist = plistlib.loads(base64.b64decode(data))
@@ -135,7 +542,7 @@ def extract_package_id(file):
         else:
             raise ApsException('Unsupported file type')
     except Exception as e:
-        LOGGER.error('Failed to extract application package ID: {e}')
+        LOGGER.error(f'Failed to extract application package ID: {e}')
         raise ApsException(e) from e
 
 
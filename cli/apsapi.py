@@ -3,30 +3,90 @@ import json
 import logging
 import os
 import shutil
+import threading
 import time
 import mimetypes
-from datetime import datetime
-import dateutil.parser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 
 from aps_utils import (
     get_config, disable_boto_logging, extract_package_id, get_api_gw_url,
-    get_os, extract_version_info, LOGGER)
+    get_os, get_upload_name, is_xcarchive_dir, iter_file_parts, iter_json_stream,
+    get_build_size, get_permission_fields, merge_statistics,
+    select_builds, split_time_range, BUILD_SIZE_FIELD, LOGGER)
 from aps_credentials import authenticate_api_key
-from aps_exceptions import ApsException
-from aps_requests import ApsRequest
+from aps_exceptions import (
+    ApsDeadlineException, ApsErrorResponseException, ApsException, ApsTaskException)
+from aps_requests import (
+    ApsRequest, check_deadline, cleanup_deadline, deadline, remaining_time)
 
 OPENAPI_VERSION = '1.1.0'
 
 PROTECT_STATES = ['protect_queue', 'protect_in_progress']
 
+# Timing phases of the time a build spends in each protection state
+PROTECT_STATE_PHASES = {'protect_queue': 'queue', 'protect_in_progress': 'protect'}
+
 # S3 multipart upload has a minimum part size of 5Mb
 PART_SIZE=5242880
 
+# Initial delay when retrying a listing that does not yet reflect our own writes. The
+# delay doubles on each retry and the total wait is bounded by ApsApi.wait_seconds.
+CONSISTENCY_RETRY_DELAY = 0.1
+
+# Seconds after which a write of this client is assumed to be reflected by listings, so
+# it is no longer tracked. This bounds the writes tracked by long lived clients.
+CONSISTENCY_WINDOW = 60
+
+# Size of the chunks in which listings are streamed
+LISTING_CHUNK_SIZE = 65536
+
+# Size of the chunks in which protected files are downloaded
+DOWNLOAD_CHUNK_SIZE = 1048576
+
+# Interval in seconds between polls of the protection state
+PROTECT_POLL_INTERVAL = 10
+
+# File into which protect_download writes the name of the downloaded file
+PROTECT_RESULT_FILE = 'protect_result.txt'
+
+# Time in seconds the account info is cached when the server does not say otherwise.
+# It includes usage counts, so it is cached for less time than other responses.
+ACCOUNT_INFO_TTL = 60
+
+# Statistics are fetched and cached in buckets of this many seconds
+STATISTICS_BUCKET_SIZE = 86400
+
+# Time in seconds after the end of a bucket before its statistics are considered final
+STATISTICS_SETTLE_TIME = 3600
+
+# Number of statistics buckets fetched at the same time
+STATISTICS_WORKERS = 4
+
+# Default number of worker threads for each stage of protect_many
+PROTECT_MANY_WORKERS = {
+    'inspect': 2,
+    'build': 4,
+    'upload': 2,
+    'protect': 8,
+    'download': 2,
+}
+
 
 def upload_data(url, data):
     '''Upload data to S3'''
     return ApsRequest.put(url, data=data)
 
+def iter_records(response):
+    '''Iterate over the records of a listing response. A response which is not a list
+    is a single record, unless it is an error.'''
+    if isinstance(response, list):
+        yield from response
+    elif 'errorMessage' in response:
+        raise ApsErrorResponseException(response)
+    else:
+        yield response
+
 def construct_headers(token):
     '''Construct HTTP headers to be sent in all requests to APS API endpoint'''
     version = OPENAPI_VERSION
@@ -45,6 +105,25 @@ class ApsApi():
         self.vmx_platform = kwargs.pop('vmx_platform', False)
         self.wait_seconds = kwargs.pop('wait_seconds', 2)
         self.rest_api_id = kwargs.pop('rest_api_id', '')
+        # Lifetime of the local application index entries, by default APPLICATION_INDEX_TTL
+        self.application_index_ttl = kwargs.pop('application_index_ttl', None)
+        self.application_index = None
+        self.job_store = None
+        self.metadata_cache = None
+        self.statistics_store = None
+        self.http_cache = None
+        self.applied_settings = None
+        # Callback receiving progress events of transfers and protections, see aps_progress
+        self.progress = kwargs.pop('progress', None)
+        # Interval in seconds at which the RSS is sampled for the timing report, if any
+        self.rss_interval = kwargs.pop('rss_interval', None)
+        # Upload mapping files gzip compressed, unless set_mapping_file says otherwise
+        self.compress_mapping_files = kwargs.pop('compress_mapping_files', False)
+        # Cache responses of read-mostly endpoints locally, see cached_get
+        self.use_http_cache = kwargs.pop('use_http_cache', True)
+        # Skip sending a signing certificate this client recorded setting before, see
+        # update_signing_certificate
+        self.skip_applied_certificates = kwargs.pop('skip_applied_certificates', False)
         self.authenticated = False
         self.tokenExpiration = 0
         self.headers = None
@@ -53,6 +132,19 @@ class ApsApi():
         self.api_key_scope = None
         self.api_gw_url = get_api_gw_url(self.config, self.rest_api_id)
 
+        # Records written by this client that listings are expected to reflect, keyed by
+        # id. The value is a dict of expected field values, or None for a deleted record.
+        self.recent_writes = {'applications': {}, 'builds': {}}
+        # Monotonic times of the recent writes, oldest first
+        self.recent_write_times = {'applications': {}, 'builds': {}}
+
+        # Guards authentication state and recent_writes, which may be shared between
+        # threads (e.g. by protect_many).
+        self.lock = threading.RLock()
+        # Serializes find_or_add_application so concurrent protections of the same
+        # package do not each add an application.
+        self.application_lock = threading.Lock()
+
         verbose_logs = kwargs.pop('verbose_logs', False)
         if not verbose_logs:
             disable_boto_logging()
@@ -66,18 +158,19 @@ class ApsApi():
         if not self.api_key:
             raise Exception("Attempt to ensure authenticated but have no API key")
 
-        if not self.authenticated:
-            '''Not authenticated'''
-            LOGGER.debug(f'Not authenticated yet, will proceed to get token')
-            self.authenticate_api_key(self.api_key_id, self.api_key,scope=self.api_key_scope)
+        with self.lock:
+            if not self.authenticated:
+                '''Not authenticated'''
+                LOGGER.debug(f'Not authenticated yet, will proceed to get token')
+                self.authenticate_api_key(self.api_key_id, self.api_key,scope=self.api_key_scope)
 
-        current_time = time.time()
-        LOGGER.debug(f'Evaluating needs to re-authenticate {self.tokenExpiration} vs {current_time}')
+            current_time = time.time()
+            LOGGER.debug(f'Evaluating needs to re-authenticate {self.tokenExpiration} vs {current_time}')
 
-        if self.authenticated and (current_time+45 > self.tokenExpiration):
-            '''Token about to expire, will authenticate'''
-            LOGGER.debug(f'Authenticated but token will expire shortly, will proceed to get token')
-            self.authenticate_api_key(self.api_key_id, self.api_key,scope=self.api_key_scope)
+            if self.authenticated and (current_time+45 > self.tokenExpiration):
+                '''Token about to expire, will authenticate'''
+                LOGGER.debug(f'Authenticated but token will expire shortly, will proceed to get token')
+                self.authenticate_api_key(self.api_key_id, self.api_key,scope=self.api_key_scope)
 
     def authenticate_api_key(self, api_key_id, api_key, **kwargs):
 
@@ -97,11 +190,169 @@ class ApsApi():
         self.headers = construct_headers(token)
         self.authenticated = True
 
+    def get_application_index(self):
+        '''Returns the local application index for the authenticated account'''
+        from aps_cache import ( # pylint: disable=import-outside-toplevel
+            APPLICATION_INDEX_TTL, ApplicationIndex)
+        with self.lock:
+            if not self.application_index:
+                ttl = self.application_index_ttl
+                self.application_index = ApplicationIndex(
+                    [self.api_gw_url, self.api_key_id],
+                    APPLICATION_INDEX_TTL if ttl is None else ttl)
+            return self.application_index
+
+    def get_job_store(self):
+        '''Returns the local store of protection jobs for the authenticated account'''
+        from aps_jobs import JobStore # pylint: disable=import-outside-toplevel
+        with self.lock:
+            if not self.job_store:
+                self.job_store = JobStore(json.dumps([self.api_gw_url, self.api_key_id]))
+            return self.job_store
+
+    def get_statistics_store(self):
+        '''Returns the local store of statistics for the authenticated account'''
+        from aps_cache import StatisticsStore # pylint: disable=import-outside-toplevel
+        with self.lock:
+            if not self.statistics_store:
+                self.statistics_store = StatisticsStore([self.api_gw_url, self.api_key_id],
+                                                        STATISTICS_BUCKET_SIZE)
+            return self.statistics_store
+
+    def get_applied_settings(self):
+        '''Returns the local record of the settings files applied to applications'''
+        from aps_cache import AppliedSettings # pylint: disable=import-outside-toplevel
+        with self.lock:
+            if not self.applied_settings:
+                self.applied_settings = AppliedSettings([self.api_gw_url, self.api_key_id])
+            return self.applied_settings
+
+    def get_http_cache(self):
+        '''Returns the local cache of responses of read-mostly endpoints, or None when
+        caching is disabled or the cache folder cannot be created'''
+        from aps_cache import HttpCache # pylint: disable=import-outside-toplevel
+        with self.lock:
+            if self.http_cache is None and self.use_http_cache:
+                try:
+                    self.http_cache = HttpCache()
+                except OSError as e:
+                    LOGGER.warning(f'Cannot create the response cache, caching disabled: {e}')
+                    self.use_http_cache = False
+            return self.http_cache
+
+    def cached_get(self, url, **kwargs):
+        '''GET a read-mostly resource of the authenticated account through the local
+        response cache. Responses are cached per API key and authentication scope.'''
+        self.ensure_authenticated()
+        return ApsRequest.cached_get(url, self.get_http_cache(),
+                                     [self.api_gw_url, self.api_key_id, self.api_key_scope],
+                                     headers=self.headers, **kwargs)
+
+    def get_metadata_cache(self):
+        '''Returns the local cache of build file metadata'''
+        from aps_cache import BuildMetadataCache # pylint: disable=import-outside-toplevel
+        with self.lock:
+            if not self.metadata_cache:
+                self.metadata_cache = BuildMetadataCache()
+            return self.metadata_cache
+
+    def get_build_metadata(self, file):
+        '''Returns the versionInfo, packageId and os of a build file, from the local
+        metadata cache when the file was inspected before'''
+        from aps_metrics import timed_phase # pylint: disable=import-outside-toplevel
+        with timed_phase('inspect'):
+            return self.get_metadata_cache().get(file)
+
+    def validate_build(self, file):
+        '''Check a build file locally for problems APS would reject it for'''
+        from aps_preflight import validate_build # pylint: disable=import-outside-toplevel
+        return validate_build(file, self.get_metadata_cache())
+
+    def preflight(self, file):
+        '''Check a build file locally before it is added. Returns an error response
+        for the first problem found, or None.'''
+        from aps_metrics import timed_phase # pylint: disable=import-outside-toplevel
+        from aps_preflight import check_build, get_error # pylint: disable=import-outside-toplevel
+        with timed_phase('preflight'):
+            errors = check_build(file, self.get_metadata_cache())
+        if not errors:
+            return None
+        error = get_error(errors[0])
+        LOGGER.error(f'Preflight check of {file} failed: {error["errorMessage"]}: '
+                     f'{error["message"]}')
+        return error
+
+    def remember_write(self, kind, record_id, expected=None):
+        '''Remember a record created or changed by this client (or deleted when expected
+        is None) so that the next listing of that kind waits until it reflects the write'''
+        if record_id:
+            with self.lock:
+                self.expire_writes(kind)
+                self.recent_writes[kind][record_id] = expected
+                self.recent_write_times[kind].pop(record_id, None)
+                self.recent_write_times[kind][record_id] = time.monotonic()
+
+    def expire_writes(self, kind):
+        '''Stop tracking the writes made more than CONSISTENCY_WINDOW seconds ago'''
+        times = self.recent_write_times[kind]
+        limit = time.monotonic() - CONSISTENCY_WINDOW
+        for record_id, written in list(times.items()):
+            if written > limit:
+                break
+            del times[record_id]
+            self.recent_writes[kind].pop(record_id, None)
+
+    def list_consistent(self, kind, fetch, matches_filter):
+        '''Fetch a listing which is Eventually Consistent on the backend.
+
+        The listing is returned straight away unless it is missing writes made by this
+        client, in which case it is fetched again with a short backoff until it reflects
+        them or until wait_seconds have elapsed.'''
+        from aps_metrics import timed_phase # pylint: disable=import-outside-toplevel
+        with self.lock:
+            self.expire_writes(kind)
+            pending = {record_id: expected
+                       for record_id, expected in self.recent_writes[kind].items()
+                       if expected is None or matches_filter(expected)}
+        delay = CONSISTENCY_RETRY_DELAY
+        deadline = time.time() + self.wait_seconds
+        while True:
+            items = fetch()
+            if not pending or not isinstance(items, list):
+                return items
+
+            listed = {item.get('id'): item for item in items}
+            missing = []
+            for record_id, expected in pending.items():
+                item = listed.get(record_id)
+                if expected is None:
+                    if item is not None:
+                        missing.append(record_id)
+                elif item is None or \
+                     any(item.get(key) != value for key, value in expected.items()):
+                    missing.append(record_id)
+
+            remaining = deadline - time.time()
+            if not missing or remaining <= 0:
+                if missing:
+                    LOGGER.debug(f'Listing of {kind} still does not reflect {missing}')
+                # Either way stop tracking these writes, so we do not wait on them again
+                with self.lock:
+                    for record_id in pending:
+                        self.recent_writes[kind].pop(record_id, None)
+                        self.recent_write_times[kind].pop(record_id, None)
+                return items
+
+            LOGGER.debug(f'Listing of {kind} does not yet reflect {missing}, '
+                         f'retrying in {min(delay, remaining):.2f}s')
+            with timed_phase('consistency_wait'):
+                time.sleep(min(delay, remaining))
+            delay *= 2
+
     def get_account_info(self):
         '''Return account info'''
         url = f'{self.api_gw_url}/report/account'
-        self.ensure_authenticated()
-        response = ApsRequest.get(url, headers=self.headers)
+        response = self.cached_get(url, ttl=ACCOUNT_INFO_TTL)
         LOGGER.debug(f'Response headers: {response.headers}')
         LOGGER.debug(f'Get account info response: {response.json()}')
         return response.json()
@@ -113,9 +364,7 @@ class ApsApi():
         body = {}
         body['applicationName'] = name
         body['applicationPackageId'] = package_id
-        body['permissionPrivate'] = permissions['private']
-        body['permissionUpload'] = False if permissions['private'] else not permissions['no_upload']
-        body['permissionDelete'] = False if permissions['private'] else not permissions['no_delete']
+        body.update(get_permission_fields(permissions))
         body['os'] = os_name
         if group:
             body['group'] = group
@@ -125,7 +374,12 @@ class ApsApi():
         self.ensure_authenticated()
         response = ApsRequest.post(url, headers=self.headers, data=json.dumps(body))
         LOGGER.debug(f'Post application response: {response.json()}')
-        return response.json()
+        application = response.json()
+        if 'errorMessage' not in application:
+            expected = {key: body[key] for key in ['group', 'subscriptionType'] if key in body}
+            self.remember_write('applications', application.get('id'), expected)
+        self.get_application_index().invalidate(package_id=package_id, os_type=os_name)
+        return application
 
     def update_application(self, application_id, name, permissions):
         '''Update an application'''
@@ -133,16 +387,18 @@ class ApsApi():
 
         body = {}
         body['applicationName'] = name
-        body['permissionPrivate'] = permissions['private']
-        body['permissionUpload'] = False if permissions['private'] else not permissions['no_upload']
-        body['permissionDelete'] = False if permissions['private'] else not permissions['no_delete']
+        body.update(get_permission_fields(permissions))
         self.ensure_authenticated()
         response = ApsRequest.patch(url, headers=self.headers, data=json.dumps(body))
         LOGGER.debug(f'Update application response: {response.json()}')
-        return response.json()
-
-    def list_applications(self, application_id, group=None, subscription_type=None):
-        '''List applications'''
+        application = response.json()
+        if 'errorMessage' not in application:
+            self.remember_write('applications', application_id, body)
+        self.get_application_index().invalidate(application_id)
+        return application
+
+    def applications_request(self, application_id, group=None, subscription_type=None):
+        '''Returns the URL and parameters for listing applications'''
         params = {}
 
         if subscription_type:
@@ -154,18 +410,31 @@ class ApsApi():
             url = f'{self.api_gw_url}/applications'
             if group:
                 params['group'] = group
+        return url, params
 
-        # If not searching by application_id this operation on DynamoDB is Eventually Consistent
-        # so wait some time before starting (to ensure system tests using this module behave
-        # reliably).
-        if not application_id and self.wait_seconds:
-            time.sleep(self.wait_seconds)
+    def list_applications(self, application_id, group=None, subscription_type=None):
+        '''List applications'''
+        url, params = self.applications_request(application_id, group, subscription_type)
 
-        self.ensure_authenticated()
-        response = ApsRequest.get(url, headers=self.headers, params=params)
-        LOGGER.debug(f'Response headers: {response.headers}')
-        LOGGER.debug(f'Get applications response: {response.json()}')
-        return response.json()
+        def fetch():
+            self.ensure_authenticated()
+            response = ApsRequest.get(url, headers=self.headers, params=params)
+            LOGGER.debug(f'Response headers: {response.headers}')
+            LOGGER.debug(f'Get applications response: {response.json()}')
+            return response.json()
+
+        # Getting a single application by id is strongly consistent
+        if application_id:
+            return fetch()
+
+        # Otherwise this operation on DynamoDB is Eventually Consistent, so make sure the
+        # listing reflects any applications this client has just added or changed.
+        def matches_filter(expected):
+            if group and expected.get('group') != group:
+                return False
+            return expected.get('subscriptionType', subscription_type) == subscription_type
+
+        return self.list_consistent('applications', fetch, matches_filter)
 
     def delete_application(self, application_id):
         '''Delete an aplication'''
@@ -177,10 +446,25 @@ class ApsApi():
         self.ensure_authenticated()
         response = ApsRequest.delete(url, headers=self.headers)
         LOGGER.debug(f'Delete application response: {response.json()}')
-        return response.json()
-
-    def list_builds(self, application_id, build_id, subscription_type=None):
-        '''List builds'''
+        result = response.json()
+        if 'errorMessage' not in result:
+            self.remember_write('applications', application_id, None)
+        self.get_application_index().invalidate(application_id)
+        return result
+
+    def iter_applications(self, application_id=None, group=None, subscription_type=None):
+        '''Generator version of list_applications, yielding applications as they are
+        parsed from the streamed response rather than loading the whole listing'''
+        if not application_id and self.recent_writes['applications']:
+            # Pending writes need the listing checked as a whole
+            yield from iter_records(self.list_applications(application_id, group,
+                                                           subscription_type))
+            return
+        url, params = self.applications_request(application_id, group, subscription_type)
+        yield from self.iter_listing(url, params)
+
+    def builds_request(self, application_id, build_id, subscription_type=None):
+        '''Returns the URL and parameters for listing builds'''
         params = {}
         if build_id:
             url = f'{self.api_gw_url}/builds/{build_id}'
@@ -191,18 +475,52 @@ class ApsApi():
 
         if subscription_type:
             params['subscriptionType'] = subscription_type
+        return url, params
+
+    def iter_builds(self, application_id=None, build_id=None, subscription_type=None):
+        '''Generator version of list_builds, yielding builds as they are parsed from the
+        streamed response rather than loading the whole listing'''
+        if not build_id and self.recent_writes['builds']:
+            # Pending writes need the listing checked as a whole
+            yield from iter_records(self.list_builds(application_id, build_id,
+                                                     subscription_type))
+            return
+        url, params = self.builds_request(application_id, build_id, subscription_type)
+        yield from self.iter_listing(url, params)
+
+    def iter_listing(self, url, params):
+        '''Stream a listing, yielding each record as soon as it has been received'''
+        self.ensure_authenticated()
+        response = ApsRequest.get(url, headers=self.headers, params=params, stream=True)
+        with response:
+            for record in iter_json_stream(response.iter_content(LISTING_CHUNK_SIZE)):
+                if isinstance(record, dict) and 'errorMessage' in record:
+                    raise ApsErrorResponseException(record)
+                yield record
+
+    def list_builds(self, application_id, build_id, subscription_type=None):
+        '''List builds'''
+        url, params = self.builds_request(application_id, build_id, subscription_type)
 
-        # If not searching by build_id this operation on DynamoDB is Eventually Consistent
-        # so wait some time before starting (to ensure system tests using this module behave
-        # reliably).
-        if not build_id and self.wait_seconds:
-            time.sleep(self.wait_seconds)
+        def fetch():
+            self.ensure_authenticated()
+            response = ApsRequest.get(url, headers=self.headers, params=params)
+            builds = response.json()
+            LOGGER.debug(f'Listing builds for app_id:{application_id} build_id:{build_id} - {builds}')
+            return builds
 
-        self.ensure_authenticated()
-        response = ApsRequest.get(url, headers=self.headers, params=params)
-        builds = response.json()
-        LOGGER.debug(f'Listing builds for app_id:{application_id} build_id:{build_id} - {builds}')
-        return builds
+        # Getting a single build by id is strongly consistent
+        if build_id:
+            return fetch()
+
+        # Otherwise this operation on DynamoDB is Eventually Consistent, so make sure the
+        # listing reflects any builds this client has just added or changed.
+        def matches_filter(expected):
+            if application_id and expected.get('applicationId') != application_id:
+                return False
+            return expected.get('subscriptionType', subscription_type) == subscription_type
+
+        return self.list_consistent('builds', fetch, matches_filter)
 
     def create_build(self, application_id=None, subscription_type=None):
         '''Create a new build'''
@@ -217,18 +535,22 @@ class ApsApi():
         self.ensure_authenticated()
         response = ApsRequest.post(url, headers=self.headers, data=json.dumps(body))
         LOGGER.debug(f'Post build response: {response.json()}')
-        return response.json()
+        build = response.json()
+        if 'errorMessage' not in build:
+            self.remember_write('builds', build.get('id'), body)
+        return build
 
 
-    def set_build_metadata(self, build_id, file):
+    def set_build_metadata(self, build_id, file, version_info=None):
         '''Set build metadata'''
-        version_info = extract_version_info(file)
+        if version_info is None:
+            version_info = self.get_build_metadata(file)['versionInfo']
 
         # Inform the backend the file is going to be uploaded
         url = f'{self.api_gw_url}/builds/{build_id}/metadata'
 
         body = {}
-        body['os'] = 'ios' if file.endswith('.xcarchive.zip') else 'android'
+        body['os'] = get_os(file)
         body['osData'] = version_info
         self.ensure_authenticated()
         response = ApsRequest.put(url, headers=self.headers, data=json.dumps(body))
@@ -236,14 +558,18 @@ class ApsApi():
         return response.json()
 
 
-    def upload_start(self, build_id, file, artifact_type=None):
-        '''Start a multipart upload. Returns the upload_id and upload_name'''
+    def upload_start(self, build_id, file, artifact_type=None, compress=False):
+        '''Start a multipart upload. Returns the upload_id and upload_name. With compress
+        the upload is a gzip file, named after the file with a .gz suffix.'''
         url =  f'{self.api_gw_url}/uploads/{build_id}/start-upload'
 
-        upload_name = os.path.basename(file)
+        upload_name = get_upload_name(file, compress)
 
         # mime type
-        upload_type = mimetypes.guess_type(file)[0]
+        if compress:
+            upload_type = 'application/gzip'
+        else:
+            upload_type = mimetypes.guess_type(upload_name)[0]
         if not upload_type:
             upload_type = 'application/zip'
 
@@ -315,51 +641,96 @@ class ApsApi():
             'PartNumber': part_number
         }
 
-    def multipart_upload(self, build_id, file, artifact_type=None):
-        '''Multipart upload method'''
+    def multipart_upload(self, build_id, file, artifact_type=None, journal=None,
+                         compress=False):
+        '''Multipart upload method. When an UploadJournal is given, the progress of the
+        upload is recorded in it and an upload already recorded in it is continued.
+        When compress is True the file is gzip compressed on the fly into the parts, and
+        uploaded as a .gz file of the given artifact type.'''
+        from aps_metrics import add_phase_bytes # pylint: disable=import-outside-toplevel
+        from aps_progress import TransferProgress # pylint: disable=import-outside-toplevel
+        from aps_tasks import check_cancelled # pylint: disable=import-outside-toplevel
 
         LOGGER.info(f'Uploading application {file}')
 
         upload_id = upload_name = None
+        progress = None
         try:
-            upload_id, upload_name = self.upload_start(build_id, file, artifact_type)
+            parts = []
+            if journal and journal.upload_id:
+                upload_id, upload_name = journal.upload_id, journal.upload_name
+                parts = list(journal.parts)
+                LOGGER.info(f'Continuing upload {upload_id} after {len(parts)} parts')
+            else:
+                upload_id, upload_name = self.upload_start(build_id, file, artifact_type,
+                                                           compress)
+                if journal:
+                    journal.start(upload_id, upload_name)
 
             # Split file into parts. For each part, get an upload url and upload
             # the part. Part numbers start at 1. After uploading each part, save
             # the returned ETag header. We need that when completing the upload.
-            parts = []
-            part_number = 1
-            with open(file, 'rb') as fp:
-                while True:
-                    data = fp.read(PART_SIZE)
-                    if not data:
-                        break
-                    part = self.upload_part(build_id, upload_id, upload_name, part_number, data)
-
-                    parts.append(part)
-                    # Increment the part number and repeat until the file is read.
-                    part_number += 1
-
+            # xcarchive folders are zipped on the fly into the parts.
+            # The size of a zipped xcarchive folder or compressed file is not known in
+            # advance
+            total = None if is_xcarchive_dir(file) or compress else os.path.getsize(file)
+            progress = TransferProgress(
+                self.progress, 'upload', total,
+                initial=min(len(parts) * PART_SIZE, total) if total else 0,
+                buildId=build_id, file=file, artifactType=artifact_type)
+            part_number = len(parts) + 1
+            for data in iter_file_parts(file, PART_SIZE, skip=len(parts), compress=compress):
+                # Stop early when e.g. setting the certificate failed during the upload
+                check_cancelled()
+                progress.start_part()
+                part = self.upload_part(build_id, upload_id, upload_name, part_number, data)
+                add_phase_bytes(len(data))
+                progress.add(len(data), part_done=True)
+
+                parts.append(part)
+                if journal:
+                    journal.add_part(part)
+                # Increment the part number and repeat until the file is read.
+                part_number += 1
 
             # Complete the upload
             self.upload_complete(build_id, upload_id, upload_name, parts, artifact_type)
+            progress.finish()
             return True
         except Exception as e:
             LOGGER.warning(f'Upload method failed: {e}')
+            if progress:
+                progress.finish(success=False)
             if upload_id and upload_name:
-                self.upload_abort(build_id, upload_id, upload_name, artifact_type)
+                with cleanup_deadline():
+                    self.upload_abort(build_id, upload_id, upload_name,
+                                      artifact_type=artifact_type)
+            if journal:
+                journal.clear()
+            if isinstance(e, ApsDeadlineException):
+                raise
             return False
 
-    def add_build(self, file, application_id=None, set_metadata=True, upload=True, subscription_type=None):
-        '''Add a new build'''
-        response = self.create_build(application_id, subscription_type)
+    def add_build(self, file, application_id=None, set_metadata=True, upload=True,
+                  subscription_type=None, preflight=True):
+        '''Add a new build. Unless preflight is False the file is first checked locally,
+        and the error response of a failed check is returned without adding the build.'''
+        from aps_metrics import timed_phase # pylint: disable=import-outside-toplevel
+        if file and preflight:
+            error = self.preflight(file)
+            if error:
+                return error
+
+        with timed_phase('create_build'):
+            response = self.create_build(application_id, subscription_type)
         if 'errorMessage' in response:
             return response
 
         build_id = response['id']
 
         if set_metadata:
-            response = self.set_build_metadata(build_id, file)
+            with timed_phase('set_metadata'):
+                response = self.set_build_metadata(build_id, file)
             if 'errorMessage' in response:
                 LOGGER.debug('set build metadata failed, delete build')
                 self.delete_build(build_id)
@@ -370,12 +741,15 @@ class ApsApi():
         if not application_id or not upload:
             return response
 
-        if not self.multipart_upload(build_id, file):
+        with timed_phase('upload'):
+            uploaded = self.multipart_upload(build_id, file)
+        if not uploaded:
             LOGGER.debug('upload failed, delete build')
             self.delete_build(build_id)
         return response
 
-    def add_build_without_app(self, file, set_metadata=True, subscription_type=None):
+    def add_build_without_app(self, file, set_metadata=True, subscription_type=None,
+                              preflight=True):
         '''Add a new build that is not yet associated to an application'''
 
         LOGGER.info(f'Adding new build with subscription type {subscription_type}')
@@ -384,7 +758,8 @@ class ApsApi():
                               application_id=None,
                               set_metadata=set_metadata,
                               upload=False,
-                              subscription_type=subscription_type)
+                              subscription_type=subscription_type,
+                              preflight=preflight)
 
     def delete_build(self, build_id):
         '''Delete a build'''
@@ -393,7 +768,154 @@ class ApsApi():
         self.ensure_authenticated()
         response = ApsRequest.delete(url, headers=self.headers)
         LOGGER.debug(f'Delete build response: {response.json()}')
-        return response.json()
+        result = response.json()
+        if 'errorMessage' not in result:
+            self.remember_write('builds', build_id, None)
+        return result
+
+    def prune_builds(self, application_id=None, older_than=None, states=None, keep_last=None,
+                     dry_run=False, workers=4, rate=5, subscription_type=None):
+        '''Delete builds selected from list_builds.
+
+        Builds are selected when they are older than older_than days and/or in one of
+        the given states. keep_last keeps the given number of most recent builds of each
+        application (and on its own selects all other builds). Builds being protected are
+        never selected, nor builds without a creation time when selecting by age or
+        keep_last. Selected builds are deleted by a pool of workers, at most rate
+        deletions per second. Returns a summary of the deleted builds and reclaimed storage.'''
+        from aps_tasks import RateLimiter # pylint: disable=import-outside-toplevel
+        if older_than is None and not states and keep_last is None:
+            raise ApsException('No build selection criteria given')
+
+        builds = self.list_builds(application_id, None, subscription_type)
+        if not isinstance(builds, list):
+            return builds
+
+        selected = select_builds(builds, older_than, states, keep_last,
+                                 excluded_states=PROTECT_STATES)
+
+        summary = {
+            'dryRun': dry_run,
+            'selected': [build['id'] for build in selected],
+            'deleted': [],
+            'failed': [],
+            'reclaimedBytes': 0,
+            'unknownSize': 0,
+        }
+
+        limiter = RateLimiter(rate)
+
+        def delete(build):
+            if dry_run:
+                return build, {}
+            limiter.wait()
+            try:
+                return build, self.delete_build(build['id'])
+            except Exception as e:
+                return build, {'errorMessage': str(e)}
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for build, response in executor.map(delete, selected):
+                if 'errorMessage' in response:
+                    LOGGER.warning(f'Failed to delete build {build["id"]}: {response["errorMessage"]}')
+                    summary['failed'].append({'id': build['id'],
+                                              'errorMessage': response['errorMessage']})
+                    continue
+                summary['deleted'].append(build['id'])
+                size = get_build_size(build)
+                if size is None:
+                    summary['unknownSize'] += 1
+                else:
+                    summary['reclaimedBytes'] += size
+
+        LOGGER.info(f'{"Would delete" if dry_run else "Deleted"} {len(summary["deleted"])} '
+                    f'builds, reclaiming {summary["reclaimedBytes"]} bytes')
+        if summary['unknownSize']:
+            LOGGER.warning(f'{summary["unknownSize"]} deleted builds have no {BUILD_SIZE_FIELD} '
+                           'size, their storage is not counted in reclaimedBytes')
+        return summary
+
+    def apply_applications(self, file, workers=4, rate=5, dry_run=False,
+                           subscription_type=None):
+        '''Bring applications to the desired state given in a file (see aps_apply).
+
+        The applications are listed once and compared with the desired state. Missing
+        applications are added, and applications whose name or permissions differ are
+        updated. Signing certificates and protection configurations are set when their
+        file differs from the one last applied by this client. The changes are applied
+        by a pool of workers, at most rate requests per second. Applications which are
+        already in the desired state cause no requests, and applications not in the file
+        are left alone. Returns a summary of the changes.'''
+        from aps_apply import ( # pylint: disable=import-outside-toplevel
+            FILE_SETTINGS, diff_application, index_applications, load_desired_state)
+        from aps_tasks import RateLimiter # pylint: disable=import-outside-toplevel
+        desired = load_desired_state(file)
+        applications = self.list_applications(None, subscription_type=subscription_type)
+        if not isinstance(applications, list):
+            return applications
+
+        current = index_applications(applications)
+
+        applied_settings = self.get_applied_settings()
+        summary = {'dryRun': dry_run, 'unchanged': [], 'changed': [], 'failed': []}
+        plan = []
+        for application in desired:
+            existing = current.get((application['packageId'], application['os']))
+            applied = applied_settings.get(existing['id']) if existing else {}
+            actions = diff_application(application, existing, applied)
+            record = {'packageId': application['packageId'], 'os': application['os'],
+                      'id': existing['id'] if existing else None}
+            if actions:
+                plan.append((application, record, actions))
+            else:
+                summary['unchanged'].append(record)
+
+        limiter = RateLimiter(rate)
+        setters = {'signingCertificate': self.set_signing_certificate,
+                   'protectionConfiguration': self.set_protection_configuration}
+
+        def call(function, *args, **kwargs):
+            limiter.wait()
+            response = function(*args, **kwargs)
+            if 'errorMessage' in response:
+                raise ApsException(response['errorMessage'])
+            return response
+
+        def apply(entry):
+            application, record, actions = entry
+            record = {**record, 'actions': actions}
+            if dry_run:
+                return record, None
+            try:
+                if 'add' in actions:
+                    record['id'] = call(self.add_application, application['name'],
+                                        application['packageId'], application['os'],
+                                        application['permissions'], application['group'],
+                                        subscription_type)['id']
+                if 'update' in actions:
+                    call(self.update_application, record['id'], application['name'],
+                         application['permissions'])
+                # The setters record the digests of the applied files
+                for setting in FILE_SETTINGS:
+                    if setting in actions:
+                        call(setters[setting], record['id'], application[setting])
+                return record, None
+            except Exception as e:
+                return record, str(e)
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            for record, error in executor.map(apply, plan):
+                if error:
+                    LOGGER.warning(f'Failed to apply {record["packageId"]} ({record["os"]}): '
+                                   f'{error}')
+                    summary['failed'].append({**record, 'errorMessage': error})
+                else:
+                    summary['changed'].append(record)
+
+        LOGGER.info(f'{"Would change" if dry_run else "Changed"} {len(summary["changed"])} '
+                    f'applications, {len(summary["unchanged"])} unchanged, '
+                    f'{len(summary["failed"])} failed')
+        return summary
 
     def delete_build_ticket(self, build_id, ticket_id):
         '''Delete a Zendesk ticket associated to a build'''
@@ -447,8 +969,13 @@ class ApsApi():
         LOGGER.debug(f'Protect cancel response: {response.json()}')
         return response.json()
 
-    def protect_download(self, build_id):
-        '''Download a protected build file'''
+    def protect_download(self, build_id, output_dir=None, result_file=PROTECT_RESULT_FILE):
+        '''Download a protected build file into output_dir (by default the current
+        directory). The name of the downloaded file is written to result_file in the
+        same folder, unless result_file is None. Returns the downloaded file path.'''
+        from aps_metrics import ( # pylint: disable=import-outside-toplevel
+            add_phase_bytes, timed_phase)
+        from aps_progress import TransferProgress # pylint: disable=import-outside-toplevel
         # Request a S3 presigned URL for the download
         url = f'{self.api_gw_url}/builds/{build_id}'
 
@@ -463,18 +990,41 @@ class ApsApi():
         url = response.text
         local_filename = url.split('/')[-1]
         local_filename = local_filename.split('?')[0]
+        local_path = os.path.join(output_dir, local_filename) if output_dir else local_filename
         LOGGER.info('Starting download of protected file')
 
         self.ensure_authenticated()
-        response = ApsRequest.get(url, stream=True)
-        LOGGER.debug(f'Download protection file response: {response}')
-        with open(local_filename, 'wb') as file_handle:
-            shutil.copyfileobj(response.raw, file_handle)
-        LOGGER.info(f'Protected file downloaded to {local_filename}')
-
-        result_file = open('protect_result.txt', 'w')
-        result_file.write(local_filename)
-        result_file.close()
+        with timed_phase('download'):
+            response = ApsRequest.get(url, stream=True)
+            LOGGER.debug(f'Download protection file response: {response}')
+            length = response.headers.get('Content-Length')
+            progress = TransferProgress(self.progress, 'download',
+                                        int(length) if length else None,
+                                        buildId=build_id, file=local_path)
+            progress.start_part()
+            try:
+                with response, open(local_path, 'wb') as file_handle:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        check_deadline()
+                        file_handle.write(chunk)
+                        add_phase_bytes(len(chunk))
+                        progress.add(len(chunk))
+            except ApsDeadlineException:
+                os.remove(local_path)
+                progress.finish(success=False)
+                raise
+            progress.add(0, part_done=True)
+            progress.finish()
+        LOGGER.info(f'Protected file downloaded to {local_path}')
+
+        # The result file is written next to the downloaded file and names it
+        # relative to the output folder.
+        if result_file:
+            if output_dir:
+                result_file = os.path.join(output_dir, result_file)
+            with open(result_file, 'w') as file_handle:
+                file_handle.write(local_filename)
+        return local_path
 
     def add_build_to_application(self, build_id, application_id):
         '''Associate a build to an application'''
@@ -486,34 +1036,82 @@ class ApsApi():
         self.ensure_authenticated()
         response = ApsRequest.put(url, headers=self.headers, data=json.dumps(body))
         LOGGER.debug(f'Add build to application response: {response.json()}')
-        return response.json()
-
-    def protect_build(self, build_id):
+        result = response.json()
+        if 'errorMessage' not in result:
+            with self.lock:
+                expected = self.recent_writes['builds'].get(build_id) or {}
+                self.remember_write('builds', build_id, {**expected, **body})
+        return result
+
+    def protect_build(self, build_id, start=True, job_id=None):
         '''High level protect build command.
         This operation does the following
-        - protect_start
-        - poll protection state (protect_get_status) until protection is completed'''
-
-        LOGGER.info(f'Starting protection for build {build_id}')
-
-        # Start protection
-        response = self.protect_start(build_id)
-        if 'errorMessage' in response:
-            LOGGER.debug('protection start call failed, delete build')
-            self.delete_build(build_id)
-            return False
+        - protect_start (unless start is False, to wait for an already started protection)
+        - poll protection state (protect_get_status) until protection is completed
+        When job_id is given, the protection state is recorded in that job.'''
+        from aps_metrics import ( # pylint: disable=import-outside-toplevel
+            add_phase_time, timed_phase)
+        from aps_progress import protect_state_event # pylint: disable=import-outside-toplevel
+
+        if start:
+            LOGGER.info(f'Starting protection for build {build_id}')
+
+            # Start protection
+            try:
+                with timed_phase('protect_start'):
+                    response = self.protect_start(build_id)
+            except ApsDeadlineException:
+                # The protection may have been started before the request timed out
+                LOGGER.warning(f'Deadline exceeded, cancelling protection and deleting '
+                               f'build {build_id}')
+                try:
+                    with cleanup_deadline():
+                        self.protect_cancel(build_id)
+                except ApsException as e:
+                    LOGGER.debug(f'Failed to cancel protection of build {build_id}: {e}')
+                with cleanup_deadline():
+                    self.delete_build(build_id)
+                raise
+            if 'errorMessage' in response:
+                LOGGER.debug('protection start call failed, delete build')
+                self.delete_build(build_id)
+                return False
+            if job_id:
+                self.get_job_store().update(job_id, stage='protecting')
 
         LOGGER.info(f'Protection stated, will wait for completion of build {build_id}')
 
-        start_time = time.time()
+        # The time between two polls is attributed to the state seen at the first poll
+        # (the queue for the time before the first poll)
+        state = 'protect_queue'
+        polled = time.monotonic()
+        reported_state = None
         while True:
-            build = self.protect_get_status(build_id)
+            try:
+                build = self.protect_get_status(build_id)
+            except ApsDeadlineException:
+                LOGGER.warning(f'Deadline exceeded, cancelling protection of build {build_id}')
+                with cleanup_deadline():
+                    self.protect_cancel(build_id)
+                raise
 
             if not 'state' in build.keys():
                 LOGGER.info(f'Failed to get protect status for build {build_id}')
                 LOGGER.info(build)
                 return False
 
+            now = time.monotonic()
+            add_phase_time(PROTECT_STATE_PHASES.get(state, 'protect'), now - polled)
+            state, polled = build['state'], now
+
+            if self.progress and build['state'] != reported_state:
+                self.progress(protect_state_event(
+                    build_id, build['state'], reported_state,
+                    build.get('progressData', {}).get('progress')))
+                reported_state = build['state']
+
+            if job_id:
+                self.get_job_store().update(job_id, protect_state=build['state'])
             if build['state'] not in PROTECT_STATES:
                 LOGGER.info('Protection complete')
                 break
@@ -522,44 +1120,46 @@ class ApsApi():
             else:
                 if 'progressData' in build:
                     LOGGER.info(f'Protecting {build["progressData"]["progress"]} complete')
-            time.sleep(10)
+            # Do not sleep past the deadline, so the protection is cancelled promptly
+            remaining = remaining_time()
+            time.sleep(PROTECT_POLL_INTERVAL if remaining is None else
+                       max(0, min(PROTECT_POLL_INTERVAL, remaining)))
 
         return (build['state'] == 'protect_done')
 
 
-    def protect(self, file, subscription_type=None, signing_certificate=None, mapping_file=None):
-        '''High level protect command.
-        This operation does the following
-        - add_build
-        - protect_start
-        - poll protection state (protect_get_status) until protection is completed
-        - protect_download'''
-
-        # First add the build
-        build = self.add_build_without_app(file, subscription_type=subscription_type)
-        if 'errorMessage' in build:
-            LOGGER.error(f'Failed to add new build {build["errorMessage"]}')
-            return False
-
-        application_package_id = build['applicationPackageId']
-        os_type = get_os(file)
-
-        applications = self.list_applications(application_id=None,
-                                              group=None,
-                                              subscription_type=subscription_type)
-        application = None
+    def find_or_add_application(self, application_package_id, os_type, subscription_type=None):
+        '''Return the application for a package id and OS, adding a new application
+        if there is none yet'''
+        with self.application_lock:
+            index = self.get_application_index()
 
-        # Check if we have an app for this build (by searching for a matching
-        # applicationPackageId)
-        for app in applications:
-            if app['applicationPackageId'] == application_package_id \
-               and app['os'] == os_type:
-                application = app
-                break
-
-        # If no application for the build exists then create a new app.
-        # Take the applicationName from the package id and use default permissive permissions
-        if not application:
+            # Try the local application index first, and verify the hit by getting the
+            # single application rather than listing all of them.
+            application_id = index.get(application_package_id, os_type, subscription_type)
+            if application_id:
+                app = self.list_applications(application_id, subscription_type=subscription_type)
+                if 'errorMessage' not in app \
+                   and app.get('applicationPackageId') == application_package_id \
+                   and app.get('os') == os_type:
+                    LOGGER.debug(f'Found application {application_id} in local index')
+                    return app
+                index.invalidate(application_id)
+
+            applications = self.list_applications(application_id=None,
+                                                  group=None,
+                                                  subscription_type=subscription_type)
+            index.update(applications, subscription_type)
+
+            # Check if we have an app for this build (by searching for a matching
+            # applicationPackageId)
+            for app in applications:
+                if app['applicationPackageId'] == application_package_id \
+                   and app['os'] == os_type:
+                    return app
+
+            # If no application for the build exists then create a new app.
+            # Take the applicationName from the package id and use default permissive permissions
             permissions = {}
             permissions['private'] = False
             permissions['no_upload'] = False
@@ -570,36 +1170,355 @@ class ApsApi():
                                                os_type,
                                                permissions,
                                                subscription_type=subscription_type)
-            if 'errorMessage' in application:
-                LOGGER.error(f'Failed to add new application {application["errorMessage"]}')
-                return False
+            if 'errorMessage' not in application:
+                index.put(application, subscription_type)
+            return application
 
-        self.add_build_to_application(build['id'], application['id'])
+    def protect(self, file, subscription_type=None, signing_certificate=None, mapping_file=None,
+                output_dir=None, timeout=None, preflight=True, timing_report=None,
+                metrics_file=None):
+        '''High level protect command.
+        This operation does the following
+        - add_build
+        - protect_start
+        - poll protection state (protect_get_status) until protection is completed
+        - protect_download
+        The progress is recorded in the local job store, so that the protection can be
+        resumed (see resume_jobs) if this process is interrupted.
+
+        timeout is an optional overall time budget in seconds, shared by the upload,
+        polling and download. Every request gets the remaining budget as its timeout.
+        When the budget runs out uploads are aborted or the protection is cancelled.
+
+        Unless preflight is False the file is first checked locally, and nothing is
+        done if the check fails.
+
+        The time spent in each phase (preflight, build creation, application lookup,
+        upload, queue, protection, download...) is logged as a timing report at the end,
+        and written as JSON to timing_report and in the OpenMetrics text format (e.g. for
+        the node_exporter textfile collector) to metrics_file when these are given.'''
+        from aps_metrics import PhaseTimer # pylint: disable=import-outside-toplevel
+        timer = PhaseTimer('protect', self.rss_interval)
+        result = False
+        try:
+            with timer.activate():
+                result = self.run_protect(file, subscription_type, signing_certificate,
+                                          mapping_file, output_dir, timeout, preflight)
+            return result
+        finally:
+            self.write_timing(timer.report(file=file, success=result),
+                              timing_report, metrics_file)
+
+    def run_protect(self, file, subscription_type, signing_certificate, mapping_file,
+                    output_dir, timeout, preflight):
+        '''Check a build file, record its protection job and run it, see protect'''
+        if preflight and self.preflight(file):
+            return False
 
-        if signing_certificate:
-            self.set_signing_certificate(application['id'], signing_certificate)
-        if mapping_file:
-            self.set_mapping_file(build['id'], mapping_file)
+        # Record absolute paths, so the job can be resumed from any working directory
+        def abspath(path):
+            return os.path.abspath(path) if path else path
+
+        job_id = self.get_job_store().add(abspath(file),
+                                          subscription_type=subscription_type,
+                                          signing_certificate=abspath(signing_certificate),
+                                          mapping_file=abspath(mapping_file),
+                                          output_dir=abspath(output_dir or os.getcwd()))
+        with deadline(timeout):
+            return self.run_protect_job(self.get_job_store().get(job_id))
+
+    @staticmethod
+    def write_timing(report, timing_report=None, metrics_file=None):
+        '''Log a timing report and write it to the given files. Failing to write them
+        does not fail the operation.'''
+        from aps_metrics import ( # pylint: disable=import-outside-toplevel
+            write_openmetrics, write_timing_report)
+        LOGGER.info('Timing: ' + ', '.join(f'{phase["phase"]} {phase["duration"]:.1f}s'
+                                          for phase in report['phases']) +
+                    f', total {report["duration"]:.1f}s')
+        LOGGER.debug(f'Timing report: {json.dumps(report)}')
+        try:
+            if timing_report:
+                write_timing_report(report, timing_report)
+            if metrics_file:
+                write_openmetrics(report, metrics_file)
+        except OSError as e:
+            LOGGER.warning(f'Failed to write timing report: {e}')
+
+    def run_protect_job(self, job):
+        '''Run a protection job from the job store, skipping the stages it completed.
+        A heartbeat is recorded while it runs, so it is not resumed by another process.'''
+        with self.get_job_store().heartbeat(job['id']):
+            return self.run_protect_stages(job)
+
+    def run_protect_stages(self, job):
+        '''Run the stages of a protection job which it did not complete yet'''
+        from aps_jobs import ( # pylint: disable=import-outside-toplevel
+            JOB_FAILED, stage_reached, UploadJournal)
+        from aps_metrics import timed_phase # pylint: disable=import-outside-toplevel
+        from aps_tasks import TaskGraph # pylint: disable=import-outside-toplevel
+        store = self.get_job_store()
+        job_id = job['id']
+        file = job['file']
+        subscription_type = job['subscription_type']
+        signing_certificate = job['signing_certificate']
+        mapping_file = job['mapping_file']
+
+        # The steps up to and including the upload form a small dependency graph, which
+        # is executed concurrently. E.g. the signing certificate and mapping file are set
+        # while the binary is being uploaded.
+        def add_build():
+            if stage_reached(job, 'build_added'):
+                return {'id': job['build_id'], 'applicationPackageId': job['package_id']}
+            # The file was checked by protect before the job was recorded
+            build = self.add_build_without_app(file, subscription_type=subscription_type,
+                                               preflight=False)
+            if 'errorMessage' in build:
+                raise ApsException(f'Failed to add new build {build["errorMessage"]}')
+            store.update(job_id, stage='build_added', build_id=build['id'],
+                         package_id=build['applicationPackageId'])
+            return build
+
+        def find_application(build):
+            if stage_reached(job, 'application_set'):
+                return {'id': job['application_id']}
+            with timed_phase('application'):
+                application = self.find_or_add_application(build['applicationPackageId'],
+                                                           get_os(file),
+                                                           subscription_type)
+            if 'errorMessage' in application:
+                raise ApsException(
+                    f'Failed to add new application {application["errorMessage"]}')
+            return application
+
+        def add_build_to_application(build, application):
+            if not stage_reached(job, 'application_set'):
+                with timed_phase('assign'):
+                    self.add_build_to_application(build['id'], application['id'])
+                store.update(job_id, stage='application_set', application_id=application['id'])
+
+        def set_signing_certificate(application):
+            with timed_phase('certificate'):
+                return self.update_signing_certificate(application, signing_certificate)
+
+        def set_mapping_file(build, _):
+            with timed_phase('mapping'):
+                uploaded = self.set_mapping_file(build['id'], mapping_file)
+            if not uploaded:
+                LOGGER.warning(f'Failed to upload mapping file {mapping_file}')
+
+        def upload(build, _):
+            journal = UploadJournal(store, job_id, job['upload'])
+            with timed_phase('upload'):
+                uploaded = self.multipart_upload(build['id'], file, journal=journal)
+            if not uploaded:
+                raise ApsException('Failed to upload build')
+
+        graph = TaskGraph()
+        graph.add('build', add_build)
+        if not stage_reached(job, 'uploaded'):
+            graph.add('application', find_application, 'build')
+            graph.add('assign', add_build_to_application, 'build', 'application')
+            if signing_certificate:
+                graph.add('certificate', set_signing_certificate, 'application')
+            if mapping_file:
+                graph.add('mapping', set_mapping_file, 'build', 'assign')
+            graph.add('upload', upload, 'build', 'assign')
 
-        # Upload the binary
-        if not self.multipart_upload(build['id'], file):
-            LOGGER.debug('upload failed, delete build')
-            self.delete_build(build['id'])
+        try:
+            build = graph.run()['build']
+        except ApsTaskException as e:
+            # Unexpected errors leave the job as is, so it can be resumed
+            if not isinstance(e.__cause__, ApsException):
+                raise e.__cause__
+            if 'build' in e.results:
+                LOGGER.debug(f'{e.task} failed, delete build')
+                with cleanup_deadline():
+                    self.delete_build(e.results['build']['id'])
+            LOGGER.error(str(e.__cause__))
+            store.update(job_id, stage=JOB_FAILED, error=str(e.__cause__))
             return False
 
-        # Start protection
+        if not stage_reached(job, 'uploaded'):
+            store.update(job_id, stage='uploaded')
+
+        # Start protection, or wait for the protection started before the job was resumed
+        if not stage_reached(job, 'protected'):
+            try:
+                protected = self.protect_build(build['id'],
+                                               start=not stage_reached(job, 'protecting'),
+                                               job_id=job_id)
+            except ApsDeadlineException as e:
+                LOGGER.error(f'Protection cancelled with build id:{build["id"]}: {e}')
+                store.update(job_id, stage=JOB_FAILED, error=str(e))
+                return False
+            if not protected:
+                LOGGER.info(f'Protection failed with build id:{build["id"]}')
+                store.update(job_id, stage=JOB_FAILED, error='Protection failed')
+                return False
+            store.update(job_id, stage='protected')
 
-        if not self.protect_build(build['id']):
-            LOGGER.info(f'Protection failed with build id:{build["id"]}')
+        # Download the protected app on success. If the deadline expires during the
+        # download, the job can still be resumed to download the protected app.
+        try:
+            output = self.protect_download(build['id'], output_dir=job['output_dir'])
+        except ApsDeadlineException as e:
+            LOGGER.error(f'Download failed with build id:{build["id"]}: {e}')
             return False
-
-        # Download the protected app on success.
-        self.protect_download(build['id'])
+        store.update(job_id, stage='done', output=output)
         # This line is parsed by test-events-android to extract the build id. Do not change
         LOGGER.info(f'Protection succeeded with build id:{build["id"]}')
 
         return True
 
+    def list_jobs(self, unfinished=False):
+        '''List the protection jobs recorded in the local job store'''
+        return self.get_job_store().list_jobs(unfinished)
+
+    def resume_jobs(self, timeout=None):
+        '''Resume every unfinished protection job from its last completed stage, each
+        with an optional time budget (see protect). Jobs still run by another process
+        are left alone. Returns the result of each job.'''
+        results = []
+        for job in self.get_job_store().list_jobs(unfinished=True):
+            if not self.get_job_store().claim(job):
+                LOGGER.info(f'Protection of {job["file"]} was resumed by another process')
+                continue
+            LOGGER.info(f'Resuming protection of {job["file"]} after stage {job["stage"]}')
+            with deadline(timeout):
+                result = self.run_protect_job(job)
+            job = self.get_job_store().get(job['id'])
+            results.append({'id': job['id'],
+                            'file': job['file'],
+                            'buildId': job['build_id'],
+                            'stage': job['stage'],
+                            'output': job['output'],
+                            'error': job['error'],
+                            'result': result})
+        return results
+
+    def protect_many(self, jobs, subscription_type=None, signing_certificate=None,
+                     mapping_file=None, output_dir=None, workers=None, preflight=True):
+        '''High level command protecting many input files.
+
+        Each job is either a file name or a dict with a 'file' key and optional
+        'subscription_type', 'signing_certificate', 'mapping_file' and 'output_dir' keys
+        overriding the arguments of this call. Jobs run through a pipeline of stages
+        (inspect, build, upload, protect, download), each stage having its own bounded
+        pool of workers. workers optionally overrides the pool size of each stage, either
+        for all stages (int) or per stage name (dict).
+
+        Every protected file is downloaded into its own folder under output_dir (by default
+        the current directory). Unless preflight is False, files are checked locally in
+        the inspect stage. Returns a list with the result of each job.'''
+        from aps_tasks import StagedPipeline # pylint: disable=import-outside-toplevel
+        stage_workers = dict(PROTECT_MANY_WORKERS)
+        if isinstance(workers, int):
+            stage_workers = {stage: workers for stage in stage_workers}
+        elif workers:
+            stage_workers.update(workers)
+
+        output_dir = output_dir or os.getcwd()
+        job_dirs = set()
+        queue = []
+        for job in jobs:
+            if isinstance(job, str):
+                job = {'file': job}
+            job = dict(job)
+            job.setdefault('subscription_type', subscription_type)
+            job.setdefault('signing_certificate', signing_certificate)
+            job.setdefault('mapping_file', mapping_file)
+
+            # Give each job its own output folder, named after the input file
+            if not job.get('output_dir'):
+                name = os.path.basename(job['file'].rstrip(os.sep)).split('.')[0]
+                job_dir, suffix = os.path.join(output_dir, name), 1
+                while job_dir in job_dirs:
+                    suffix += 1
+                    job_dir = os.path.join(output_dir, f'{name}-{suffix}')
+                job['output_dir'] = job_dir
+            job_dirs.add(job['output_dir'])
+            queue.append(job)
+
+        def inspect(job):
+            error = preflight and self.preflight(job['file'])
+            if error:
+                raise ApsException(f'{error["errorMessage"]}: {error["message"]}')
+            job['os'] = get_os(job['file'])
+            job['version_info'] = self.get_build_metadata(job['file'])['versionInfo']
+            return job
+
+        def build(job):
+            response = self.create_build(subscription_type=job['subscription_type'])
+            if 'errorMessage' in response:
+                raise ApsException(f'Failed to add new build {response["errorMessage"]}')
+            job['build_id'] = response['id']
+
+            response = self.set_build_metadata(job['build_id'], job['file'], job['version_info'])
+            if 'errorMessage' in response:
+                raise ApsException(f'Failed to set build metadata {response["errorMessage"]}')
+
+            application = self.find_or_add_application(response['applicationPackageId'],
+                                                       job['os'],
+                                                       job['subscription_type'])
+            if 'errorMessage' in application:
+                raise ApsException(
+                    f'Failed to add new application {application["errorMessage"]}')
+            job['application_id'] = application['id']
+
+            self.add_build_to_application(job['build_id'], job['application_id'])
+            if job['signing_certificate']:
+                self.update_signing_certificate(application, job['signing_certificate'])
+            return job
+
+        def upload(job):
+            if job['mapping_file'] and not self.set_mapping_file(job['build_id'],
+                                                                 job['mapping_file']):
+                raise ApsException('Failed to upload mapping file')
+            if not self.multipart_upload(job['build_id'], job['file']):
+                raise ApsException('Failed to upload build')
+            return job
+
+        def protect(job):
+            if not self.protect_build(job['build_id']):
+                raise ApsException('Protection failed')
+            return job
+
+        def download(job):
+            os.makedirs(job['output_dir'], exist_ok=True)
+            job['output'] = self.protect_download(job['build_id'],
+                                                  output_dir=job['output_dir'],
+                                                  result_file=None)
+            return job
+
+        stages = [(name, function, stage_workers[name]) for name, function in
+                  [('inspect', inspect), ('build', build), ('upload', upload),
+                   ('protect', protect), ('download', download)]]
+
+        summary = []
+        for job, stage, exc in StagedPipeline(stages).run(queue):
+            result = {
+                'file': job['file'],
+                'buildId': job.get('build_id'),
+                'applicationId': job.get('application_id'),
+            }
+            if exc:
+                LOGGER.error(f'Protection of {job["file"]} failed in {stage} stage: {exc}')
+                result['status'] = 'failed'
+                result['stage'] = stage
+                result['error'] = str(exc)
+                # protect_build already deletes the build when protection fails to start
+                if job.get('build_id') and stage in ['build', 'upload']:
+                    LOGGER.debug('protect_many job failed, delete build')
+                    self.delete_build(job['build_id'])
+            else:
+                # This line is parsed by test-events-android to extract the build id. Do not change
+                LOGGER.info(f'Protection succeeded with build id:{job["build_id"]}')
+                result['status'] = 'protected'
+                result['output'] = job['output']
+            summary.append(result)
+        return summary
+
     def get_build_artifacts(self, build_id):
         '''Get build artifacts'''
 
@@ -625,14 +1544,56 @@ class ApsApi():
         LOGGER.info(f'Build artifacts downloaded to {outdir}')
 
 
-    def get_statistics(self, start, end):
-        '''Get APS statistics'''
+    def get_statistics(self, start, end, cache=False):
+        '''Get APS statistics.
+
+        With cache the range is split into daily buckets. Buckets which ended are fetched
+        once, concurrently, and kept in a local store; only the buckets without final
+        statistics (e.g. the current day) and partial days at the ends of the range are
+        requested every time. The statistics of the buckets are merged, adding up counts
+        (see merge_statistics). When they cannot be merged the whole range is requested.'''
+        import dateutil.parser # pylint: disable=import-outside-toplevel
         start_time = dateutil.parser.parse(start)
         if end:
             end_time = dateutil.parser.parse(end)
         else:
             end_time = datetime.now()
 
+        if not cache:
+            return self.fetch_statistics(start_time, end_time)
+
+        # Buckets are computed on naive local times, like the default end time
+        range_start, range_end = start_time, end_time
+        start_time, end_time = [value.astimezone().replace(tzinfo=None) if value.tzinfo
+                                else value for value in [start_time, end_time]]
+        closed_before = datetime.now() - timedelta(seconds=STATISTICS_SETTLE_TIME)
+        buckets = split_time_range(start_time, end_time, STATISTICS_BUCKET_SIZE,
+                                   closed_before)
+        store = self.get_statistics_store()
+        results = [store.get(bucket_start) if closed else None
+                   for bucket_start, _, closed in buckets]
+        missing = [index for index, result in enumerate(results) if result is None]
+        LOGGER.debug(f'Fetching statistics of {len(missing)} of {len(buckets)} buckets')
+
+        with ThreadPoolExecutor(max_workers=STATISTICS_WORKERS) as executor:
+            fetched = executor.map(lambda index: self.fetch_statistics(*buckets[index][:2]),
+                                   missing)
+            closed_results = {}
+            for index, result in zip(missing, fetched):
+                if isinstance(result, dict) and 'errorMessage' in result:
+                    return result
+                results[index] = result
+                if buckets[index][2]:
+                    closed_results[buckets[index][0]] = result
+        if closed_results:
+            store.put(closed_results)
+        merged = merge_statistics(results)
+        if merged is None:
+            return self.fetch_statistics(range_start, range_end)
+        return merged
+
+    def fetch_statistics(self, start_time, end_time):
+        '''Request the statistics of a time range from APS'''
         params = {}
 
         url = f'{self.api_gw_url}/report/statistics?start={start_time}&end={end_time}'
@@ -640,12 +1601,24 @@ class ApsApi():
         response = ApsRequest.get(url, headers=self.headers, params=params)
         return response.json()
 
+    def report_builds(self, application_id=None, subscription_type=None, percentiles=None):
+        '''Report on the build history: per application and per OS the protected and
+        failed builds, percentiles of queue and protection times, and the throughput per
+        day. The builds are streamed, so large histories are not held as records.'''
+        from aps_report import build_report # pylint: disable=import-outside-toplevel
+        return build_report(self.iter_builds(application_id, None, subscription_type),
+                            percentiles)
+
     def display_application_package_id(self, file):
         '''Extract the package id from the input file'''
-        return extract_package_id(file)
+        if file.endswith('.aab'):
+            return extract_package_id(file)
+        # The package id is parsed again, reporting the error, if the cache has none
+        return self.get_build_metadata(file)['packageId'] or extract_package_id(file)
 
     def set_protection_configuration(self, application_id, file):
         '''Set protection configuration for an application'''
+        from aps_apply import setting_digest # pylint: disable=import-outside-toplevel
         url = f'{self.api_gw_url}/applications/{application_id}/protection-configuration'
 
         body = {}
@@ -655,11 +1628,17 @@ class ApsApi():
         self.ensure_authenticated()
         response = ApsRequest.put(url, headers=self.headers, data=json.dumps(body))
         LOGGER.debug(f'Set protection configuration response: {response.json()}')
-        return response.json()
+        result = response.json()
+        if 'errorMessage' not in result:
+            self.get_applied_settings().put(
+                application_id, 'protectionConfiguration',
+                setting_digest('protectionConfiguration', file) if file else None)
+        return result
 
 
     def set_signing_certificate(self, application_id, file):
         '''Set signing certificate for an application'''
+        from aps_apply import setting_digest # pylint: disable=import-outside-toplevel
 
         url = f'{self.api_gw_url}/applications/{application_id}/signing-certificate'
 
@@ -668,15 +1647,46 @@ class ApsApi():
             with open(file, 'r') as file_handle:
                 body['certificate'] = file_handle.read()
                 body['certificateFileName'] = os.path.basename(file)
-        LOGGER.info(body)
+        LOGGER.info(f'Setting signing certificate {body.get("certificateFileName")} '
+                    f'of application {application_id}')
         self.ensure_authenticated()
         response = ApsRequest.put(url, headers=self.headers, data=json.dumps(body))
         LOGGER.debug(f'Set signing certificate response: {response.json()}')
-        return response.json()
-
-    def set_mapping_file(self, build_id, file):
-        '''Set mapping for a build'''
-        return self.multipart_upload(build_id, file, 'MAPPING_FILE')
+        result = response.json()
+        if 'errorMessage' not in result:
+            self.get_applied_settings().put(
+                application_id, 'signingCertificate',
+                setting_digest('signingCertificate', file) if file else None)
+        return result
+
+    def update_signing_certificate(self, application, file):
+        '''Set the signing certificate of an application. APS does not return the
+        certificate of an application, so with skip_applied_certificates the certificate
+        is compared with the one last set by this client instead, and not sent again
+        when they are the same. This may be out of date if the certificate was changed
+        elsewhere. Returns the response, or None when the certificate was not sent.'''
+        if self.skip_applied_certificates:
+            from aps_apply import setting_digest # pylint: disable=import-outside-toplevel
+            applied = self.get_applied_settings().get(application['id'])
+            if applied.get('signingCertificate') == \
+                    setting_digest('signingCertificate', file):
+                LOGGER.info(f'Skipped uploading signing certificate {file}: it was set on '
+                            f'application {application["id"]} from this host before')
+                return None
+        return self.set_signing_certificate(application['id'], file)
+
+    def set_mapping_file(self, build_id, file, compress=None):
+        '''Set mapping for a build. With compress the mapping file, which is text and
+        compresses well, is uploaded gzip compressed as <name>.gz, still with the
+        MAPPING_FILE artifact type. By default compress_mapping_files of the client is
+        used. Compression is experimental, as APS is not known to accept compressed
+        mapping files yet.'''
+        if compress is None:
+            compress = self.compress_mapping_files
+        if compress:
+            LOGGER.warning(f'Uploading mapping file {file} gzip compressed: this is '
+                           'experimental and APS may not accept compressed mapping files')
+        return self.multipart_upload(build_id, file, 'MAPPING_FILE', compress=compress)
 
     def get_sail_config(self, os_type, version):
         '''Get SAIL configuration'''
@@ -687,8 +1697,7 @@ class ApsApi():
         if version:
             params['version'] = version
 
-        self.ensure_authenticated()
-        response = ApsRequest.get(url, headers=self.headers, params=params)
+        response = self.cached_get(url, params=params)
         config = response.json()
         LOGGER.debug('Get SAIL configuration')
         return config
@@ -696,6 +1705,5 @@ class ApsApi():
     def get_version(self):
         '''Get version'''
         url = f'{self.api_gw_url}/version'
-        self.ensure_authenticated()
-        response = ApsRequest.get(url, headers=self.headers)
+        response = self.cached_get(url)
         return response.json()
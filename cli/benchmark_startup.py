@@ -0,0 +1,87 @@
+#!/usr/bin/python
+'''Benchmark of the startup time of the aps command line tool.
+
+Measures the time a fresh aps process takes to run protect-get-status up to the point
+where it would authenticate: parsing the arguments and loading the aps module and the
+APS API client. The command is run without credentials, so it stops there without
+sending any request. The startup time is compared with the time a bare Python process
+takes to import requests, which aps cannot do without, so the limit holds on fast and
+slow machines alike. Optionally lists the slowest imports.
+
+Exits with status 1 when the median startup time exceeds the median baseline time by
+more than the limit. Timings vary between machines and runs, so the limit is advisory:
+use it to spot regressions, not as a hard gate.'''
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+CLI_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# A protect-get-status run, which fails for the missing credentials right before it
+# would authenticate
+STARTUP_COMMAND = ['aps.py', '--no-daemon', 'protect-get-status', '--build-id', 'benchmark']
+
+# What any run of aps needs at least
+BASELINE_COMMAND = ['-c', 'import requests']
+
+
+def measure(command, runs):
+    '''Returns the times in seconds of the given number of runs of a Python command'''
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + command, cwd=CLI_DIR, check=False,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times
+
+def slowest_imports(count):
+    '''Returns the modules with the largest cumulative import time, using -X importtime'''
+    result = subprocess.run([sys.executable, '-X', 'importtime'] + STARTUP_COMMAND,
+                            cwd=CLI_DIR, check=False, capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        imports.append((int(fields[1]), fields[2].strip()))
+    return sorted(imports, reverse=True)[:count]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of aps')
+    parser.add_argument('--runs', type=int, default=10, help='Number of runs')
+    parser.add_argument('--limit', type=float, default=0.1,
+                        help='''Maximum median startup time in seconds, in excess of the
+                        median time of importing requests''')
+    parser.add_argument('--top', type=int, default=0,
+                        help='Also list this many of the slowest imports')
+    args = parser.parse_args()
+
+    # Interleave the runs, so load changes on the machine affect both alike
+    baseline_times = []
+    times = []
+    for _ in range(args.runs):
+        baseline_times += measure(BASELINE_COMMAND, 1)
+        times += measure(STARTUP_COMMAND, 1)
+    baseline = statistics.median(baseline_times)
+    median = statistics.median(times)
+    print(f'startup: median {median * 1000:.0f} ms, min {min(times) * 1000:.0f} ms, '
+          f'max {max(times) * 1000:.0f} ms over {args.runs} runs')
+    print(f'baseline (import requests): median {baseline * 1000:.0f} ms, '
+          f'aps overhead {(median - baseline) * 1000:.0f} ms')
+
+    if args.top:
+        for cumulative, module in slowest_imports(args.top):
+            print(f'{cumulative / 1000:8.1f} ms  {module}')
+
+    if median - baseline > args.limit:
+        print(f'Startup overhead exceeds the advisory limit of {args.limit * 1000:.0f} ms')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+'''Test configuration: the CLI modules are imported from the parent folder'''
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
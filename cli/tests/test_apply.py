@@ -0,0 +1,66 @@
+'''Tests of the comparison of applications with their desired state'''
+import hashlib
+
+from aps_apply import diff_application, index_applications, normalize_application
+from aps_utils import get_permission_fields
+
+
+def desired_application(tmp_path, **fields):
+    '''A normalized desired application, with settings files relative to tmp_path'''
+    return normalize_application({'packageId': 'com.example.app', 'os': 'android',
+                                  'name': 'Example', **fields}, str(tmp_path))
+
+def current_application(**fields):
+    '''An application record matching the default desired application'''
+    return {'id': 'app-1', 'applicationName': 'Example', 'permissionPrivate': False,
+            'permissionUpload': True, 'permissionDelete': True, **fields}
+
+
+def test_index_applications_uses_first_of_duplicate_package_ids(caplog):
+    applications = [{'id': 'app-1', 'applicationPackageId': 'com.example.app', 'os': 'android'},
+                    {'id': 'app-2', 'applicationPackageId': 'com.example.app', 'os': 'ios'},
+                    {'id': 'app-3', 'applicationPackageId': 'com.example.app', 'os': 'android'}]
+    index = index_applications(applications)
+    assert index[('com.example.app', 'android')]['id'] == 'app-1'
+    assert index[('com.example.app', 'ios')]['id'] == 'app-2'
+    assert 'ignoring app-3' in caplog.text
+
+def test_get_permission_fields():
+    assert get_permission_fields({'private': False, 'no_upload': True, 'no_delete': False}) == \
+        {'permissionPrivate': False, 'permissionUpload': False, 'permissionDelete': True}
+
+def test_get_permission_fields_private():
+    assert get_permission_fields({'private': True, 'no_upload': False, 'no_delete': False}) == \
+        {'permissionPrivate': True, 'permissionUpload': False, 'permissionDelete': False}
+
+def test_missing_application_is_added(tmp_path):
+    assert diff_application(desired_application(tmp_path), None, {}) == ['add']
+
+def test_unchanged_application(tmp_path):
+    assert diff_application(desired_application(tmp_path), current_application(), {}) == []
+
+def test_changed_name_or_permissions(tmp_path):
+    desired = desired_application(tmp_path)
+    assert diff_application(desired, current_application(applicationName='Old'), {}) == \
+        ['update']
+    assert diff_application(desired_application(tmp_path, noDelete=True),
+                            current_application(), {}) == ['update']
+
+def test_settings_files_compared_with_applied_digests(tmp_path):
+    (tmp_path / 'config.json').write_bytes(b'{"a": 1}')
+    desired = desired_application(tmp_path, protectionConfiguration='config.json')
+    digest = hashlib.sha256(b'{"a": 1}').hexdigest()
+    assert diff_application(desired, current_application(), {}) == ['protectionConfiguration']
+    assert diff_application(desired, current_application(),
+                            {'protectionConfiguration': digest}) == []
+    assert diff_application(desired, current_application(),
+                            {'protectionConfiguration': 'other'}) == ['protectionConfiguration']
+
+def test_certificate_compared_with_applied_fingerprint(tmp_path):
+    (tmp_path / 'cert.pem').write_bytes(b'not a pem certificate')
+    desired = desired_application(tmp_path, signingCertificate='cert.pem')
+    fingerprint = hashlib.sha256(b'not a pem certificate').hexdigest()
+    assert diff_application(desired, current_application(),
+                            {'signingCertificate': fingerprint}) == []
+    assert diff_application(desired, current_application(),
+                            {'signingCertificate': 'stale'}) == ['signingCertificate']
@@ -0,0 +1,138 @@
+'''Tests of the binary AndroidManifest.xml reader'''
+import struct
+
+import pytest
+
+from aps_axml import parse_manifest
+from aps_exceptions import ApsException
+
+ANDROID_NAMESPACE = 'http://schemas.android.com/apk/res/android'
+NO_INDEX = 0xFFFFFFFF
+
+# Attribute names with their resource ids, which come first in the string pool
+RESOURCE_ATTRIBUTES = [('versionCode', 0x0101021b), ('versionName', 0x0101021c),
+                       ('minSdkVersion', 0x0101020c), ('debuggable', 0x0101000f),
+                       ('name', 0x01010003)]
+
+
+class ManifestBuilder:
+    '''Builds a binary AndroidManifest.xml'''
+
+    def __init__(self, utf8=False):
+        self.utf8 = utf8
+        self.strings = [name for name, _ in RESOURCE_ATTRIBUTES]
+        self.elements = b''
+
+    def string(self, value):
+        if value not in self.strings:
+            self.strings.append(value)
+        return self.strings.index(value)
+
+    def start(self, name, *attributes):
+        '''Add a start element. attributes are (name, type, value) tuples.'''
+        body = b''
+        for attribute_name, data_type, value in attributes:
+            namespace = NO_INDEX if attribute_name == 'package' else self.string(ANDROID_NAMESPACE)
+            raw_value = NO_INDEX
+            if data_type == 0x03:
+                raw_value = value = self.string(value)
+            body += struct.pack('<IIIHBBI', namespace, self.string(attribute_name), raw_value,
+                                8, 0, data_type, value)
+        header = struct.pack('<IIHHHHHH', NO_INDEX, self.string(name), 20, 20,
+                             len(attributes), 0, 0, 0)
+        self.elements += struct.pack('<HHIII', 0x0102, 16, 16 + len(header) + len(body),
+                                     1, NO_INDEX) + header + body
+        return self
+
+    def end(self, name):
+        self.elements += struct.pack('<HHIIIII', 0x0103, 16, 24, 1, NO_INDEX, NO_INDEX,
+                                     self.string(name))
+        return self
+
+    def string_pool(self):
+        data = b''
+        offsets = []
+        for value in self.strings:
+            offsets.append(len(data))
+            if self.utf8:
+                encoded = value.encode('utf-8')
+                data += bytes([len(value), len(encoded)]) + encoded + b'\0'
+            else:
+                data += struct.pack('<H', len(value)) + value.encode('utf-16-le') + b'\0\0'
+        data += b'\0' * (-len(data) % 4)
+        header_size = 28
+        strings_start = header_size + 4 * len(offsets)
+        return struct.pack('<HHIIIIII', 0x0001, header_size, strings_start + len(data),
+                           len(offsets), 0, 0x100 if self.utf8 else 0, strings_start, 0) + \
+            struct.pack(f'<{len(offsets)}I', *offsets) + data
+
+    def build(self):
+        resource_map = struct.pack(f'<HHI{len(RESOURCE_ATTRIBUTES)}I', 0x0180, 8,
+                                   8 + 4 * len(RESOURCE_ATTRIBUTES),
+                                   *[resource_id for _, resource_id in RESOURCE_ATTRIBUTES])
+        # The elements refer to the strings, so the pool is built last
+        elements = self.elements
+        body = self.string_pool() + resource_map + elements
+        return struct.pack('<HHI', 0x0003, 8, 8 + len(body)) + body
+
+
+def example_manifest(utf8=False):
+    return ManifestBuilder(utf8) \
+        .start('manifest', ('versionCode', 0x10, 42), ('versionName', 0x03, '1.2.3'),
+               ('package', 0x03, 'com.example.app')) \
+        .start('uses-sdk', ('minSdkVersion', 0x10, 21)).end('uses-sdk') \
+        .start('uses-permission', ('name', 0x03, 'android.permission.INTERNET')) \
+        .end('uses-permission') \
+        .start('application', ('debuggable', 0x12, 0xFFFFFFFF)) \
+        .start('activity', ('name', 0x03, '.MainActivity')).end('activity') \
+        .end('application') \
+        .end('manifest') \
+        .build()
+
+
+@pytest.mark.parametrize('utf8', [False, True])
+def test_parse_manifest(utf8):
+    manifest = parse_manifest(example_manifest(utf8))
+    assert manifest['package'] == 'com.example.app'
+    assert manifest['versionName'] == '1.2.3'
+    assert manifest['versionCode'] == 42
+    assert manifest['minSdkVersion'] == 21
+    assert manifest['targetSdkVersion'] is None
+    assert manifest['debuggable'] is True
+    assert manifest['permissions'] == ['android.permission.INTERNET']
+
+def test_nested_elements_do_not_set_manifest_properties():
+    manifest = parse_manifest(ManifestBuilder()
+                              .start('manifest', ('package', 0x03, 'com.example.app'))
+                              .start('application')
+                              .start('uses-sdk', ('minSdkVersion', 0x10, 30)).end('uses-sdk')
+                              .end('application')
+                              .end('manifest')
+                              .build())
+    assert manifest['package'] == 'com.example.app'
+    assert manifest['minSdkVersion'] is None
+    assert manifest['debuggable'] is False
+
+def test_text_manifest_is_rejected():
+    with pytest.raises(ApsException):
+        parse_manifest(b'<?xml version="1.0" encoding="utf-8"?><manifest/>')
+
+@pytest.mark.parametrize('length', [0, 4, 8, 40, 200, -30, -1])
+def test_truncated_manifest_is_rejected(length):
+    with pytest.raises(ApsException):
+        parse_manifest(example_manifest()[:length])
+
+def test_corrupt_string_index_is_rejected():
+    data = bytearray(example_manifest())
+    # Point the name of the first element past the end of the string pool
+    position = data.index(struct.pack('<HH', 0x0102, 16)) + 20
+    data[position:position + 4] = struct.pack('<I', 1000)
+    with pytest.raises(ApsException):
+        parse_manifest(bytes(data))
+
+def test_corrupt_chunk_size_is_rejected():
+    data = bytearray(example_manifest())
+    position = data.index(struct.pack('<HH', 0x0102, 16))
+    data[position + 4:position + 8] = struct.pack('<I', 4)
+    with pytest.raises(ApsException):
+        parse_manifest(bytes(data))
@@ -0,0 +1,21 @@
+'''Tests of signing certificate fingerprints'''
+import base64
+import hashlib
+import os
+
+from aps_utils import certificate_fingerprint
+
+
+def test_certificate_fingerprint_of_pem(tmp_path):
+    der = os.urandom(100)
+    encoded = base64.encodebytes(der)
+    path = tmp_path / 'cert.pem'
+    path.write_bytes(b'-----BEGIN CERTIFICATE-----\n' + encoded +
+                     b'-----END CERTIFICATE-----\n')
+    assert certificate_fingerprint(str(path)) == hashlib.sha256(der).hexdigest()
+
+def test_certificate_fingerprint_of_other_file(tmp_path):
+    path = tmp_path / 'cert.der'
+    path.write_bytes(b'binary certificate')
+    assert certificate_fingerprint(str(path)) == \
+        hashlib.sha256(b'binary certificate').hexdigest()
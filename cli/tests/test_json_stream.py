@@ -0,0 +1,52 @@
+'''Tests of the incremental parsing of streamed JSON listings'''
+import json
+
+import pytest
+
+from aps_utils import iter_json_stream
+
+RECORDS = [{'id': 'a1', 'name': 'Quoted "name", with [brackets] and {braces}'},
+           {'id': 'a2', 'name': 'Escapes \\ \n \t and unicode é中\U0001F600'},
+           {'id': 'a3', 'count': 12345, 'ratio': -1.5e3, 'flags': [True, False, None]}]
+
+
+def chunked(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 100000])
+def test_array_split_across_chunks(size):
+    data = json.dumps(RECORDS, ensure_ascii=False).encode('utf-8')
+    assert list(iter_json_stream(chunked(data, size))) == RECORDS
+
+def test_elements_yielded_before_end_of_document():
+    chunks = iter([b'[{"id": 1}, ', b'{"id": 2}', b']'])
+    records = iter_json_stream(chunks)
+    assert next(records) == {'id': 1}
+    # Only the first chunk was read before the first record was yielded
+    assert next(chunks) == b'{"id": 2}'
+
+def test_number_split_across_chunks():
+    assert list(iter_json_stream([b'[12', b'34, 5', b'6]'])) == [1234, 56]
+
+def test_whitespace_between_elements():
+    assert list(iter_json_stream([b' \n[ 1 ,\n', b' 2 ] \n'])) == [1, 2]
+
+def test_empty_array():
+    assert list(iter_json_stream([b'[', b'  ]'])) == []
+    assert list(iter_json_stream([b'[]'])) == []
+
+def test_non_array_body():
+    error = {'errorMessage': 'Failed', 'nested': [1, 2]}
+    data = json.dumps(error).encode('utf-8')
+    assert list(iter_json_stream(chunked(data, 5))) == [error]
+
+@pytest.mark.parametrize('data', [b'', b'[', b'[{"id": 1}', b'[{"id": 1},', b'[{"id": "ab',
+                                  b'{"errorMessage": "Fail'])
+def test_truncated_body_raises(data):
+    with pytest.raises(ValueError):
+        list(iter_json_stream(chunked(data, 3)))
+
+def test_missing_separator_raises():
+    with pytest.raises(ValueError):
+        list(iter_json_stream([b'[1 2]']))
@@ -0,0 +1,20 @@
+'''Tests of the compression of mapping files'''
+import gzip
+
+from aps_utils import get_upload_name, iter_gzip_stream
+
+
+def test_iter_gzip_stream(tmp_path):
+    data = b''.join(b'line %d of the mapping file\n' % i for i in range(20000))
+    path = tmp_path / 'mapping.txt'
+    path.write_bytes(data)
+    parts = list(iter_gzip_stream(str(path), 4096))
+    assert all(len(part) == 4096 for part in parts[:-1])
+    assert 0 < len(parts[-1]) <= 4096
+    assert gzip.decompress(b''.join(parts)) == data
+    # Unchanged input gives the same output, so an interrupted upload can be continued
+    assert list(iter_gzip_stream(str(path), 4096)) == parts
+
+def test_compressed_upload_name(tmp_path):
+    assert get_upload_name(str(tmp_path / 'mapping.txt'), compress=True) == 'mapping.txt.gz'
+    assert get_upload_name(str(tmp_path / 'mapping.txt')) == 'mapping.txt'
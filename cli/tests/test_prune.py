@@ -0,0 +1,94 @@
+'''Tests of the selection of builds to prune'''
+from datetime import datetime, timezone
+
+import pytest
+
+from aps_exceptions import ApsException
+from aps_utils import select_builds
+
+DAY = 86400
+NOW = 100 * DAY
+
+
+def build(build_id, age_days=None, application='app', state='protect_done'):
+    '''A build record created age_days ago, without a creation time if age_days is None'''
+    record = {'id': build_id, 'applicationId': application, 'state': state}
+    if age_days is not None:
+        record['createdAt'] = NOW - age_days * DAY
+    return record
+
+def ids(builds):
+    return [build['id'] for build in builds]
+
+
+def test_keep_last_keeps_most_recent_per_application():
+    builds = [build('a1', 3), build('a2', 1), build('a3', 2),
+              build('b1', 5, 'other'), build('b2', 4, 'other')]
+    assert ids(select_builds(builds, keep_last=1, now=NOW)) == ['a1', 'a3', 'b1']
+
+def test_older_than():
+    builds = [build('old', 10), build('new', 1)]
+    assert ids(select_builds(builds, older_than=5, now=NOW)) == ['old']
+
+def test_build_without_time_is_never_selected():
+    builds = [build('old', 10), build('unknown'), build('new', 1)]
+    assert ids(select_builds(builds, keep_last=1, now=NOW)) == ['old']
+    assert ids(select_builds(builds, older_than=5, now=NOW)) == ['old']
+    assert ids(select_builds(builds, older_than=5, keep_last=0, now=NOW)) == ['old']
+
+def test_build_with_unreadable_time_is_never_selected():
+    builds = [build('old', 10), dict(build('bad'), createdAt='yesterday')]
+    assert ids(select_builds(builds, keep_last=0, now=NOW)) == ['old']
+
+def test_state_selection_does_not_need_a_time():
+    builds = [build('failed', state='protect_failed'), build('done')]
+    assert ids(select_builds(builds, states=['protect_failed'], now=NOW)) == ['failed']
+
+def test_excluded_states():
+    builds = [build('queued', 10, state='protect_queue'), build('old', 10)]
+    assert ids(select_builds(builds, older_than=5, excluded_states=['protect_queue'],
+                             now=NOW)) == ['old']
+
+def test_older_than_and_keep_last_combined():
+    builds = [build('a1', 30), build('a2', 20), build('a3', 10), build('a4', 1),
+              build('b1', 30, 'other')]
+    # The most recent build of each application is kept even when it is old enough
+    assert ids(select_builds(builds, older_than=5, keep_last=1, now=NOW)) == \
+        ['a1', 'a2', 'a3']
+    assert ids(select_builds(builds, older_than=15, keep_last=3, now=NOW)) == ['a1']
+
+def test_keep_last_counts():
+    builds = [build('a1', 3), build('a2', 2), build('a3', 1)]
+    assert ids(select_builds(builds, keep_last=0, now=NOW)) == ['a1', 'a2', 'a3']
+    assert ids(select_builds(builds, keep_last=2, now=NOW)) == ['a1']
+    assert ids(select_builds(builds, keep_last=5, now=NOW)) == []
+
+def test_older_than_boundary():
+    builds = [build('exact', 5), build('younger', 4.9)]
+    assert ids(select_builds(builds, older_than=5, now=NOW)) == ['exact']
+
+def test_age_and_state_combined():
+    builds = [build('old-failed', 10, state='protect_failed'), build('old-done', 10),
+              build('new-failed', 1, state='protect_failed')]
+    assert ids(select_builds(builds, older_than=5, states=['protect_failed'], now=NOW)) == \
+        ['old-failed']
+
+def test_time_formats():
+    # Millisecond times are told apart by their size, so use a realistic time
+    now = 1700000000
+    created = now - 10 * DAY
+    iso = datetime.fromtimestamp(created, timezone.utc).isoformat().replace('+00:00', 'Z')
+    builds = [{'id': 'iso', 'createdAt': iso},
+              {'id': 'millis', 'createdAt': created * 1000},
+              {'id': 'seconds', 'createdAt': created},
+              {'id': 'new', 'createdAt': now - DAY}]
+    assert ids(select_builds(builds, older_than=5, now=now)) == ['iso', 'millis', 'seconds']
+
+def test_no_build_with_time_fails():
+    builds = [build('a'), build('b')]
+    with pytest.raises(ApsException):
+        select_builds(builds, older_than=5, now=NOW)
+    with pytest.raises(ApsException):
+        select_builds(builds, keep_last=1, now=NOW)
+    assert ids(select_builds(builds, states=['protect_done'], now=NOW)) == ['a', 'b']
+    assert select_builds([], older_than=5, now=NOW) == []
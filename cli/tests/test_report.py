@@ -0,0 +1,38 @@
+'''Tests of the build history report'''
+from aps_report import build_report
+
+DAY = 86400
+
+
+def build(application, state='protect_done', requested=0, started=10, ended=70, **fields):
+    '''A build record protected on the first day'''
+    record = {'id': f'{application}-{state}', 'applicationId': application, 'os': 'android',
+              'state': state, 'protectRequestTime': requested, 'protectStartTime': started,
+              'protectEndTime': ended}
+    record.update(fields)
+    return {field: value for field, value in record.items() if value is not None}
+
+
+def test_build_report():
+    report = build_report([build('app'), build('app', started=30, ended=130),
+                           build('app', 'protect_failed', started=None, ended=None)],
+                          percentiles=[50])
+    stats = report['byApplication']['app']
+    assert stats['builds'] == 3
+    assert stats['protected'] == 2
+    assert stats['failed'] == 1
+    assert stats['failureRatio'] == 1 / 3
+    assert stats['queueTime'] == {'p50': 20}
+    assert stats['protectTime'] == {'p50': 80}
+    assert report['missingTimings'] == 0
+    assert report['throughput'] == [{'date': '1970-01-01', 'protected': 2}]
+
+def test_protected_build_without_times_is_counted(caplog):
+    report = build_report([build('app'), build('other', protectStartTime=None)],
+                          percentiles=[50])
+    assert report['missingTimings'] == 1
+    assert report['byApplication']['other']['missingTimings'] == 1
+    assert report['byApplication']['other']['protected'] == 1
+    assert report['byApplication']['other']['protectTime'] == {'p50': None}
+    assert report['byOs']['android']['protectTime'] == {'p50': 60}
+    assert 'lack some of the protectRequestTime' in caplog.text
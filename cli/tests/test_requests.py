@@ -0,0 +1,25 @@
+'''Tests of the caching of responses'''
+from requests.structures import CaseInsensitiveDict
+
+from aps_requests import cache_lifetime
+
+
+def lifetime(ttl=300, **headers):
+    return cache_lifetime(CaseInsensitiveDict({name.replace('_', '-'): value
+                                               for name, value in headers.items()}), ttl)
+
+
+def test_cache_lifetime_default_ttl():
+    assert lifetime() == 300
+
+def test_cache_lifetime_max_age():
+    assert lifetime(Cache_Control='public, max-age=60') == 60
+    assert lifetime(Cache_Control='max-age=60', ETag='"abc"') == 60
+
+def test_cache_lifetime_no_store():
+    assert lifetime(Cache_Control='no-store') is None
+
+def test_cache_lifetime_revalidated():
+    assert lifetime(Cache_Control='no-cache') == 0
+    assert lifetime(ETag='"abc"') == 0
+    assert lifetime(Last_Modified='Wed, 21 Oct 2015 07:28:00 GMT') == 0
@@ -0,0 +1,17 @@
+'''Tests of the merging of statistics fetched in buckets'''
+from aps_utils import merge_statistics
+
+
+def test_merge_statistics_adds_up_additive_fields():
+    responses = [{'builds': {'android': 1, 'ios': 2}, 'unit': 'day'},
+                 {'builds': {'android': 3}, 'unit': 'day'}]
+    assert merge_statistics(responses) == {'builds': {'android': 4, 'ios': 2}, 'unit': 'day'}
+
+def test_merge_statistics_single_response():
+    assert merge_statistics([{'applications': 5}]) == {'applications': 5}
+
+def test_merge_statistics_refuses_other_fields():
+    assert merge_statistics([{'applications': 2}, {'applications': 3}]) is None
+    assert merge_statistics([{'builds': 1, 'applications': 2}, {'builds': 1}]) is None
+    assert merge_statistics([{'count': 1}, {'count': 2}], additive_fields=['count']) == \
+        {'count': 3}
@@ -0,0 +1,92 @@
+'''Tests of the concurrent task graph'''
+import threading
+import time
+
+import pytest
+
+from aps_exceptions import ApsException, ApsTaskException
+from aps_tasks import check_cancelled, TaskGraph
+
+
+def test_results_passed_in_dependency_order():
+    order = []
+    lock = threading.Lock()
+
+    def task(name, value):
+        def run(*args):
+            with lock:
+                order.append(name)
+            return value + sum(args)
+        return run
+
+    graph = TaskGraph()
+    graph.add('a', task('a', 1))
+    graph.add('b', task('b', 10), 'a')
+    graph.add('c', task('c', 100), 'a')
+    graph.add('d', task('d', 1000), 'c', 'b')
+    assert graph.run() == {'a': 1, 'b': 11, 'c': 101, 'd': 1112}
+    assert order[0] == 'a'
+    assert order[-1] == 'd'
+
+def test_independent_tasks_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    graph = TaskGraph()
+    graph.add('a', barrier.wait)
+    graph.add('b', barrier.wait)
+    assert set(graph.run()) == {'a', 'b'}
+
+def test_unknown_dependency():
+    graph = TaskGraph()
+    with pytest.raises(ApsException):
+        graph.add('a', lambda build: None, 'build')
+
+def test_failure_propagation():
+    started = []
+
+    def fail(_):
+        raise ValueError('broken')
+
+    graph = TaskGraph()
+    graph.add('a', lambda: 'result')
+    graph.add('b', fail, 'a')
+    graph.add('c', lambda *_: started.append('c'), 'b')
+    with pytest.raises(ApsTaskException) as info:
+        graph.run()
+    assert info.value.task == 'b'
+    assert info.value.results == {'a': 'result'}
+    assert isinstance(info.value.__cause__, ValueError)
+    # Tasks depending on the failed one are not started
+    assert not started
+
+def test_running_tasks_cancelled_on_failure():
+    started = threading.Event()
+    cancelled = []
+
+    def upload():
+        started.set()
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            try:
+                check_cancelled()
+            except ApsException:
+                cancelled.append(True)
+                raise
+            time.sleep(0.01)
+
+    def fail():
+        started.wait(5)
+        raise ApsException('certificate rejected')
+
+    graph = TaskGraph()
+    graph.add('upload', upload)
+    graph.add('certificate', fail)
+    start = time.monotonic()
+    with pytest.raises(ApsTaskException) as info:
+        graph.run()
+    assert time.monotonic() - start < 4
+    assert cancelled
+    # The first failure is reported, not the cancellation it caused
+    assert info.value.task == 'certificate'
+
+def test_check_cancelled_outside_graph():
+    check_cancelled()